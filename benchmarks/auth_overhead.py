@@ -0,0 +1,49 @@
+"""
+Microbenchmark of the per-request authentication overhead.
+
+Measures verify_jwt_once() + get_user_from_jwt() inside a request context,
+with the verified token cache disabled (full signature check on every
+request) and enabled (claims served from the cache).
+
+    $ APP_SETTINGS=server.config.TestingConfig python -m benchmarks.auth_overhead
+"""
+import argparse
+import timeit
+
+from flask_jwt_extended import create_access_token
+
+from server import app
+from server.models import db, User
+from server.utils.auth_utils import get_user_from_jwt
+from server.utils.token_cache import verified_tokens
+
+
+def authenticate(headers):
+    with app.test_request_context('/runs', headers=headers):
+        get_user_from_jwt()
+
+
+def run(iterations):
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(id='bench_user').first()
+        if user is None:
+            user = User(id='bench_user', password=User.get_password_hash('bench_user')).save()
+        headers = {'Authorization': 'Bearer ' + create_access_token(identity=user)}
+
+        results = {}
+        for label, cache_size in (('uncached', 0), ('cached', 1024)):
+            app.config['JWT_VERIFIED_TOKEN_CACHE_SIZE'] = cache_size
+            verified_tokens.clear()
+            authenticate(headers)
+            elapsed = timeit.timeit(lambda: authenticate(headers), number=iterations)
+            results[label] = elapsed / iterations * 1e6
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    args = parser.parse_args()
+    for label, micros in run(args.iterations).items():
+        print('{:>10}: {:8.1f} us/request'.format(label, micros))
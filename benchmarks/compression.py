@@ -0,0 +1,89 @@
+"""
+Benchmark of response compression: bandwidth against CPU per encoding and level.
+
+Creates a user with --runs runs in --database (a fresh SQLite file by default),
+takes a page of --page-size runs of GET /runs and the CSV export of all runs
+through the test client, then compresses both bodies with every available
+encoding at several levels. Reports the compression ratio, the CPU time and the
+throughput of each, the export being compressed in its streamed chunks.
+
+    $ python -m benchmarks.compression --runs 5000 --page-size 1000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.sparse_fields import insert_runs, USER
+from server import create_app
+from server.models import db, Run, User
+from server.utils.compression import available_encodings, compress, compress_stream, COMPRESSORS
+
+LEVELS = {'gzip': (1, 5, 6, 9), 'br': (1, 4, 5, 7, 11), 'zstd': (1, 3, 6, 12, 19)}
+
+
+def bodies(app, runs, page_size):
+    insert_runs(runs)
+    client = app.test_client()
+    token = client.post('/user/login', json={'user_id': USER, 'password': 'random'}).get_json()['auth_token']
+    headers = {'Authorization': 'Bearer ' + token, 'Accept-Encoding': 'identity'}
+    page = client.get('/runs?page[size]={}'.format(page_size), headers=headers).get_data()
+    export = list(client.get('/runs/export', headers=headers, buffered=False).response)
+    return {'json:api page': [page], 'csv export': [chunk.encode() if isinstance(chunk, str) else chunk
+                                                    for chunk in export]}
+
+
+def measure(chunks, encoding, level, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        if len(chunks) == 1:
+            size = len(compress(COMPRESSORS[encoding](level), chunks[0]))
+        else:
+            size = sum(len(data) for data in compress_stream(COMPRESSORS[encoding](level), chunks))
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return size, best
+
+
+def run(app, runs, page_size, repeat):
+    results = []
+    for name, chunks in bodies(app, runs, page_size).items():
+        original = sum(len(chunk) for chunk in chunks)
+        results.append((name, 'identity', '', original, 0.0, original))
+        for encoding in ('gzip', 'br', 'zstd'):
+            if encoding not in available_encodings():
+                continue
+            for level in LEVELS[encoding]:
+                size, seconds = measure(chunks, encoding, level, repeat)
+                results.append((name, encoding, level, size, seconds, original))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--database', help='defaults to a temporary SQLite file')
+    args = parser.parse_args()
+
+    app = create_app(os.getenv('APP_SETTINGS') or 'server.config.TestingConfig')
+    directory = tempfile.TemporaryDirectory()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database or 'sqlite:///{}/runs.db'.format(directory.name)
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+    with app.app_context():
+        db.create_all()
+        if not User.query.get(USER):
+            User(id=USER, password=User.get_password_hash('random')).save()
+        try:
+            print('{:>14} {:>9} {:>6} {:>12} {:>7} {:>9} {:>9}'.format(
+                'body', 'encoding', 'level', 'bytes', 'ratio', 'cpu ms', 'MB/s'))
+            for name, encoding, level, size, seconds, original in run(app, args.runs, args.page_size, args.repeat):
+                print('{:>14} {:>9} {:>6} {:>12,} {:>7.1f} {:>9.1f} {:>9}'.format(
+                    name, encoding, level, size, original / size, seconds * 1000,
+                    '{:.0f}'.format(original / seconds / 10 ** 6) if seconds else '-'))
+        finally:
+            Run.query.filter_by(user_id=USER).delete()
+            User.query.filter_by(id=USER).delete()
+            db.session.commit()
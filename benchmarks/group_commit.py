@@ -0,0 +1,96 @@
+"""
+Benchmark of POST /runs throughput with and without group commit.
+
+Posts --runs runs from --clients concurrent threads through the test client,
+against --database (a fresh SQLite file by default), once per group commit
+window of --windows milliseconds (0 commits every request on its own).
+Reports the runs per second, the median and 99th percentile latency and the
+number of commits. Use a PostgreSQL database to measure with its fsync cost.
+
+    $ python -m benchmarks.group_commit --runs 2000 --clients 32 --windows 0,2,5,10
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from server import create_app
+from server.models import db, Run, RunRecords, User
+
+USER = 'bench_group_commit'
+RUN = {'data': {'type': 'run', 'attributes': {
+    'start_time': '2020-01-20T16:34:34', 'end_time': '2020-01-20T16:54:45', 'start_lat': '12.8947909',
+    'start_lng': '77.6427151', 'end_lat': '12.8986343', 'end_lng': '77.656089', 'distance': '3100'},
+    'relationships': {'user': {'data': {'type': 'user', 'id': USER}}}}}
+
+
+def post_runs(app, runs, clients):
+    client = app.test_client()
+    token = client.post('/user/login', json={'user_id': USER, 'password': 'random'}).get_json()['auth_token']
+    headers = {'Authorization': 'Bearer ' + token}
+    # Creates the records of the user, which concurrent first runs would race for.
+    client.post('/runs', json=RUN, headers=headers)
+
+    def post(_):
+        start = time.perf_counter()
+        response = client.post('/runs', json=RUN, headers=headers)
+        assert response.status_code == 201, response.get_data()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        latencies = sorted(pool.map(post, range(runs)))
+    return time.perf_counter() - start, latencies
+
+
+def run(app, runs, clients, windows):
+    results = []
+    commits = []
+
+    def count_commit(connection):
+        commits.append(connection)
+
+    event.listen(db.engine, 'commit', count_commit)
+    try:
+        for window in windows:
+            app.config['RUNS_GROUP_COMMIT_WINDOW_MS'] = window
+            del commits[:]
+            elapsed, latencies = post_runs(app, runs, clients)
+            results.append((window, runs / elapsed, statistics.median(latencies),
+                            latencies[int(len(latencies) * 0.99) - 1], len(commits)))
+    finally:
+        event.remove(db.engine, 'commit', count_commit)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--windows', default='0,2,5,10', help='comma separated milliseconds')
+    parser.add_argument('--database', help='defaults to a temporary SQLite file')
+    args = parser.parse_args()
+
+    app = create_app(os.getenv('APP_SETTINGS') or 'server.config.TestingConfig')
+    directory = tempfile.TemporaryDirectory()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database or 'sqlite:///{}/runs.db'.format(directory.name)
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+    with app.app_context():
+        db.create_all()
+        if not User.query.get(USER):
+            User(id=USER, password=User.get_password_hash('random')).save()
+        try:
+            print('{:>10} {:>9} {:>10} {:>10} {:>8}'.format('window ms', 'runs/s', 'p50 ms', 'p99 ms', 'commits'))
+            for window, throughput, median, p99, commits in run(
+                    app, args.runs, args.clients, [int(window) for window in args.windows.split(',')]):
+                print('{:>10} {:>9.0f} {:>10.1f} {:>10.1f} {:>8}'.format(
+                    window, throughput, median * 1000, p99 * 1000, commits))
+        finally:
+            Run.query.filter_by(user_id=USER).delete()
+            RunRecords.query.filter_by(user_id=USER).delete()
+            User.query.filter_by(id=USER).delete()
+            db.session.commit()
@@ -0,0 +1,87 @@
+"""
+Load test of legitimate API latency during a credential-stuffing burst.
+
+Attacker threads send wrong passwords to /user/login at a fixed rate while
+the main thread measures the latency of authenticated GET /runs requests.
+The victim's password is hashed with production bcrypt cost. The run is
+repeated with the login rate limiter disabled and enabled.
+
+    $ APP_SETTINGS=server.config.TestingConfig python -m benchmarks.login_flood
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+
+from server import app
+from server.models import bcrypt, db, User
+from server.utils.rate_limit import login_rate_limiter
+
+
+def flood(stop, victim, rate, counter):
+    client = app.test_client()
+    while not stop.is_set():
+        start = time.perf_counter()
+        client.post('/user/login', data=json.dumps({'user_id': victim, 'password': 'guess'}),
+                    content_type='application/json')
+        counter.append(1)
+        stop.wait(max(0.0, 1.0 / rate - (time.perf_counter() - start)))
+
+
+def measure(requests, attackers, rate, headers):
+    stop = threading.Event()
+    attempts = []
+    threads = [threading.Thread(target=flood, args=(stop, 'bench_victim', rate, attempts))
+               for _ in range(attackers)]
+    for thread in threads:
+        thread.start()
+    client = app.test_client()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.get('/runs', headers=headers)
+        latencies.append((time.perf_counter() - start) * 1000)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies),
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+        'login_attempts_per_s': len(attempts) / elapsed,
+    }
+
+
+def run(requests, attackers, rate):
+    with app.app_context():
+        db.create_all()
+        if User.query.filter_by(id='bench_user').first() is None:
+            User(id='bench_user', password=User.get_password_hash('bench_user')).save()
+        if User.query.filter_by(id='bench_victim').first() is None:
+            password = bcrypt.generate_password_hash('bench_victim', 12).decode('utf-8')
+            User(id='bench_victim', password=password).save()
+        client = app.test_client()
+        login = client.post('/user/login', data=json.dumps({'user_id': 'bench_user', 'password': 'bench_user'}),
+                            content_type='application/json')
+        headers = {'Authorization': 'Bearer ' + login.get_json()['auth_token']}
+
+        results = {'baseline': measure(requests, 0, rate, headers)}
+        for label, enabled in (('flood, unlimited', False), ('flood, rate limited', True)):
+            app.config['LOGIN_RATE_LIMIT_ENABLED'] = enabled
+            login_rate_limiter.store.clear()
+            results[label] = measure(requests, attackers, rate, headers)
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=200)
+    parser.add_argument('-a', '--attackers', type=int, default=8)
+    parser.add_argument('-r', '--rate', type=float, default=20, help='login attempts per second per attacker')
+    args = parser.parse_args()
+    for label, result in run(args.requests, args.attackers, args.rate).items():
+        print('{:>20}: p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  logins/s {login_attempts_per_s:8.1f}'.format(
+            label, **result))
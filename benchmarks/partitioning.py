@@ -0,0 +1,120 @@
+"""
+Benchmark of the run queries on a partitioned and an unpartitioned run table.
+
+Builds two copies of the run table (PostgreSQL only) with the same synthetic
+runs spread over --months months, then times the weekly summary and the
+date-range listing of one user over the last three months, and a month-wide
+count, on both. The tables are dropped afterwards unless --keep is given.
+
+    $ APP_SETTINGS=server.config.DevelopmentConfig python -m benchmarks.partitioning --runs 10000000 --months 60
+"""
+import argparse
+import statistics
+import time
+from datetime import datetime
+
+from sqlalchemy.schema import CreateTable
+
+from server import app
+from server.models import db
+from server.partitioning import create_partition, month_start, months_between, next_month, partitioned_table
+
+PLAIN, PARTITIONED = 'bench_run_plain', 'bench_run_partitioned'
+USERS = 1000
+
+QUERIES = {
+    'weekly summary': (
+        "SELECT avg(distance), avg(duration), avg(distance / duration), date_part('week', start_time) AS week, "
+        "date_part('year', start_time) AS year FROM {table} "
+        "WHERE user_id = %(user_id)s AND start_time >= %(since)s AND start_time < %(until)s "
+        "GROUP BY year, week ORDER BY year DESC, week DESC"),
+    'runs page': (
+        "SELECT * FROM {table} WHERE user_id = %(user_id)s AND start_time >= %(since)s AND start_time < %(until)s "
+        "ORDER BY start_time DESC LIMIT 30"),
+    'month count': (
+        "SELECT count(*) FROM {table} WHERE start_time >= %(month)s AND start_time < %(next_month)s"),
+}
+
+
+def create_tables(connection, runs, first, last):
+    connection.execute(
+        "INSERT INTO \"user\" (id, password, active) SELECT 'bench_part_' || g, 'x', true "
+        "FROM generate_series(1, %(users)s) g ON CONFLICT DO NOTHING", {'users': USERS})
+    connection.execute('CREATE TABLE {} (LIKE run INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(PLAIN))
+    connection.execute('ALTER TABLE {} ADD PRIMARY KEY (id)'.format(PLAIN))
+    connection.execute(CreateTable(partitioned_table(PARTITIONED)))
+    for month in months_between(first, last):
+        create_partition(connection, month, PARTITIONED)
+
+    seconds = int((last - first).total_seconds())
+    connection.execute(
+        "INSERT INTO {} (id, user_id, start_time, end_time, distance, duration, date) "
+        "SELECT g, 'bench_part_' || (g %% %(users)s + 1), start_time, start_time + interval '30 minutes', "
+        "3000 + g %% 7000, 1800, to_char(start_time, 'YYYY-MM-DD') FROM ("
+        "  SELECT g, %(first)s::timestamp + (random() * %(seconds)s) * interval '1 second' AS start_time "
+        "  FROM generate_series(1, %(runs)s) g) runs".format(PLAIN),
+        {'users': USERS, 'first': first, 'seconds': seconds, 'runs': runs})
+    connection.execute('INSERT INTO {} SELECT * FROM {}'.format(PARTITIONED, PLAIN))
+    for table in (PLAIN, PARTITIONED):
+        connection.execute('CREATE INDEX ON {} (user_id, start_time)'.format(table))
+        connection.execute('ANALYZE {}'.format(table))
+
+
+def drop_tables(connection):
+    for table in (PLAIN, PARTITIONED):
+        connection.execute('DROP TABLE IF EXISTS {} CASCADE'.format(table))
+
+
+def time_query(connection, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(sql, params).fetchall()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def scanned_tables(connection, sql, params):
+    plan = connection.execute('EXPLAIN ' + sql, params).fetchall()
+    return sum(1 for line, in plan if ' on bench_run_' in line)
+
+
+def months_before(month, count):
+    index = month.year * 12 + month.month - 1 - count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def run(runs, months, repeat, keep):
+    last = next_month(month_start(datetime.utcnow()))
+    first = months_before(last, months)
+    since = months_before(last, 3)
+    params = {'user_id': 'bench_part_1', 'since': since, 'until': last, 'month': since, 'next_month': next_month(since)}
+
+    results = []
+    with app.app_context():
+        with db.engine.begin() as connection:
+            drop_tables(connection)
+            create_tables(connection, runs, first, last)
+        try:
+            with db.engine.connect() as connection:
+                for name, sql in QUERIES.items():
+                    for table in (PLAIN, PARTITIONED):
+                        query = sql.format(table=table)
+                        results.append((name, table, time_query(connection, query, params, repeat),
+                                        scanned_tables(connection, query, params)))
+        finally:
+            if not keep:
+                with db.engine.begin() as connection:
+                    drop_tables(connection)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=1000000)
+    parser.add_argument('--months', type=int, default=36)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark tables')
+    args = parser.parse_args()
+    for name, table, millis, scanned in run(args.runs, args.months, args.repeat, args.keep):
+        print('{:>15} on {:<22}: {:8.2f} ms, {:>3} relations scanned'.format(name, table, millis, scanned))
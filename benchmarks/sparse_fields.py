@@ -0,0 +1,102 @@
+"""
+Benchmark of GET /runs pages with and without sparse fieldsets.
+
+Creates a user with --runs runs carrying a weather_info of the size returned by
+OpenWeatherMap in --database (a fresh SQLite file by default), then requests
+pages of --page-size runs through the test client: all fields, a sparse
+fieldset of distance and duration, and one with weather_info. Reports the
+median latency, the response size and the columns selected.
+
+    $ python -m benchmarks.sparse_fields --runs 5000 --page-size 1000
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from server import create_app
+from server.models import db, Run, User
+
+USER = 'bench_fields'
+WEATHER = json.dumps({
+    'reference_time': 1579538074, 'sunset_time': 1579524421, 'sunrise_time': 1579483069,
+    'clouds': 20, 'rain': {}, 'snow': {}, 'wind': {'speed': 2.6, 'deg': 90},
+    'humidity': 44, 'pressure': {'press': 1014, 'sea_level': None},
+    'temperature': {'temp': 298.15, 'temp_kf': None, 'temp_max': 299.15, 'temp_min': 297.04},
+    'status': 'Clouds', 'detailed_status': 'few clouds', 'weather_code': 801, 'weather_icon_name': '02n',
+    'visibility_distance': 6000, 'dewpoint': None, 'humidex': None, 'heat_index': None,
+})
+PAGES = {
+    'all fields': '',
+    'distance,duration': '&fields[run]=distance,duration',
+    'with weather_info': '&fields[run]=distance,duration,weather_info',
+}
+
+
+def insert_runs(count):
+    start = datetime(2020, 1, 1, 7)
+    rows = [{'user_id': USER, 'start_time': start + timedelta(days=index),
+             'end_time': start + timedelta(days=index, minutes=30), 'distance': 5000, 'duration': 1800,
+             'date': (start + timedelta(days=index)).strftime('%Y-%m-%d'), 'start_lat': '12.8947909',
+             'start_lng': '77.6427151', 'end_lat': '12.8986343', 'end_lng': '77.656089',
+             'weather_info': WEATHER} for index in range(count)]
+    db.session.execute(Run.__table__.insert(), rows)
+    db.session.commit()
+
+
+def run(app, runs, page_size, repeat):
+    insert_runs(runs)
+    client = app.test_client()
+    token = client.post('/user/login', json={'user_id': USER, 'password': 'random'}).get_json()['auth_token']
+    headers = {'Authorization': 'Bearer ' + token}
+    selects = []
+
+    def record(conn, cursor, statement, *args):
+        if statement.lstrip().startswith('SELECT') and 'FROM run' in statement and 'count(' not in statement:
+            selects.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    results = []
+    for name, fields in PAGES.items():
+        url = '/runs?page[size]={}{}'.format(page_size, fields)
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.get(url, headers=headers)
+            samples.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.get_data()
+        columns = selects[-1].split(' FROM ')[0].count('run.')
+        results.append((name, statistics.median(samples) * 1000, len(response.get_data()), columns))
+    event.remove(db.engine, 'before_cursor_execute', record)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--database', help='defaults to a temporary SQLite file')
+    args = parser.parse_args()
+
+    app = create_app(os.getenv('APP_SETTINGS') or 'server.config.TestingConfig')
+    directory = tempfile.TemporaryDirectory()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database or 'sqlite:///{}/runs.db'.format(directory.name)
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+    with app.app_context():
+        db.create_all()
+        if not User.query.get(USER):
+            User(id=USER, password=User.get_password_hash('random')).save()
+        try:
+            print('{:>20} {:>10} {:>12} {:>8}'.format('page', 'ms', 'bytes', 'columns'))
+            for name, ms, size, columns in run(app, args.runs, args.page_size, args.repeat):
+                print('{:>20} {:>10.1f} {:>12,} {:>8}'.format(name, ms, size, columns))
+        finally:
+            Run.query.filter_by(user_id=USER).delete()
+            User.query.filter_by(id=USER).delete()
+            db.session.commit()
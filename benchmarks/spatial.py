@@ -0,0 +1,109 @@
+"""
+Benchmark of the spatial run queries: geohash prefix ranges against a full scan.
+
+Inserts --runs synthetic runs scattered around 200 city centres into the run
+table of --database (a fresh SQLite file by default), then times bounding box
+and radius queries through server.spatial against the same boxes filtered by
+casting start_lat/start_lng on every row, checking that both return the same
+runs. The runs are deleted afterwards unless --keep is given.
+
+    $ python -m benchmarks.spatial --runs 1000000
+    $ APP_SETTINGS=server.config.DevelopmentConfig python -m benchmarks.spatial --database postgresql://localhost/jogging_times
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import cast, Float
+
+from server import create_app
+from server.models import db, Run, User
+from server.spatial import nearby, radius_bbox, within_bbox
+from server.utils import geohash
+
+USER = 'bench_spatial'
+CITIES = 200
+# Boxes of ~1 km and ~10 km around a city centre and the radius of the nearby query in meters.
+BOXES = {'1 km box': 0.0045, '10 km box': 0.045}
+RADIUS = 2000
+
+
+def insert_runs(count, seed=0):
+    rng = random.Random(seed)
+    cities = [(rng.uniform(-50, 60), rng.uniform(-120, 150)) for _ in range(CITIES)]
+    table = Run.__table__
+    start = datetime(2020, 1, 1)
+    for offset in range(0, count, 10000):
+        rows = []
+        for _ in range(min(10000, count - offset)):
+            city_lat, city_lng = rng.choice(cities)
+            lat = max(-90.0, min(90.0, rng.gauss(city_lat, 0.1)))
+            lng = max(-180.0, min(180.0, rng.gauss(city_lng, 0.1)))
+            rows.append({'user_id': USER, 'start_time': start, 'end_time': start, 'distance': 5000,
+                         'duration': 1800, 'date': '2020-01-01', 'start_lat': '{:.7f}'.format(lat),
+                         'start_lng': '{:.7f}'.format(lng), 'start_geohash': geohash.encode(lat, lng)})
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+    return cities
+
+
+def full_scan(min_lat, min_lng, max_lat, max_lng):
+    lat, lng = cast(Run.start_lat, Float), cast(Run.start_lng, Float)
+    return Run.query.filter(lat.between(min_lat, max_lat), lng.between(min_lng, max_lng))
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return result, statistics.median(samples) * 1000
+
+
+def run(runs, repeat, seed=0):
+    cities = insert_runs(runs, seed)
+    results = []
+    for name, half in BOXES.items():
+        lat, lng = cities[0]
+        box = (lat - half, lng - half, lat + half, lng + half)
+        indexed, indexed_ms = timed(lambda: sorted(run.id for run in within_bbox(Run.query, *box)), repeat)
+        scanned, scan_ms = timed(lambda: sorted(run.id for run in full_scan(*box)), max(1, repeat // 5))
+        assert indexed == scanned, name
+        results.append((name, len(indexed), indexed_ms, scan_ms))
+
+    lat, lng = cities[0]
+    matches, nearby_ms = timed(lambda: nearby(Run.query, lat, lng, RADIUS, 1000), repeat)
+    _, scan_ms = timed(lambda: full_scan(*radius_bbox(lat, lng, RADIUS)).all(), max(1, repeat // 5))
+    results.append(('{} m radius'.format(RADIUS), len(matches), nearby_ms, scan_ms))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--database', help='defaults to a temporary SQLite file')
+    parser.add_argument('--keep', action='store_true')
+    args = parser.parse_args()
+
+    app = create_app(os.getenv('APP_SETTINGS') or 'server.config.TestingConfig')
+    directory = tempfile.TemporaryDirectory()
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database or 'sqlite:///{}/runs.db'.format(directory.name)
+    with app.app_context():
+        db.create_all()
+        if not User.query.get(USER):
+            db.session.add(User(id=USER, password='x'))
+            db.session.commit()
+        try:
+            print('{:>16} {:>8} {:>12} {:>12}'.format('query', 'runs', 'geohash ms', 'scan ms'))
+            for name, count, indexed_ms, scan_ms in run(args.runs, args.repeat):
+                print('{:>16} {:>8} {:>12.2f} {:>12.2f}'.format(name, count, indexed_ms, scan_ms))
+        finally:
+            if not args.keep:
+                Run.query.filter_by(user_id=USER).delete()
+                db.session.commit()
@@ -0,0 +1,75 @@
+"""
+Cold-start benchmark of a worker, measured with `python -X importtime`.
+
+Each sample starts a fresh interpreter that builds the app through the
+factory, like a gunicorn worker does. Reports the wall time, the total import
+time and the slowest top-level imports, and can append the results to a JSON
+lines file to track them across changes.
+
+    $ APP_SETTINGS=server.config.ProductionConfig python -m benchmarks.startup --record startup.jsonl
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BOOT_SCRIPT = 'from server import create_app; create_app()'
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr):
+    """
+    Returns {module: cumulative microseconds} of the top-level imports.
+    """
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented below their parent.
+        if name.startswith(' ') and not name.startswith('  '):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+
+def sample():
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', BOOT_SCRIPT],
+                             cwd=PROJECT_DIR, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    wall = time.perf_counter() - start
+    return wall, parse_importtime(process.stderr)
+
+
+def run(samples):
+    walls, totals = [], []
+    slowest = {}
+    for _ in range(samples):
+        wall, imports = sample()
+        walls.append(wall * 1000)
+        totals.append(sum(imports.values()) / 1000)
+        for name, micros in imports.items():
+            slowest[name] = max(slowest.get(name, 0), micros / 1000)
+    return {
+        'timestamp': time.time(),
+        'samples': samples,
+        'wall_ms': statistics.median(walls),
+        'import_ms': statistics.median(totals),
+        'slowest_imports_ms': dict(sorted(slowest.items(), key=lambda item: -item[1])[:10]),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--samples', type=int, default=5)
+    parser.add_argument('--record', help='JSON lines file the results are appended to')
+    args = parser.parse_args()
+    result = run(args.samples)
+    print('cold start: {wall_ms:.1f} ms wall, {import_ms:.1f} ms importing (median of {samples})'.format(**result))
+    for name, millis in result['slowest_imports_ms'].items():
+        print('{:>40}: {:7.1f} ms'.format(name, millis))
+    if args.record:
+        with open(args.record, 'a') as record:
+            record.write(json.dumps(result) + '\n')
@@ -0,0 +1,109 @@
+"""
+Benchmark of the NumPy run statistics against a pure Python baseline.
+
+Generates synthetic run histories and times the conversion of the query rows
+into columnar arrays plus server.stats.compute_stats against the same metrics
+computed run by run in Python, checking that both agree. No database is needed.
+
+    $ python -m benchmarks.stats --runs 1000 100000 1000000
+"""
+import argparse
+import math
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+from server.stats import arrays_from_rows, compute_stats
+
+NOW = datetime(2020, 6, 1)
+
+
+def generate(count):
+    # A run every 20 hours, packed closer for very long histories.
+    step = min(timedelta(hours=20), timedelta(days=365 * 50) / count)
+    start = NOW - step * count
+    runs = []
+    for index in range(count):
+        distance = random.randint(2000, 21000)
+        runs.append((start + step * index, distance, distance * random.uniform(0.25, 0.4)))
+    return runs
+
+
+def percentile(values, q):
+    # Linear interpolation, as numpy.percentile.
+    position = (len(values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def python_stats(runs, now, window=10):
+    today = now.date()
+    paces = [duration * 1000 / distance for _, distance, duration in runs]
+    sorted_paces = sorted(paces)
+    rolling = [sum(paces[index - window:index]) / window for index in range(window, len(paces) + 1)]
+    days = sorted({start_time.date() for start_time, _, _ in runs})
+    longest = current = 1
+    for previous, day in zip(days, days[1:]):
+        current = current + 1 if (day - previous).days == 1 else 1
+        longest = max(longest, current)
+
+    def minutes_in(number):
+        return sum(duration for start_time, _, duration in runs if 0 <= (today - start_time.date()).days < number) / 60
+
+    return {
+        'total_distance': sum(distance for _, distance, _ in runs),
+        'average_pace': statistics.mean(paces),
+        'pace_median': percentile(sorted_paces, 50),
+        'best_rolling_pace': min(rolling),
+        'longest_streak': longest,
+        'acute_load': minutes_in(7),
+        'longest_run': max(distance for _, distance, _ in runs),
+    }
+
+
+def numpy_stats(rows, now, window=10):
+    stats = compute_stats(arrays_from_rows(rows), now=now, window=window)
+    return {
+        'total_distance': stats['total_distance'],
+        'average_pace': stats['average_pace'],
+        'pace_median': stats['pace_percentiles']['50'],
+        'best_rolling_pace': stats['rolling']['best_pace_over_{}_runs'.format(window)],
+        'longest_streak': stats['streaks']['longest'],
+        'acute_load': stats['training_load']['acute'],
+        'longest_run': stats['personal_bests']['longest_run']['distance'],
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def run(run_counts):
+    # The first call pays for NumPy's lazy imports.
+    numpy_stats([(0, 1000, 300)] * 20, NOW)
+    results = []
+    for count in run_counts:
+        runs = generate(count)
+        # Each side gets the rows of its query: datetimes for the ORM, epoch seconds for load_runs.
+        rows = [(start_time.replace(tzinfo=timezone.utc).timestamp(), distance, duration)
+                for start_time, distance, duration in runs]
+        expected, python_ms = timed(python_stats, runs, NOW)
+        actual, numpy_ms = timed(numpy_stats, rows, NOW)
+        for key, value in expected.items():
+            if not math.isclose(value, actual[key], rel_tol=1e-9):
+                raise AssertionError('{}: {} != {}'.format(key, value, actual[key]))
+        results.append((count, python_ms, numpy_ms))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, nargs='+', default=[1000, 100000, 1000000])
+    args = parser.parse_args()
+    for count, python_ms, numpy_ms in run(args.runs):
+        print('{:>9} runs: python {:9.2f} ms, numpy {:8.2f} ms ({:5.1f}x)'.format(
+            count, python_ms, numpy_ms, python_ms / numpy_ms))
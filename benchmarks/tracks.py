@@ -0,0 +1,68 @@
+"""
+Benchmark of the GPS track storage: bytes per run and decode throughput.
+
+Encodes synthetic 1 Hz tracks and reports the stored size against the JSON
+upload and a naive row per point (lat, lng, time as 8 byte values), the
+encode and full decode throughput, the latency of a range read and of
+Douglas-Peucker simplification at a few tolerances. No database is needed.
+
+    $ python -m benchmarks.tracks --points 3600 36000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from server.tracks import decode, encode, simplify
+
+REPEAT = 20
+
+
+def synthetic_track(count, seed=0):
+    # A run at ~3 m/s with a slowly turning heading, GPS noise of ~2 m.
+    random = np.random.RandomState(seed)
+    heading = np.cumsum(random.normal(0, 0.05, count))
+    step = 3 / 111195
+    lat = 12.9 + np.cumsum(np.cos(heading) * step) + random.normal(0, 2 / 111195, count)
+    lng = 77.6 + np.cumsum(np.sin(heading) * step) + random.normal(0, 2 / 111195, count)
+    return lat, lng, 1579538074 + np.arange(count, dtype=float)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = fn(*args)
+    return result, (time.perf_counter() - start) / REPEAT
+
+
+def run(point_counts, block_size):
+    results = []
+    for count in point_counts:
+        lat, lng, times = synthetic_track(count)
+        json_bytes = len(json.dumps(np.stack([lat, lng, times], axis=1).tolist()))
+        data, encode_s = timed(encode, lat, lng, times, block_size)
+        _, decode_s = timed(decode, data)
+        _, range_s = timed(decode, data, count // 2, count // 2 + 100)
+        simplified = {tolerance: (len(keep), seconds) for tolerance in (1, 5, 20)
+                      for keep, seconds in [timed(simplify, lat, lng, tolerance)]}
+        results.append({
+            'points': count, 'bytes': len(data), 'json_bytes': json_bytes, 'row_bytes': count * 24,
+            'encode_points_per_s': count / encode_s, 'decode_points_per_s': count / decode_s,
+            'range_read_ms': range_s * 1000, 'simplified': simplified,
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+', default=[3600, 36000])
+    parser.add_argument('--block-size', type=int, default=1024)
+    args = parser.parse_args()
+    for result in run(args.points, args.block_size):
+        print('{points:>7} points: {bytes:>8} bytes ({per_point:.2f}/point), JSON {json_bytes} bytes, '
+              'rows {row_bytes} bytes'.format(per_point=result['bytes'] / result['points'], **result))
+        print('{:>15}encode {encode_points_per_s:,.0f} points/s, decode {decode_points_per_s:,.0f} points/s, '
+              '100 point range read {range_read_ms:.3f} ms'.format('', **result))
+        for tolerance, (kept, seconds) in result['simplified'].items():
+            print('{:>15}simplified at {:>2} m: {:>6} points in {:.2f} ms'.format('', tolerance, kept, seconds * 1000))
@@ -0,0 +1,67 @@
+"""
+Benchmark of DELETE /users/<id> for users with large run histories.
+
+The request only deactivates the user and records the deletion, so its
+latency should not depend on the number of runs. The background purge is
+timed separately.
+
+    $ APP_SETTINGS=server.config.TestingConfig python -m benchmarks.user_delete --runs 1000 1000000
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+from server import app
+from server.models import db, Role, Run, User
+from server.tasks import purge_user
+
+CHUNK_SIZE = 50000
+
+
+def insert_runs(user_id, count):
+    start = datetime(2000, 1, 1)
+    for offset in range(0, count, CHUNK_SIZE):
+        db.session.execute(Run.__table__.insert(), [
+            {'user_id': user_id, 'start_time': start + timedelta(hours=i), 'end_time': start + timedelta(hours=i, minutes=30),
+             'distance': 5000, 'duration': 1800}
+            for i in range(offset, min(count, offset + CHUNK_SIZE))
+        ])
+        db.session.commit()
+
+
+def run(run_counts):
+    app.config['BACKGROUND_JOBS_MODE'] = 'deferred'
+    results = []
+    with app.app_context():
+        db.create_all()
+        admin_role = Role.query.filter_by(name='admin').first() or Role(name='admin', privileged=True).save()
+        if User.query.filter_by(id='bench_admin').first() is None:
+            User(id='bench_admin', password=User.get_password_hash('bench_admin'), roles=[admin_role]).save()
+        client = app.test_client()
+        login = client.post('/user/login', data=json.dumps({'user_id': 'bench_admin', 'password': 'bench_admin'}),
+                            content_type='application/json')
+        headers = {'Authorization': 'Bearer ' + login.get_json()['auth_token']}
+        for count in run_counts:
+            user_id = 'bench_user_{}'.format(count)
+            User(id=user_id, password=User.get_password_hash(user_id)).save()
+            insert_runs(user_id, count)
+
+            start = time.perf_counter()
+            response = client.delete('/users/' + user_id, headers=headers, content_type='application/json')
+            request_ms = (time.perf_counter() - start) * 1000
+            deletion_id = response.get_json()['meta']['deletion']['id']
+
+            start = time.perf_counter()
+            purge_user(deletion_id)
+            purge_s = time.perf_counter() - start
+            results.append((count, request_ms, purge_s))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, nargs='+', default=[1000, 1000000])
+    args = parser.parse_args()
+    for count, request_ms, purge_s in run(args.runs):
+        print('{:>9} runs: DELETE request {:7.2f} ms, background purge {:8.2f} s'.format(count, request_ms, purge_s))
@@ -0,0 +1,27 @@
+# Gunicorn settings, see `server.warmup` for the warmup hooks.
+import gc
+
+bind = '0.0.0.0:5000'
+workers = 4
+worker_class = 'gevent'
+# Concurrent connections per worker, most of them idle summary event streams.
+worker_connections = 5000
+# Import the app once in the master, workers share it copy-on-write.
+preload_app = True
+
+
+def when_ready(server):
+    from server import warmup
+
+    # Set before the workers fork, they report ready once post_worker_init ran.
+    warmup.hooked = True
+    warmup.prepare(server.app.wsgi())
+    # Keep the preloaded objects out of the collector, which would otherwise
+    # touch their pages and unshare them in every worker.
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    from server.warmup import warm_worker
+
+    warm_worker(worker.wsgi)
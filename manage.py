@@ -1,20 +1,36 @@
 # manage.py
 
+import csv
 import os
 import unittest
+from datetime import datetime, timedelta
 
-import coverage
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+from flask_script import Command, Manager
 
-from server import app
-from server.models import db, Role, User
+from server import create_app
+from server.models import db, BlacklistToken, IdempotencyKey, Role, User
 
-migrate = Migrate(app, db)
+app = create_app()
 manager = Manager(app)
 
+
+class MigrationsCommand(Command):
+    """
+    Database migrations with Flask-Migrate, see `manage.py db --help`.
+    """
+    # The arguments are Flask-Migrate's, which is only imported when the command runs.
+    capture_all_args = True
+    help_args = ()
+
+    def run(self, args):
+        from flask_migrate import Migrate, MigrateCommand
+
+        Migrate(app, db)
+        return MigrateCommand.handle('manage.py db', args)
+
+
 # migrations
-manager.add_command('db', MigrateCommand)
+manager.add_command('db', MigrationsCommand())
 
 
 @manager.command
@@ -34,6 +50,8 @@ def cov():
     """
     Runs the unit tests with coverage.
     """
+    import coverage
+
     COV = coverage.coverage(
         branch=True,
         include='server/*',
@@ -66,6 +84,10 @@ def create_db():
     Creates the db tables.
     """
     db.create_all()
+    if app.config.get('RUNS_PARTITIONED'):
+        from server.partitioning import migrate_to_partitioned
+
+        migrate_to_partitioned(drop_legacy=True)
     populate_roles()
     create_admin_user()
 
@@ -78,6 +100,232 @@ def drop_db():
     db.drop_all()
 
 
+@manager.command
+def purge_blacklist():
+    """
+    Deletes blacklist entries of expired tokens and of tokens below the revocation watermark.
+    """
+    deleted = BlacklistToken.purge(app.config.get('JWT_REVOCATION_WATERMARK'))
+    print('Purged {} blacklisted tokens.'.format(deleted))
+
+
+@manager.command
+def purge_idempotency_keys():
+    """
+    Deletes the expired idempotency keys.
+    """
+    print('Purged {} idempotency keys.'.format(IdempotencyKey.purge()))
+
+
+@manager.command
+def bulk_create_users(path, processes=None):
+    """
+    Creates users from a CSV file with the columns id, email, password,
+    first_name, last_name and roles (separated by ';').
+    """
+    from server.utils.provisioning import provision_users
+
+    with open(path, newline='') as csv_file:
+        rows = []
+        for line in csv.DictReader(csv_file):
+            attributes = {key: value for key, value in line.items() if key != 'id' and value}
+            attributes['roles'] = [role for role in line.get('roles', '').split(';') if role] or ['user']
+            rows.append({'type': 'user', 'id': line['id'], 'attributes': attributes})
+    results = provision_users(rows, allow_privileged=True, processes=int(processes) if processes else None)
+    failed = [result for result in results if result['status'] != '201']
+    for result in failed:
+        print('Row {index} ({id}): {status} {title} {detail}'.format(**{'title': '', 'detail': '', **result}))
+    print('Created {} users, {} failed.'.format(len(results) - len(failed), len(failed)))
+
+
+@manager.command
+def resume_user_deletions():
+    """
+    Completes the removal of deleted users, for deferred or interrupted deletions.
+    """
+    from server.tasks import resume_user_deletions as resume
+
+    print('Completed {} user deletions.'.format(resume()))
+
+
+@manager.option('--concurrency', dest='concurrency', type=int, default=4)
+@manager.option('--burst', dest='burst', action='store_true', default=False, help='exit once no job is due')
+def worker(concurrency, burst):
+    """
+    Runs the jobs of the job queue with `concurrency` threads, until SIGINT or SIGTERM.
+    """
+    import signal
+    from server.jobs import Worker
+
+    job_worker = Worker(app, concurrency, burst)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: job_worker.stop())
+    print('Running jobs with {} threads.'.format(concurrency))
+    job_worker.run()
+
+
+@manager.option('name')
+@manager.option('--args', dest='args', default='[]', help='JSON list of the arguments')
+@manager.option('--priority', dest='priority', type=int, default=0)
+@manager.option('--delay', dest='delay', type=int, default=0, help='seconds')
+def enqueue(name, args, priority, delay):
+    """
+    Queues a job, e.g. from cron: `manage.py enqueue purge_blacklist`.
+    """
+    import json
+    from server.jobs import enqueue as enqueue_job
+
+    job = enqueue_job(name, *json.loads(args), priority=priority, delay=delay)
+    print('Queued job {}.'.format(job.id))
+
+
+@manager.command
+def job_stats():
+    """
+    Prints the depth and latency of the job queue.
+    """
+    import json
+    from server.jobs import metrics
+
+    print(json.dumps(metrics(), indent=2, sort_keys=True))
+
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=50000)
+@manager.option('--drop-legacy', dest='drop_legacy', action='store_true', default=False)
+def partition_runs(batch_size, drop_legacy):
+    """
+    Moves the runs into a table partitioned by start_time month (PostgreSQL).
+    """
+    from server.partitioning import is_partitioned, migrate_to_partitioned
+
+    with db.engine.connect() as connection:
+        if is_partitioned(connection):
+            print('The run table is partitioned already.')
+            return
+    copied = migrate_to_partitioned(batch_size, drop_legacy)
+    print('Copied {} runs into the partitioned table.'.format(copied))
+
+
+@manager.option('--months', dest='months', type=int, default=3)
+def create_run_partitions(months):
+    """
+    Creates the run partitions of the upcoming months ahead of time, e.g. from
+    cron, and of the months whose runs fell in the default partition.
+    """
+    from server.partitioning import create_partitions, default_partition_months, month_start, next_month
+
+    moved = default_partition_months()
+    for month in moved:
+        create_partitions(month, month)
+    last = month_start(datetime.utcnow())
+    for _ in range(months):
+        last = next_month(last)
+    names = create_partitions(datetime.utcnow(), last)
+    print('Run partitions up to {}, {} months moved out of the default partition.'.format(names[-1], len(moved)))
+
+
+@manager.option('--before', dest='before', help='ISO date, defaults to --days before today')
+@manager.option('--days', dest='days', type=int, default=730)
+@manager.option('--batch-size', dest='batch_size', type=int, default=5000)
+def archive_runs(before, days, batch_size):
+    """
+    Moves the runs which started before the cutoff into the columnar archive.
+    """
+    from server.archive import archive_runs as archive
+
+    cutoff = datetime.fromisoformat(before) if before else datetime.utcnow() - timedelta(days=days)
+    users, runs = archive(cutoff, batch_size)
+    print('Archived {} runs of {} users started before {}.'.format(runs, users, cutoff.isoformat()))
+
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=10000)
+def backfill_geohashes(batch_size):
+    """
+    Computes the start geohash of the runs which don't have one yet.
+    """
+    from server.spatial import backfill_geohashes as backfill
+
+    print('Computed the geohash of {} runs.'.format(backfill(batch_size)))
+
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=1000)
+@manager.option('--stale', dest='stale', action='store_true', default=False,
+                help='also refresh the weather fetched long after the end of the run')
+@manager.option('--restart', dest='restart', action='store_true', default=False,
+                help='scan from the first run instead of the saved checkpoint')
+def backfill_weather(batch_size, stale, restart):
+    """
+    Fetches the weather of the runs stored without one, resuming from the last checkpoint.
+    """
+    from server.weather_backfill import backfill
+
+    def progress(stats):
+        print('{processed} runs scanned, {updated} updated, {unavailable} without weather, {calls} provider calls, '
+              '{runs_per_second:.0f} runs/s, {remaining} left.'.format(**stats))
+
+    stats = backfill(batch_size, stale, restart, progress)
+    print('Updated the weather of {updated} runs with {calls} provider calls.'.format(**stats))
+
+
+@manager.command
+def enable_postgis():
+    """
+    Adds the PostGIS geography column of the run start points, set RUNS_SPATIAL_BACKEND=postgis to use it.
+    """
+    from server.spatial import enable_postgis as enable
+
+    enable()
+    print('PostGIS start point column and index created.')
+
+
+@manager.option('--retention-days', dest='retention_days', type=int)
+def compact_run_changes(retention_days):
+    """
+    Compacts the run change log, see RUN_CHANGES_TOMBSTONE_RETENTION_DAYS.
+    """
+    from server.changes import compact
+
+    days = retention_days if retention_days is not None else app.config['RUN_CHANGES_TOMBSTONE_RETENTION_DAYS']
+    superseded, tombstones = compact(timedelta(days=days))
+    print('Removed {} superseded changes and {} tombstones.'.format(superseded, tombstones))
+
+
+@manager.option('--batch-size', dest='batch_size', type=int, default=50000)
+def backfill_run_changes(batch_size):
+    """
+    Adds the runs created before the change log to it, so that a sync from 0 returns them.
+    """
+    from server.changes import backfill
+
+    print('Logged {} runs.'.format(backfill(batch_size)))
+
+
+@manager.command
+def create_run_shards():
+    """
+    Creates the run table in the databases of RUNS_SHARDS.
+    """
+    from server.sharding import create_shards, shards
+
+    create_shards()
+    print('Run table created in {}.'.format(', '.join(shards()) or 'no shard'))
+
+
+@manager.option('--from', dest='sources', default='main',
+                help="comma separated bind keys the runs are in, 'main' for the main database")
+@manager.option('--batch-size', dest='batch_size', type=int, default=5000)
+def reshard_runs(sources, batch_size):
+    """
+    Moves the runs of the given databases into their shard under RUNS_SHARDS.
+    """
+    from server.sharding import reshard, shards
+
+    if not shards():
+        print('RUNS_SHARDS is not set.')
+        return
+    print('Moved {} runs.'.format(reshard(sources.split(','), batch_size)))
+
+
 def populate_roles():
     Role(name="admin", description="Admin role", privileged=True).save()
     Role(name="usermanager", description="User Manager role", privileged=True).save()
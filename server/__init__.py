@@ -4,29 +4,55 @@ import os
 
 from flask import Flask
 
-from server.views import auth_blueprint, jwt, api
-from server.models import bcrypt, db
-
 STATIC_FOLDER = './../client/static'
 TEMPLATE_FOLDER = './../client/templates'
 
-app = Flask(__name__, template_folder=TEMPLATE_FOLDER, static_folder=STATIC_FOLDER, static_url_path='')
-
-load_dotenv(os.path.join(pathlib.Path(__file__).parent, '.flaskenv'), verbose=True)
-app_settings = os.getenv(
-    'APP_SETTINGS'
-)
-app.config.from_object(app_settings)
 
-bcrypt.init_app(app)
-db.init_app(app)
-jwt.init_app(app)
-api.init_app(app)
+def create_app(config_object=None):
+    """
+    Application factory, the resources and their dependencies are imported here
+    so that importing the package stays cheap.
+    """
+    from server.models import bcrypt, db
+    from server.views import (auth_blueprint, health_blueprint, operations_blueprint, runs_blueprint, users_blueprint,
+                              jwt, api)
+    from server.utils.compression import compression
+    from server.utils.rate_limit import login_rate_limiter
+
+    app = Flask(__name__, template_folder=TEMPLATE_FOLDER, static_folder=STATIC_FOLDER, static_url_path='')
+
+    load_dotenv(os.path.join(pathlib.Path(__file__).parent, '.flaskenv'), verbose=True)
+    app.config.from_object(config_object or os.getenv('APP_SETTINGS'))
+
+    bcrypt.init_app(app)
+    db.init_app(app)
+    jwt.init_app(app)
+    api.init_app(app)
+    login_rate_limiter.init_app(app)
+    compression.init_app(app)
+
+    # Blueprints
+    app.register_blueprint(auth_blueprint, url_prefix='/user')
+    app.register_blueprint(health_blueprint, url_prefix='/health')
+    app.register_blueprint(users_blueprint, url_prefix='/users')
+    app.register_blueprint(runs_blueprint, url_prefix='/runs')
+    app.register_blueprint(operations_blueprint, url_prefix='/operations')
+    return app
+
+
+def __getattr__(name):
+    # `server.app` is created on first access, e.g. by `from server import app`.
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    # The models import Flask-Security, they're loaded with the app.
+    if name in ('bcrypt', 'db'):
+        from server import models
+        return getattr(models, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-# Blueprints
-app.register_blueprint(auth_blueprint, url_prefix='/user')
 
 if __name__ == "__main__":
     port = os.getenv("PORT", 5000)
-    app.run(port=port, host='0.0.0.0')
-
+    create_app().run(port=port, host='0.0.0.0')
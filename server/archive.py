@@ -0,0 +1,284 @@
+###
+# Columnar archive of historical runs, one zstd compressed Arrow IPC file per user and year.
+###
+import heapq
+import os
+import shutil
+from datetime import datetime
+from fractions import Fraction
+from urllib.parse import quote
+
+from flask import current_app
+from sqlalchemy import func
+
+from server import changes, records
+from server.models import db, Run, RunTrack
+from server.partitioning import time_range_filter
+
+# Columns of the archive files, in the order of the run table.
+COLUMNS = [column.name for column in Run.__table__.columns]
+# Aggregates of the weekly summary, kept as (sum, count) pairs so that live and archived runs add up exactly.
+TOTALS = ('distance', 'duration', 'speed')
+
+
+def _arrow():
+    # pyarrow is only needed once an archive directory is configured.
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+    return pyarrow
+
+
+def _schema(pa):
+    timestamp = pa.timestamp('us')
+    types = {'id': pa.int64(), 'created_at': timestamp, 'updated_at': timestamp, 'start_time': timestamp,
+             'end_time': timestamp, 'distance': pa.int64(), 'duration': pa.int64()}
+    return pa.schema([(name, types.get(name, pa.string())) for name in COLUMNS])
+
+
+class RunArchive:
+    """
+    Runs moved out of the run table, stored under <directory>/<user id>/<year>.arrow
+    sorted by start_time. Files are replaced atomically and read through memory maps.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _user_dir(self, user_id):
+        return os.path.join(self.directory, quote(user_id, safe=''))
+
+    def path(self, user_id, year):
+        return os.path.join(self._user_dir(user_id), '{}.arrow'.format(year))
+
+    def years(self, user_id):
+        try:
+            names = os.listdir(self._user_dir(user_id))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-len('.arrow')]) for name in names if name.endswith('.arrow'))
+
+    def archived_until(self, user_id):
+        """
+        Start of the year after the newest archived run of the user, None without archived runs.
+        """
+        years = self.years(user_id)
+        return datetime(years[-1] + 1, 1, 1) if years else None
+
+    def read_year(self, user_id, year):
+        pa = _arrow()
+        with pa.memory_map(self.path(user_id, year)) as source:
+            table = pa.ipc.open_file(source).read_all()
+        # Files written before a column was added to the run table get it as nulls.
+        for field in _schema(pa):
+            if field.name not in table.column_names:
+                table = table.append_column(field, pa.nulls(table.num_rows, field.type))
+        return table.select(COLUMNS)
+
+    def write_year(self, user_id, year, table):
+        """
+        Merges the runs into the file of the year, runs archived before are
+        replaced by their new version.
+        """
+        pa = _arrow()
+        path = self.path(user_id, year)
+        if os.path.exists(path):
+            existing = self.read_year(user_id, year)
+            kept = existing.filter(pa.compute.invert(pa.compute.is_in(existing['id'], value_set=table['id'])))
+            table = pa.concat_tables([kept, table])
+        table = table.sort_by([('start_time', 'ascending'), ('id', 'ascending')])
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + '.tmp'
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+        with pa.OSFile(temporary, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table, max_chunksize=65536)
+        with open(temporary, 'rb') as written:
+            os.fsync(written.fileno())
+        os.replace(temporary, path)
+
+    def remove_user(self, user_id):
+        shutil.rmtree(self._user_dir(user_id), ignore_errors=True)
+
+    def scan(self, user_id, since=None, until=None, exclude_ids=()):
+        """
+        Yields the archived runs of the user with start_time in [since, until)
+        as filtered tables, one per year, skipping the years outside of the range
+        and the runs whose id is in `exclude_ids`.
+        """
+        pa = _arrow()
+        pc = pa.compute
+        exclude = pa.array(list(exclude_ids), pa.int64())
+        for year in self.years(user_id):
+            if (since is not None and year < since.year) or (until is not None and datetime(year, 1, 1) >= until):
+                continue
+            table = self.read_year(user_id, year)
+            mask = pc.invert(pc.is_in(table['id'], value_set=exclude))
+            if since is not None:
+                mask = pc.and_(mask, pc.greater_equal(table['start_time'], pa.scalar(since, pa.timestamp('us'))))
+            if until is not None:
+                mask = pc.and_(mask, pc.less(table['start_time'], pa.scalar(until, pa.timestamp('us'))))
+            yield table.filter(mask)
+
+    def weekly_totals(self, user_id, since=None, until=None, exclude_ids=()):
+        """
+        Returns {(year, week): {aggregate: [sum, count]}} like weekly_totals_query.
+        The week is the ISO week and the year the calendar year of start_time, as
+        date_part() computes them.
+        """
+        pa = _arrow()
+        pc = pa.compute
+        totals = {}
+        for table in self.scan(user_id, since, until, exclude_ids):
+            if not table.num_rows:
+                continue
+            # Postgres truncates the integer division, a zero duration has no speed.
+            duration = pc.if_else(pc.equal(table['duration'], 0), pa.scalar(None, pa.int64()), table['duration'])
+            grouped = pa.table({
+                'year': pc.year(table['start_time']),
+                'week': pc.iso_week(table['start_time']),
+                'distance': table['distance'],
+                'duration': table['duration'],
+                'speed': pc.divide(table['distance'], duration),
+            }).group_by(['year', 'week']).aggregate(
+                [(name, aggregate) for name in TOTALS for aggregate in ('sum', 'count')])
+            for row in grouped.to_pylist():
+                add_totals(totals, (row['year'], row['week']),
+                           {name: [row[name + '_sum'] or 0, row[name + '_count']] for name in TOTALS})
+        return totals
+
+    def rows(self, user_id, exclude_ids=()):
+        """
+        Yields the archived runs of the user as dicts, ordered by start_time and id.
+        """
+        for table in self.scan(user_id, exclude_ids=exclude_ids):
+            for batch in table.to_batches():
+                yield from batch.to_pylist()
+
+
+def get_archive():
+    """
+    The configured run archive, None when archiving is disabled.
+    """
+    directory = current_app.config.get('RUNS_ARCHIVE_DIR')
+    return RunArchive(directory) if directory else None
+
+
+def add_totals(totals, key, values):
+    current = totals.setdefault(key, {name: [0, 0] for name in TOTALS})
+    for name, (total, count) in values.items():
+        current[name][0] += total
+        current[name][1] += count
+
+
+def weekly_totals_query(user_id, since=None, until=None):
+    """
+    Sums and counts of the live runs of a user per week, the building blocks of the weekly averages.
+    """
+    week_number = func.date_part('week', Run.start_time)
+    year = func.date_part('year', Run.start_time)
+    speed = Run.distance / Run.duration
+    query = db.session.query(
+        year, week_number,
+        func.sum(Run.distance), func.count(Run.distance),
+        func.sum(Run.duration), func.count(Run.duration),
+        func.sum(speed), func.count(speed)
+    ).filter(Run.user_id == user_id)
+    return time_range_filter(query, since, until).group_by(year, week_number)
+
+
+def weekly_report(user_id, archive, since=None, until=None):
+    """
+    Weekly averages over the live and the archived runs of a user, latest week
+    first. Only the live runs are read when `archive` is None.
+    """
+    totals = {}
+    for year, week, *sums in weekly_totals_query(user_id, since, until):
+        add_totals(totals, (int(year), int(week)),
+                   {name: [int(sums[2 * index] or 0), sums[2 * index + 1]] for index, name in enumerate(TOTALS)})
+    if archive is not None:
+        archived_totals = archive.weekly_totals(user_id, since, until, live_archived_ids(user_id, archive))
+        for key, values in archived_totals.items():
+            add_totals(totals, key, values)
+
+    report = []
+    for (year, week), values in sorted(totals.items(), reverse=True):
+        averages = {name: float(Fraction(total, count)) if count else None for name, (total, count) in values.items()}
+        report.append({'year': year, 'week_number': week, 'average_distance': averages['distance'],
+                       'average_duration': averages['duration'], 'average_speed': averages['speed']})
+    return report
+
+
+def live_archived_ids(user_id, archive):
+    """
+    Ids of live runs within the archived years of a user. They are normally
+    none, except for runs added since the archiving or left over by an
+    interrupted archiving, and take precedence over their archived copy.
+    """
+    archived_until = archive.archived_until(user_id)
+    if archived_until is None:
+        return []
+    return [run_id for run_id, in db.session.query(Run.id).filter(
+        Run.user_id == user_id, Run.start_time < archived_until)]
+
+
+def iter_runs(user_id):
+    """
+    Yields the runs of a user as dicts ordered by start_time and id, merging
+    the archived runs when archiving is enabled.
+    """
+    columns = Run.__table__.columns
+    live = db.session.execute(
+        Run.__table__.select().where(columns.user_id == user_id).order_by(columns.start_time, columns.id)
+        .execution_options(stream_results=True))
+    live_rows = (dict(row) for row in live)
+    archive = get_archive()
+    if archive is None or not archive.years(user_id):
+        return live_rows
+    return heapq.merge(live_rows, archive.rows(user_id, live_archived_ids(user_id, archive)),
+                       key=lambda row: (row['start_time'], row['id']))
+
+
+def archive_runs(cutoff, batch_size=5000):
+    """
+    Moves the runs which started before the cutoff into the archive, user by
+    user and year by year. The file of a year is written before its runs are
+    deleted, so an interrupted run leaves both copies and readers prefer the
+    live one. The tracks of the runs are deleted with them, the deletions are
+    logged in the change feed and the records of the user are recomputed
+    without the archived runs. Returns (users, runs) archived.
+    """
+    archive = get_archive()
+    if archive is None:
+        raise RuntimeError('RUNS_ARCHIVE_DIR is not configured')
+    pa = _arrow()
+    schema = _schema(pa)
+    table = Run.__table__
+    user_ids = [user_id for user_id, in db.session.query(Run.user_id).filter(
+        Run.start_time < cutoff).distinct().order_by(Run.user_id)]
+    archived = 0
+    for user_id in user_ids:
+        first = db.session.query(func.min(Run.start_time)).filter(
+            Run.user_id == user_id, Run.start_time < cutoff).scalar()
+        # One year of runs of the user in memory at a time, the unit of the archive files.
+        for year in range(first.year, cutoff.year + 1):
+            rows = db.session.execute(table.select().where(
+                (table.c.user_id == user_id) & (table.c.start_time >= datetime(year, 1, 1))
+                & (table.c.start_time < min(cutoff, datetime(year + 1, 1, 1)))
+            ).order_by(table.c.start_time)).fetchall()
+            if not rows:
+                continue
+            archive.write_year(user_id, year, pa.Table.from_pylist([dict(row) for row in rows], schema=schema))
+            run_ids = [row.id for row in rows]
+            del rows
+            for offset in range(0, len(run_ids), batch_size):
+                batch = run_ids[offset:offset + batch_size]
+                RunTrack.query.filter(RunTrack.run_id.in_(batch)).delete(synchronize_session=False)
+                Run.query.filter(Run.id.in_(batch)).delete(synchronize_session=False)
+                changes.log_updated([(run_id, user_id) for run_id in batch], deleted=True)
+                db.session.commit()
+            archived += len(run_ids)
+        records.recompute(user_id)
+        db.session.commit()
+    return len(user_ids), archived
@@ -0,0 +1,139 @@
+###
+# Change log of runs, the source of the delta sync of GET /runs/changes.
+###
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import and_, event, exists, inspect, literal, select
+from sqlalchemy.orm import aliased, undefer
+
+from server.models import db, Run, RunChange, RunChangeCompaction, User
+from server.utils.shards import main_connection
+
+MAX_LIMIT = 1000
+
+
+class ExpiredToken(Exception):
+    pass
+
+
+def _log(connection, user_id, run_id, deleted=False):
+    if user_id is None:
+        return
+    # The user row stays locked until commit, so that the changes of a user get
+    # their sequence numbers in commit order and a client never skips one.
+    users = User.__table__
+    connection.execute(select([users.c.id]).where(users.c.id == user_id).with_for_update(key_share=True))
+    connection.execute(RunChange.__table__.insert().values(run_id=run_id, user_id=user_id, deleted=deleted))
+
+
+@event.listens_for(Run, 'after_insert')
+def run_inserted(mapper, connection, target):
+    _log(main_connection(target, connection), target.user_id, target.id)
+
+
+@event.listens_for(Run, 'after_update')
+def run_updated(mapper, connection, target):
+    connection = main_connection(target, connection)
+    previous = inspect(target).attrs.user_id.history.deleted
+    if previous and previous[0] != target.user_id:
+        # Moved to another user, gone from the feed of the previous one.
+        _log(connection, previous[0], target.id, deleted=True)
+    _log(connection, target.user_id, target.id)
+
+
+@event.listens_for(Run, 'after_delete')
+def run_deleted(mapper, connection, target):
+    _log(main_connection(target, connection), target.user_id, target.id, deleted=True)
+
+
+def log_updated(runs, deleted=False):
+    """
+    Logs the changes of runs updated, or `deleted`, without the ORM, `runs`
+    being (run id, user id) pairs.
+    """
+    connection = db.session.connection()
+    for run_id, user_id in runs:
+        _log(connection, user_id, run_id, deleted)
+
+
+def horizon():
+    """
+    Sequence up to which tombstones were compacted away.
+    """
+    return db.session.query(db.func.max(RunChangeCompaction.horizon)).scalar() or 0
+
+
+def changes_since(user_id, since, limit=MAX_LIMIT):
+    """
+    Changes of the runs of a user after the sequence `since`, oldest first.
+    Returns (runs, deleted run ids, next token, whether more changes follow).
+    Raises ExpiredToken when tombstones after `since` were compacted, the
+    client must then sync again from 0.
+    """
+    if 0 < since < horizon():
+        raise ExpiredToken("The sync token has expired, sync again from 0")
+    entries = db.session.query(RunChange.id, RunChange.run_id, RunChange.deleted).filter(
+        RunChange.user_id == user_id, RunChange.id > since).order_by(RunChange.id).limit(limit + 1).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    latest = OrderedDict()
+    for _, run_id, deleted in entries:
+        latest.pop(run_id, None)
+        latest[run_id] = deleted
+    live_ids = [run_id for run_id, deleted in latest.items() if not deleted]
+    runs = {}
+    if live_ids:
+        runs = {run.id: run for run in Run.query.options(undefer(Run.weather_info)).filter(
+            Run.id.in_(live_ids), Run.user_id == user_id)}
+    # A run missing despite a live entry was deleted or archived after it, its tombstone comes later.
+    deleted_ids = [run_id for run_id in latest if run_id not in runs]
+    return [runs[run_id] for run_id in live_ids if run_id in runs], deleted_ids, \
+        entries[-1][0] if entries else since, has_more
+
+
+def compact(tombstone_retention):
+    """
+    Deletes the entries superseded by a later change of the same run, and the
+    tombstones older than `tombstone_retention` (a timedelta). Returns the
+    number of deleted entries of both kinds.
+    """
+    later = aliased(RunChange)
+    superseded = RunChange.query.filter(exists().where(and_(
+        later.run_id == RunChange.run_id, later.user_id == RunChange.user_id, later.id > RunChange.id
+    ))).delete(synchronize_session=False)
+    db.session.commit()
+
+    cutoff = datetime.utcnow() - tombstone_retention
+    last = db.session.query(db.func.max(RunChange.id)).filter(
+        RunChange.deleted.is_(True), RunChange.created_at < cutoff).scalar()
+    tombstones = 0
+    if last is not None:
+        tombstones = RunChange.query.filter(RunChange.deleted.is_(True), RunChange.id <= last).delete(
+            synchronize_session=False)
+        db.session.add(RunChangeCompaction(horizon=last, removed=tombstones))
+        db.session.commit()
+    return superseded, tombstones
+
+
+def backfill(batch_size=50000):
+    """
+    Logs a change for the runs created before the change log, in id order and
+    one transaction per batch. Returns the number of logged runs.
+    """
+    runs, changes = Run.__table__, RunChange.__table__
+    logged, last_id = 0, 0
+    now = datetime.utcnow()
+    while True:
+        ids = [run_id for run_id, in db.session.query(Run.id).filter(Run.id > last_id).order_by(Run.id).limit(
+            batch_size)]
+        if not ids:
+            return logged
+        missing = select([runs.c.id, runs.c.user_id, literal(False), literal(now), literal(now)]).where(and_(
+            runs.c.id >= ids[0], runs.c.id <= ids[-1], runs.c.user_id.isnot(None),
+            ~exists().where(changes.c.run_id == runs.c.id))).order_by(runs.c.id)
+        result = db.session.execute(changes.insert().from_select(
+            ['run_id', 'user_id', 'deleted', 'created_at', 'updated_at'], missing))
+        db.session.commit()
+        logged += result.rowcount
+        last_id = ids[-1]
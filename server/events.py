@@ -0,0 +1,249 @@
+###
+# Push of weekly summary updates. Run changes are published per user and week,
+# through PostgreSQL NOTIFY so that every worker sees them, in process otherwise.
+###
+import json
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import object_session, Session
+
+from server.archive import get_archive, weekly_report
+from server.models import db, Run
+from server.utils.shards import main_connection
+
+CHANNEL = 'run_summary'
+# Returned by Subscription.wait when more weeks changed than it keeps.
+RESYNC = 'resync'
+_PENDING = 'summary_events'
+
+
+def week_of(start_time):
+    """
+    Key of the summary row of a run, as date_part('year') and date_part('week').
+    """
+    return start_time.year, start_time.isocalendar()[1]
+
+
+def week_ranges(year, week):
+    """
+    The [since, until) ranges of the runs of a summary row: the ISO weeks with
+    that number clipped to the calendar year, which are two at the turn of the year.
+    """
+    first, last = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    ranges = []
+    for iso_year in (year - 1, year, year + 1):
+        monday = datetime.strptime('{}-W{}-1'.format(iso_year, week), '%G-W%V-%u')
+        if monday.isocalendar()[:2] != (iso_year, week):
+            continue
+        since, until = max(first, monday), min(last, monday + timedelta(days=7))
+        if since < until:
+            ranges.append((since, until))
+    return ranges
+
+
+def week_summary(user_id, week):
+    """
+    The summary row of a week, with None averages when it has no runs anymore.
+    """
+    ranges = week_ranges(*week)
+    report = weekly_report(user_id, get_archive(), min(since for since, _ in ranges),
+                           max(until for _, until in ranges))
+    for row in report:
+        if (row['year'], row['week_number']) == week:
+            return row
+    return {'year': week[0], 'week_number': week[1], 'average_distance': None,
+            'average_duration': None, 'average_speed': None}
+
+
+class Subscription:
+    """
+    The weeks of a user changed since the last wait, coalesced and bounded by
+    `max_pending`: beyond it only a resync is kept.
+    """
+
+    def __init__(self, user_id, max_pending):
+        self.user_id = user_id
+        self.max_pending = max_pending
+        self._weeks = set()
+        self._overflowed = False
+        self._changed = threading.Event()
+        self._lock = threading.Lock()
+
+    def notify(self, week):
+        with self._lock:
+            if week is RESYNC or len(self._weeks) >= self.max_pending and week not in self._weeks:
+                self._overflowed = True
+                self._weeks.clear()
+            elif not self._overflowed:
+                self._weeks.add(week)
+            self._changed.set()
+
+    def wait(self, timeout):
+        """
+        The changed weeks, RESYNC after an overflow or None when nothing changed within `timeout` seconds.
+        """
+        if not self._changed.wait(timeout):
+            return None
+        with self._lock:
+            weeks = RESYNC if self._overflowed else self._weeks
+            self._weeks, self._overflowed = set(), False
+            self._changed.clear()
+        return weeks
+
+
+class SummaryBroker:
+    """
+    Subscriptions of the open event streams of the process, by user.
+    """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def subscribe(self, user_id, max_pending):
+        subscription = Subscription(user_id, max_pending)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def publish(self, user_id, week):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.notify(week)
+
+    def publish_all(self, week):
+        with self._lock:
+            subscriptions = [subscription for user in self._subscriptions.values() for subscription in user]
+        for subscription in subscriptions:
+            subscription.notify(week)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def ensure_listening(self, app):
+        """
+        Starts the thread receiving the notifications of the other workers, once per process.
+        """
+        with self._lock:
+            if self._listener is not None or db.get_engine(app).dialect.name != 'postgresql':
+                return
+            self._listener = threading.Thread(target=self._listen, args=(app,), name='summary-events', daemon=True)
+        self._listener.start()
+
+    def _listen(self, app):
+        reconnecting = False
+        while True:
+            connection = None
+            try:
+                with app.app_context():
+                    # Kept out of the pool, it's held for the lifetime of the process.
+                    connection = db.engine.raw_connection()
+                    connection.detach()
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute('LISTEN ' + CHANNEL)
+                if reconnecting:
+                    # Notifications sent while disconnected are lost.
+                    self.publish_all(RESYNC)
+                reconnecting = True
+                while True:
+                    if select.select([dbapi_connection], [], [], 60) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        user_id, year, week = json.loads(dbapi_connection.notifies.pop(0).payload)
+                        self.publish(user_id, (year, week))
+            except Exception:
+                app.logger.exception("Summary events listener failed, reconnecting")
+                time.sleep(1)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+
+broker = SummaryBroker()
+
+
+def _changed_weeks(target):
+    state = inspect(target)
+    users = {target.user_id, *state.attrs.user_id.history.deleted}
+    weeks = {week_of(start_time) for start_time in (target.start_time, *state.attrs.start_time.history.deleted)
+             if start_time is not None}
+    return {(user_id, week) for user_id in users if user_id is not None for week in weeks}
+
+
+@event.listens_for(Run, 'after_insert')
+@event.listens_for(Run, 'after_update')
+@event.listens_for(Run, 'after_delete')
+def run_changed(mapper, connection, target):
+    changes = _changed_weeks(target)
+    # Listeners are connected to the main database, whichever shard the run is in.
+    connection = main_connection(target, connection)
+    if connection.dialect.name == 'postgresql':
+        # Delivered to the listeners on commit, dropped on rollback.
+        for user_id, (year, week) in changes:
+            connection.execute(func.pg_notify(CHANNEL, json.dumps([user_id, year, week])).select())
+    else:
+        object_session(target).info.setdefault(_PENDING, set()).update(changes)
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_pending(session):
+    for user_id, week in session.info.pop(_PENDING, ()):
+        broker.publish(user_id, week)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_pending(session):
+    session.info.pop(_PENDING, None)
+
+
+def _format(name, data):
+    return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data))
+
+
+def summary_stream(user_id, expires_at=None):
+    """
+    Server-sent events of the weekly summary rows of a user as they change,
+    until `expires_at` (unix time, the expiry of the access token). No database
+    connection is held while waiting.
+    """
+    config = current_app.config
+    broker.ensure_listening(current_app._get_current_object())
+    subscription = broker.subscribe(user_id, config['SUMMARY_EVENTS_MAX_PENDING'])
+    try:
+        yield 'retry: {}\n\n'.format(config['SUMMARY_EVENTS_RETRY_MS'])
+        while True:
+            timeout = config['SUMMARY_EVENTS_HEARTBEAT']
+            if expires_at is not None:
+                timeout = min(timeout, expires_at - time.time())
+                if timeout <= 0:
+                    yield _format('expired', {})
+                    return
+            weeks = subscription.wait(timeout)
+            if weeks is None:
+                # Keeps proxies from closing the connection, and finds disconnected clients.
+                yield ': keepalive\n\n'
+            elif weeks is RESYNC:
+                yield _format('resync', {})
+            else:
+                for week in sorted(weeks):
+                    yield _format('summary', week_summary(user_id, week))
+                db.session.remove()
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,127 @@
+###
+# Group commit of run inserts (RUNS_GROUP_COMMIT_WINDOW_MS): the POST /runs
+# requests of a worker hand their run to a committer thread, which inserts the
+# runs arriving within the window in one transaction.
+###
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+
+from server.models import db, Run
+from server.utils.transactions import in_single_transaction, single_transaction
+
+
+def enabled():
+    return current_app.config.get('RUNS_GROUP_COMMIT_WINDOW_MS', 0) > 0 and not in_single_transaction()
+
+
+def _insert(data):
+    """
+    Adds a run, whose records are updated on commit, returns the column values of the run.
+    """
+    values = {key: value for key, value in data.items() if key != 'user'}
+    run = Run(user_id=data['user'], **values)
+    db.session.add(run)
+    db.session.flush()
+    return {column.key: getattr(run, column.key) for column in Run.__table__.columns}
+
+
+class GroupCommitter:
+    """
+    Thread of a worker process committing the runs submitted by its requests
+    in groups. A request waits for the commit of its group, so a run is only
+    acknowledged once it's durable, like with a commit of its own.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def _ensure_started(self, app):
+        # Threads don't survive the fork of the gunicorn workers, each one starts its own,
+        # and a thread which died is replaced.
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, args=(app, self._queue), daemon=True,
+                                                name='run-group-commit')
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def insert(self, data):
+        """
+        Inserts a run from the data loaded by RunSchema, together with the runs
+        of concurrent requests. Returns the run, added to the session of the
+        request as persistent, or raises the error of its insert, or
+        concurrent.futures.TimeoutError when its group doesn't start within the
+        window and RUNS_GROUP_COMMIT_TIMEOUT. The run is then withdrawn, so that
+        a retry of the request doesn't insert it twice.
+        """
+        app = current_app._get_current_object()
+        self._ensure_started(app)
+        future = Future()
+        self._queue.put((data, future))
+        config = app.config
+        try:
+            result = future.result(
+                timeout=config['RUNS_GROUP_COMMIT_WINDOW_MS'] / 1000.0 + config['RUNS_GROUP_COMMIT_TIMEOUT'])
+        except TimeoutError:
+            if future.cancel():
+                raise
+            # Its group is being committed already, the thread settles it whatever happens.
+            result = future.result()
+        run = Run(**result)
+        make_transient_to_detached(run)
+        db.session.add(run)
+        return run
+
+    def _run(self, app, pending):
+        while True:
+            batch = [pending.get()]
+            window = app.config['RUNS_GROUP_COMMIT_WINDOW_MS'] / 1000.0
+            deadline = time.monotonic() + window
+            while len(batch) < app.config['RUNS_GROUP_COMMIT_MAX_SIZE']:
+                try:
+                    batch.append(pending.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            # The runs of requests which timed out are skipped.
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            with app.app_context():
+                try:
+                    self._commit(batch)
+                except Exception as e:
+                    app.logger.exception("Group commit of %s runs failed", len(batch))
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                finally:
+                    db.session.remove()
+
+    @staticmethod
+    def _commit(batch):
+        try:
+            with single_transaction():
+                results = [_insert(data) for data, _ in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # One failing run would fail the whole group, the others are committed on their own.
+            for item in batch:
+                GroupCommitter._commit([item])
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+committer = GroupCommitter()
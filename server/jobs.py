@@ -0,0 +1,234 @@
+###
+# Job queue in the job table, run by `manage.py worker`: workers claim due jobs
+# with SELECT ... FOR UPDATE SKIP LOCKED, highest priority first, and retry
+# failed ones with exponential backoff.
+###
+import json
+import random
+import threading
+import time
+import traceback
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, func, or_
+
+from server.models import db, Job
+
+# Registered tasks by name.
+TASKS = {}
+
+Claimed = namedtuple('Claimed', 'id name args attempts max_attempts run_at started_at')
+
+
+def task(fn):
+    """
+    Registers a function as a task which can be enqueued by its name.
+    """
+    if TASKS.get(fn.__name__, fn) is not fn:
+        raise ValueError('A task named {} is registered already'.format(fn.__name__))
+    TASKS[fn.__name__] = fn
+    return fn
+
+
+def enqueue(fn, *args, priority=0, delay=0, max_attempts=None):
+    """
+    Queues a call of a task, `fn` being the task or its name, with JSON
+    serializable arguments. Commits the session. Returns the Job.
+    """
+    name = fn if isinstance(fn, str) else fn.__name__
+    if TASKS.get(name) is None or not isinstance(fn, str) and TASKS[name] is not fn:
+        raise ValueError('{} is not a registered task'.format(name))
+    return Job(name=name, args=json.dumps(args), priority=priority,
+               run_at=datetime.utcnow() + timedelta(seconds=delay),
+               max_attempts=max_attempts or current_app.config['JOBS_MAX_ATTEMPTS']).save()
+
+
+def claim(now=None):
+    """
+    Takes the next due job: queued and due, or running with an expired lease
+    (its worker died). Running jobs with an expired lease and no attempt left
+    fail. Returns a Claimed, or None when no job is due. SKIP LOCKED lets
+    concurrent workers pass the rows others are claiming; the update on the
+    attempts also keeps databases without row locks from handing a job out twice.
+    """
+    now = now or datetime.utcnow()
+    expired = and_(Job.status == 'running', Job.lease_until < now)
+    Job.query.filter(expired, Job.attempts >= Job.max_attempts).update(
+        {'status': 'failed', 'finished_at': now, 'last_error': 'Lease expired, the worker running the job died'},
+        synchronize_session=False)
+    db.session.commit()
+    while True:
+        job = Job.query.filter(or_(and_(Job.status == 'queued', Job.run_at <= now), expired)).order_by(
+            Job.priority.desc(), Job.run_at, Job.id).with_for_update(skip_locked=True).first()
+        if job is None:
+            db.session.rollback()
+            return None
+        claimed = Claimed(job.id, job.name, job.args, job.attempts + 1, job.max_attempts, job.run_at, now)
+        taken = Job.query.filter(Job.id == job.id, Job.attempts == job.attempts).update(
+            {'status': 'running', 'attempts': claimed.attempts, 'started_at': now,
+             'lease_until': now + timedelta(seconds=current_app.config['JOBS_LEASE_SECONDS'])},
+            synchronize_session=False)
+        db.session.commit()
+        if taken:
+            return claimed
+
+
+def _renew_lease(app, job, stopped):
+    """
+    Extends the lease of a running job every third of JOBS_LEASE_SECONDS until
+    `stopped` is set, in transactions of its own.
+    """
+    lease = app.config['JOBS_LEASE_SECONDS']
+    table = Job.__table__
+    while not stopped.wait(lease / 3):
+        try:
+            with app.app_context(), db.engine.begin() as connection:
+                connection.execute(table.update().where(and_(
+                    table.c.id == job.id, table.c.status == 'running', table.c.attempts == job.attempts)).values(
+                    lease_until=datetime.utcnow() + timedelta(seconds=lease)))
+        except Exception:
+            app.logger.exception("Renewal of the lease of job %s failed", job.id)
+
+
+def backoff(attempts):
+    """
+    Seconds before the retry of a job which failed `attempts` times, doubling
+    from JOBS_RETRY_BACKOFF up to JOBS_RETRY_BACKOFF_MAX, with jitter so that
+    jobs failing together don't retry together.
+    """
+    config = current_app.config
+    delay = min(config['JOBS_RETRY_BACKOFF_MAX'], config['JOBS_RETRY_BACKOFF'] * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def _claimed(job):
+    """
+    The row of a claimed job, as long as this attempt holds it.
+    """
+    return Job.query.filter(Job.id == job.id, Job.attempts == job.attempts, Job.status == 'running')
+
+
+def execute(job):
+    """
+    Runs a claimed job and records its outcome, unless the job was claimed
+    again meanwhile (its lease expired). Returns whether it succeeded.
+    """
+    started = time.monotonic()
+    stopped = threading.Event()
+    threading.Thread(target=_renew_lease, args=(current_app._get_current_object(), job, stopped), daemon=True,
+                     name='job-lease-{}'.format(job.id)).start()
+    try:
+        fn = TASKS.get(job.name)
+        if fn is None:
+            raise LookupError('{} is not a registered task'.format(job.name))
+        fn(*json.loads(job.args))
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        now = datetime.utcnow()
+        if job.attempts < job.max_attempts:
+            values = {'status': 'queued', 'run_at': now + timedelta(seconds=backoff(job.attempts))}
+        else:
+            values = {'status': 'failed', 'finished_at': now}
+        _claimed(job).update(dict(values, last_error=error), synchronize_session=False)
+        db.session.commit()
+        current_app.logger.warning("Job %s %s failed (attempt %s of %s): %s", job.id, job.name, job.attempts,
+                                   job.max_attempts, error.strip().splitlines()[-1])
+        return False
+    finally:
+        stopped.set()
+    _claimed(job).update({'status': 'done', 'finished_at': datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    current_app.logger.info("Job %s %s done, waited %.1fs, ran %.1fs", job.id, job.name,
+                            (job.started_at - job.run_at).total_seconds(), time.monotonic() - started)
+    return True
+
+
+class Worker:
+    """
+    `concurrency` threads running jobs until stop() is called, or until no
+    job is due with `burst`.
+    """
+
+    def __init__(self, app, concurrency=1, burst=False):
+        self.app = app
+        self.concurrency = concurrency
+        self.burst = burst
+        self.stopping = threading.Event()
+
+    def stop(self):
+        """
+        Lets the threads finish their current job and exit.
+        """
+        self.stopping.set()
+
+    def run(self):
+        threads = [threading.Thread(target=self._loop, name='job-worker-{}'.format(index))
+                   for index in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # A timeout keeps the main thread responsive to signals.
+            while thread.is_alive():
+                thread.join(1)
+
+    def _loop(self):
+        with self.app.app_context():
+            poll_interval = self.app.config['JOBS_POLL_INTERVAL']
+            while not self.stopping.is_set():
+                try:
+                    job = claim()
+                    if job is not None:
+                        execute(job)
+                except Exception:
+                    self.app.logger.exception("Job worker failed, retrying")
+                    db.session.rollback()
+                    job = None
+                finally:
+                    db.session.remove()
+                if job is None:
+                    if self.burst:
+                        return
+                    self.stopping.wait(poll_interval)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def metrics(window=timedelta(hours=1), now=None):
+    """
+    Queue depth and latency: the number of jobs by status, the due jobs by
+    priority and the age of the oldest, and the median and 95th percentile of
+    the wait (from due to start) and run times of the jobs finished within `window`.
+    """
+    now = now or datetime.utcnow()
+    due = and_(Job.status == 'queued', Job.run_at <= now)
+    oldest = db.session.query(func.min(Job.run_at)).filter(due).scalar()
+    finished = db.session.query(Job.run_at, Job.started_at, Job.finished_at).filter(
+        Job.status == 'done', Job.finished_at >= now - window).all()
+    waits = [(started_at - run_at).total_seconds() for run_at, started_at, _ in finished]
+    runs = [(finished_at - started_at).total_seconds() for _, started_at, finished_at in finished]
+    return {
+        'status': dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status)),
+        'due': dict(db.session.query(Job.priority, func.count(Job.id)).filter(due).group_by(Job.priority)),
+        'oldest_due_seconds': (now - oldest).total_seconds() if oldest else 0,
+        'finished': len(finished),
+        'wait_seconds': {'p50': _percentile(waits, 0.5), 'p95': _percentile(waits, 0.95)},
+        'run_seconds': {'p50': _percentile(runs, 0.5), 'p95': _percentile(runs, 0.95)},
+    }
+
+
+@task
+def purge_jobs(days=None):
+    """
+    Deletes the jobs which finished more than `days` (JOBS_RETENTION_DAYS) days ago.
+    """
+    days = current_app.config['JOBS_RETENTION_DAYS'] if days is None else days
+    deleted = Job.query.filter(Job.finished_at < datetime.utcnow() - timedelta(days=days)).delete(
+        synchronize_session=False)
+    db.session.commit()
+    return deleted
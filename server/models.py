@@ -2,15 +2,20 @@
 # DB configurations and models
 ###
 import os
+import threading
+import time
 from datetime import datetime
 
+from flask import current_app
 from flask_bcrypt import Bcrypt
 from flask_security import SQLAlchemyUserDatastore, RoleMixin, UserMixin, Security
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+
+from server.utils.shards import ShardAwareQuery, ShardingSQLAlchemy
 
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = ShardingSQLAlchemy(query_class=ShardAwareQuery)
 
 # Define models
 roles_users = db.Table(
@@ -47,6 +52,72 @@ class Role(db.Model, BaseMixin, RoleMixin):
         return self.name
 
 
+class RoleRegistry(object):
+    """
+    Process-wide cache of the roles table. Roles change almost never, the
+    registry is reloaded after role writes in this process and after
+    ROLES_REGISTRY_TTL seconds to pick up writes from other processes.
+    """
+
+    def __init__(self):
+        self._roles = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        rows = db.session.query(Role.id, Role.name, Role.privileged).all()
+        with self._lock:
+            self._roles = {name: (role_id, bool(privileged)) for role_id, name, privileged in rows}
+            self._loaded_at = time.monotonic()
+        return self._roles
+
+    def invalidate(self):
+        with self._lock:
+            self._roles = None
+
+    def _get_roles(self):
+        roles = self._roles
+        ttl = current_app.config.get('ROLES_REGISTRY_TTL', 300)
+        if roles is None or time.monotonic() - self._loaded_at > ttl:
+            roles = self.load()
+        return roles
+
+    def names(self):
+        return frozenset(self._get_roles())
+
+    def privileged_names(self):
+        return frozenset(name for name, (_, privileged) in self._get_roles().items() if privileged)
+
+    def role_ids(self, names):
+        """
+        Returns the ids of the given role names, raises KeyError with the unknown names.
+        """
+        roles = self._get_roles()
+        unknown = [name for name in names if name not in roles]
+        if unknown:
+            raise KeyError(unknown)
+        return [roles[name][0] for name in names]
+
+    def resolve(self, names):
+        """
+        Returns the Role rows of the given names in one query, in the same order.
+        Raises KeyError with the unknown names.
+        """
+        ids = self.role_ids(names)
+        rows = {role.id: role for role in Role.query.filter(Role.id.in_(ids)).all()} if ids else {}
+        return [rows[role_id] for role_id in ids]
+
+
+roles_registry = RoleRegistry()
+
+
+@event.listens_for(Role, 'after_insert')
+@event.listens_for(Role, 'after_update')
+@event.listens_for(Role, 'after_delete')
+def invalidate_roles_registry(mapper, connection, target):
+    roles_registry.invalidate()
+
+
 class User(db.Model, BaseMixin, UserMixin):
     id = db.Column(db.String(255), primary_key=True)
     first_name = db.Column(db.String(255))
@@ -54,7 +125,9 @@ class User(db.Model, BaseMixin, UserMixin):
     email = db.Column(db.String(255), unique=True)
     password = db.Column(db.String(255), nullable=False)
     active = db.Column(db.Boolean(), default=True)
-    roles = db.relationship('Role', secondary=roles_users,
+    # Set when the user is deleted, the rows are removed by a background job.
+    deleted_at = db.Column(db.DateTime)
+    roles = db.relationship('Role', secondary=roles_users, lazy='joined', order_by='Role.id',
                             backref=db.backref('users', lazy='dynamic'))
 
     def verify_password(self, password):
@@ -68,13 +141,11 @@ class User(db.Model, BaseMixin, UserMixin):
         return bcrypt.generate_password_hash(
             password, os.getenv('BCRYPT_LOG_ROUNDS')).decode('utf-8')
 
+    def role_names(self):
+        return {role.name for role in self.roles}
+
     def is_privileged(self):
-        is_privileged = False
-        for role in self.roles:
-            if role.privileged:
-                is_privileged = True
-                break
-        return is_privileged
+        return not self.role_names().isdisjoint(roles_registry.privileged_names())
 
     def __str__(self):
         return self.id
@@ -82,10 +153,20 @@ class User(db.Model, BaseMixin, UserMixin):
 
 class BlacklistToken(db.Model, BaseMixin):
     token = db.Column(db.String(500), unique=True, nullable=False)
+    # Expiry of the revoked token, entries past it are purged.
+    expires_at = db.Column(db.DateTime, index=True)
 
     def __repr__(self):
         return '<id: token: {}'.format(self.token)
 
+    @staticmethod
+    def from_decoded_token(decoded_token):
+        expires = decoded_token.get('exp')
+        return BlacklistToken(
+            token=decoded_token['jti'],
+            expires_at=datetime.utcfromtimestamp(expires) if expires else None
+        )
+
     @staticmethod
     def check_blacklist(jti):
         # check whether auth token has been blacklisted
@@ -95,6 +176,47 @@ class BlacklistToken(db.Model, BaseMixin):
         else:
             return False
 
+    @staticmethod
+    def purge(watermark=None):
+        """
+        Deletes the entries of expired tokens, and of tokens issued before the
+        revocation watermark. Returns the number of deleted entries.
+        """
+        condition = BlacklistToken.expires_at < datetime.utcnow()
+        if watermark is not None:
+            condition = condition | (BlacklistToken.created_at < datetime.utcfromtimestamp(watermark))
+        deleted = BlacklistToken.query.filter(condition).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class IdempotencyKey(db.Model, BaseMixin):
+    """
+    Outcome of a request made with an Idempotency-Key header, replayed to the
+    retries of the request until it expires. `status` is None while the first
+    request is in progress.
+    """
+    # sha256 of the user, the endpoint and the client key.
+    key = db.Column(db.String(64), unique=True, nullable=False)
+    # sha256 of the request body, a key can't be reused for another request.
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    location = db.Column(db.String(500))
+    # zlib compressed response body.
+    body = db.Column(db.LargeBinary)
+    expires_at = db.Column(db.DateTime, index=True, nullable=False)
+
+    @staticmethod
+    def purge():
+        """
+        Deletes the expired keys. Returns the number of deleted keys.
+        """
+        deleted = IdempotencyKey.query.filter(
+            IdempotencyKey.expires_at < datetime.utcnow()).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
 
 # Setup Flask-Security
 user_datastore = SQLAlchemyUserDatastore(db, User, Role)
@@ -114,6 +236,140 @@ class Run(db.Model, BaseMixin):
     date = db.Column(db.String(11))
     # Duration in seconds
     duration = db.Column(db.Integer)
-    weather_info = db.Column(db.String())
+    # Large and rarely needed in lists, loaded when the fields of a run are dumped in full.
+    weather_info = db.deferred(db.Column(db.String()))
+    # Geohash of the start point, maintained by server.spatial.
+    start_geohash = db.Column(db.String(12), index=True)
+    # Whether the run belongs to the requesting user, loaded with the run by RunDetail.
+    owned = db.query_expression()
 
     user = db.relationship('User', foreign_keys='Run.user_id')
+
+
+class IdBlock(db.Model):
+    """
+    Next free id of a table whose ids the application hands out in blocks,
+    e.g. runs split across shards, see server.sharding.
+    """
+    __tablename__ = 'id_block'
+    name = db.Column(db.String(50), primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
+
+class Job(db.Model, BaseMixin):
+    """
+    Job of the queue run by `manage.py worker`, see server.jobs.
+    """
+    __tablename__ = 'job'
+    # Name of the task, registered with server.jobs.task.
+    name = db.Column(db.String(100), nullable=False)
+    # JSON list of the arguments of the task.
+    args = db.Column(db.Text, nullable=False, default='[]')
+    # Higher runs first.
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    # queued, running, done or failed
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    # Earliest start, pushed back by the retries.
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    started_at = db.Column(db.DateTime)
+    # End of the lease of a running job, renewed by its worker while the task runs.
+    lease_until = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (
+        db.Index('ix_job_due', 'status', 'priority', 'run_at'),
+        db.Index('ix_job_finished_at', 'finished_at'),
+    )
+
+
+class Checkpoint(db.Model, BaseMixin):
+    """
+    Position of a resumable scan over a table by id, e.g. server.weather_backfill.
+    """
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    # Id of the last row processed.
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.Integer, nullable=False, default=0)
+
+
+class UserDeletion(db.Model, BaseMixin):
+    """
+    Progress of the background removal of a deleted user and their runs.
+    """
+    user_id = db.Column(db.String(255), index=True, nullable=False)
+    # pending, running, done or failed
+    status = db.Column(db.String(20), default='pending', nullable=False)
+    runs_total = db.Column(db.Integer)
+    runs_deleted = db.Column(db.Integer, default=0)
+    finished_at = db.Column(db.DateTime)
+
+
+class RunRecords(db.Model, BaseMixin):
+    """
+    Personal bests and latest streak of a user, maintained incrementally by server.records.
+    """
+    __tablename__ = 'run_records'
+    user_id = db.Column(db.String(255), db.ForeignKey('user.id'), unique=True, nullable=False)
+    # Fastest run of at least 5 km, by pace in seconds per km.
+    fastest_5k_run_id = db.Column(db.Integer)
+    fastest_5k_pace = db.Column(db.Float)
+    longest_run_id = db.Column(db.Integer)
+    longest_run_distance = db.Column(db.Integer)
+    # Consecutive days with a run ending on the day of the latest run.
+    streak_start = db.Column(db.Date)
+    streak_end = db.Column(db.Date)
+
+    def to_dict(self, today=None):
+        today = today or datetime.utcnow().date()
+        streak_length = (self.streak_end - self.streak_start).days + 1 if self.streak_end else 0
+        current_streak = streak_length if self.streak_end and (today - self.streak_end).days <= 1 else 0
+        return {
+            'fastest_5k': {'run_id': self.fastest_5k_run_id, 'pace': self.fastest_5k_pace,
+                           'time': self.fastest_5k_pace * 5} if self.fastest_5k_run_id else None,
+            'longest_run': {'run_id': self.longest_run_id,
+                            'distance': self.longest_run_distance} if self.longest_run_id else None,
+            'current_streak': current_streak,
+            'latest_streak': {'start': self.streak_start.isoformat(), 'end': self.streak_end.isoformat(),
+                              'length': streak_length} if self.streak_end else None,
+        }
+
+
+class RunTrack(db.Model, BaseMixin):
+    """
+    GPS track of a run in the binary format of server.tracks.
+    """
+    __tablename__ = 'run_track'
+    # No foreign key, the run table may be partitioned.
+    run_id = db.Column(db.Integer, unique=True, nullable=False)
+    points = db.Column(db.Integer, nullable=False)
+    # Length of the track in meters.
+    distance = db.Column(db.Float, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+
+class RunChange(db.Model, BaseMixin):
+    """
+    Entry of the change log of runs, written by server.changes whenever a run
+    is created, updated or deleted. The id is the sequence the sync tokens refer to.
+    """
+    __tablename__ = 'run_change'
+    __table_args__ = (db.Index('ix_run_change_user_id_id', 'user_id', 'id'),)
+    # No foreign key, the run table may be partitioned.
+    run_id = db.Column(db.Integer, index=True, nullable=False)
+    user_id = db.Column(db.String(255), nullable=False)
+    # Tombstone of a deleted run.
+    deleted = db.Column(db.Boolean, default=False, nullable=False)
+
+
+class RunChangeCompaction(db.Model, BaseMixin):
+    """
+    Compaction of the run change log. Tombstones up to `horizon` were removed,
+    so tokens below it can't be resumed.
+    """
+    __tablename__ = 'run_change_compaction'
+    horizon = db.Column(db.Integer, nullable=False)
+    removed = db.Column(db.Integer, nullable=False)
@@ -0,0 +1,166 @@
+###
+# JSON:API atomic operations (https://jsonapi.org/ext/atomic/) on runs and users,
+# applied in one transaction through the hooks of the resources.
+###
+from flask import request
+from flask_rest_jsonapi import JsonApiException
+from flask_rest_jsonapi.exceptions import BadRequest, ObjectNotFound
+from flask_rest_jsonapi.querystring import QueryStringManager
+from flask_rest_jsonapi.schema import compute_schema
+from marshmallow import ValidationError
+from marshmallow_jsonapi.exceptions import IncorrectTypeError
+
+from server.resources import RunDetail, RunsList, UserDetail, UserList
+from server.utils.transactions import single_transaction
+
+MEDIA_TYPE = 'application/vnd.api+json; ext="https://jsonapi.org/ext/atomic"'
+# List and detail resources, and the type of the ids, by resource type.
+RESOURCES = {
+    'run': (RunsList, RunDetail, int),
+    'user': (UserList, UserDetail, str),
+}
+
+
+class OperationsError(Exception):
+    """
+    JSON:API errors of an operation, which rolled the whole request back.
+    """
+
+    def __init__(self, errors, status):
+        self.errors = errors
+        self.status = status
+
+
+def _prefixed(errors, index):
+    prefix = '/atomic:operations/{}'.format(index)
+    for error in errors:
+        # The source of some errors is a plain description, e.g. of permission checks.
+        source = error.get('source') if isinstance(error.get('source'), dict) else {}
+        error['source'] = dict(source, pointer=prefix + source.get('pointer', ''))
+    return errors
+
+
+def _load(schema, data):
+    try:
+        loaded, errors = schema.load({'data': data})
+    except IncorrectTypeError as e:
+        raise OperationsError([dict(error, status='409', title='Incorrect type')
+                               for error in e.messages['errors']], '409')
+    except ValidationError as e:
+        errors = e.messages
+    if errors:
+        raise OperationsError([dict(error, status='422', title='Validation error')
+                               for error in errors['errors']], '422')
+    return loaded
+
+
+def _resolve(identifier, lids, pointer):
+    """
+    The id of a resource identifier, looking up the `lid` of a resource added earlier in the request.
+    """
+    if 'id' in identifier:
+        return identifier['id']
+    key = (identifier.get('type'), identifier.get('lid'))
+    if key not in lids:
+        raise BadRequest('Unknown lid {!r}'.format(key[1]), source={'pointer': pointer})
+    return lids[key]
+
+
+def _resolve_relationships(data, lids):
+    for name, relationship in (data.get('relationships') or {}).items():
+        linkage = relationship.get('data') if isinstance(relationship, dict) else None
+        for identifier in linkage if isinstance(linkage, list) else [linkage]:
+            if isinstance(identifier, dict) and 'lid' in identifier:
+                identifier['id'] = _resolve(identifier, lids, '/data/relationships/{}'.format(name))
+                del identifier['lid']
+
+
+def _add(list_resource, data, qs, lids):
+    lid = data.pop('lid', None)
+    resource = list_resource()
+    schema = compute_schema(resource.schema, getattr(resource, 'post_schema_kwargs', dict()), qs, qs.include)
+    loaded = _load(schema, data)
+    resource.before_post((), {}, data=loaded)
+    result = schema.dump(resource.create_object(loaded, {})).data
+    if lid is not None:
+        lids[(data['type'], lid)] = str(result['data']['id'])
+    return result
+
+
+def _update(detail_resource, view_kwargs, data, qs):
+    resource = detail_resource()
+    schema_kwargs = dict(getattr(resource, 'patch_schema_kwargs', dict()), partial=True)
+    resource.before_marshmallow((), view_kwargs)
+    schema = compute_schema(resource.schema, schema_kwargs, qs, qs.include)
+    loaded = _load(schema, data)
+    resource.before_patch((), view_kwargs, data=loaded)
+    return schema.dump(resource.update_object(loaded, qs, view_kwargs)).data
+
+
+def _remove(detail_resource, view_kwargs):
+    resource = detail_resource()
+    resource.before_delete((), view_kwargs)
+    resource.delete_object(view_kwargs)
+    return {}
+
+
+def apply(operation, lids):
+    """
+    Applies one operation, returns its result object.
+    """
+    if not isinstance(operation, dict) or operation.get('op') not in ('add', 'update', 'remove'):
+        raise BadRequest('op must be one of add, update or remove', source={'pointer': '/op'})
+    op, ref, data = operation['op'], operation.get('ref'), operation.get('data')
+    if op != 'remove' and not isinstance(data, dict):
+        raise BadRequest('The {} operation requires a resource object in data'.format(op),
+                         source={'pointer': '/data'})
+    target = ref if isinstance(ref, dict) else data if isinstance(data, dict) else {}
+    if target.get('type') not in RESOURCES:
+        raise BadRequest('type must be one of {}'.format(', '.join(sorted(RESOURCES))),
+                         source={'pointer': '/ref/type' if ref else '/data/type'})
+    list_resource, detail_resource, id_type = RESOURCES[target['type']]
+    qs = QueryStringManager(request.args, list_resource.schema)
+
+    if data is not None:
+        _resolve_relationships(data, lids)
+    if op == 'add':
+        return _add(list_resource, data, qs, lids)
+
+    pointer = '/ref' if ref else '/data'
+    if 'id' not in target and 'lid' not in target:
+        raise BadRequest('Missing id or lid', source={'pointer': pointer})
+    resource_id = _resolve(target, lids, pointer)
+    try:
+        view_kwargs = {'id': id_type(resource_id)}
+    except ValueError:
+        raise ObjectNotFound('{}: {} not found'.format(target['type'], resource_id), source={'pointer': pointer})
+    if op == 'update':
+        if ref and (data.get('type') != ref['type'] or 'id' in data and str(data['id']) != str(resource_id)):
+            raise BadRequest('data must be the resource of ref', source={'pointer': '/data'})
+        data.pop('lid', None)
+        data['id'] = str(resource_id)
+        return _update(detail_resource, view_kwargs, data, qs)
+    if target['type'] == 'user':
+        # The removal of a user runs in the background and can't be part of the transaction.
+        raise BadRequest("Users can't be removed in atomic operations, use DELETE /users/{id}",
+                         source={'pointer': '/op'})
+    return _remove(detail_resource, view_kwargs)
+
+
+def execute(operations):
+    """
+    Applies the operations in order in one transaction. Returns the list of
+    results, or raises OperationsError with the errors of the first failing
+    operation, after rolling back the ones before it.
+    """
+    lids = {}
+    results = []
+    with single_transaction():
+        for index, operation in enumerate(operations):
+            try:
+                results.append(apply(operation, lids))
+            except JsonApiException as e:
+                raise OperationsError(_prefixed([e.to_dict()], index), str(e.status))
+            except OperationsError as e:
+                raise OperationsError(_prefixed(e.errors, index), e.status)
+    return results
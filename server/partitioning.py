@@ -0,0 +1,169 @@
+###
+# Monthly range partitioning of the run table by start_time (PostgreSQL only).
+###
+from datetime import datetime
+
+from sqlalchemy import MetaData, PrimaryKeyConstraint
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from server.models import db, Run, User
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def next_month(value):
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def months_between(first, last):
+    """
+    Yields the first day of every month from the month of `first` to the month of `last`.
+    """
+    month = month_start(first)
+    while month <= last:
+        yield month
+        month = next_month(month)
+
+
+def partition_name(month, table_name=None):
+    return '{}_y{:04d}m{:02d}'.format(table_name or Run.__tablename__, month.year, month.month)
+
+
+def partitioned_table(table_name=None):
+    """
+    Returns a copy of the run table partitioned by start_time. Postgres requires
+    the partition key in the primary key, hence (id, start_time); the ORM keeps
+    identifying runs by id alone.
+    """
+    metadata = MetaData()
+    User.__table__.tometadata(metadata)
+    table = Run.__table__.tometadata(metadata, name=table_name or Run.__tablename__)
+    table.append_constraint(PrimaryKeyConstraint(table.c.id, table.c.start_time))
+    table.dialect_kwargs['postgresql_partition_by'] = 'RANGE (start_time)'
+    return table
+
+
+def _exists(connection, name):
+    return connection.execute('SELECT to_regclass(%(name)s) IS NOT NULL', {'name': name}).scalar()
+
+
+def default_partition_name(table_name=None):
+    return '{}_default'.format(table_name or Run.__tablename__)
+
+
+def create_partition(connection, month, table_name=None):
+    """
+    Creates the partition of a month, moving its runs out of the default
+    partition. Takes an exclusive lock on the run table until the transaction
+    of `connection` ends, run it in a short transaction of its own.
+    """
+    table_name = table_name or Run.__tablename__
+    name = partition_name(month, table_name)
+    bounds = {'start': month, 'end': next_month(month)}
+    if _exists(connection, name):
+        return name
+    default = default_partition_name(table_name)
+    moving = _exists(connection, default)
+    if moving:
+        # Postgres refuses a partition whose rows are in the default partition.
+        connection.execute('CREATE TEMP TABLE {}_moving ON COMMIT DROP AS SELECT * FROM {} '
+                           'WHERE start_time >= %(start)s AND start_time < %(end)s'.format(table_name, default),
+                           bounds)
+        connection.execute('DELETE FROM {} WHERE start_time >= %(start)s AND start_time < %(end)s'.format(
+            default), bounds)
+    connection.execute('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%(start)s) TO (%(end)s)'.format(
+        name, table_name), bounds)
+    if moving:
+        connection.execute('INSERT INTO {0} SELECT * FROM {0}_moving'.format(table_name))
+    return name
+
+
+def create_partitions(first, last, table_name=None):
+    """
+    Creates the partitions of the months from `first` to `last`, each in its own transaction.
+    """
+    names = []
+    for month in months_between(first, last):
+        with db.engine.begin() as connection:
+            names.append(create_partition(connection, month, table_name))
+    return names
+
+
+def default_partition_months(table_name=None):
+    """
+    Months of the runs in the default partition, which need a partition of their own.
+    """
+    with db.engine.connect() as connection:
+        return [month for month, in connection.execute(
+            "SELECT DISTINCT date_trunc('month', start_time) FROM {} WHERE start_time IS NOT NULL".format(
+                default_partition_name(table_name)))]
+
+
+def create_partitioned_runs(connection, table_name=None):
+    """
+    Creates the partitioned run table, with the indexes of the model and a
+    default partition for the runs of the months without a partition yet.
+    """
+    table_name = table_name or Run.__tablename__
+    table = partitioned_table(table_name)
+    connection.execute(CreateTable(table))
+    for index in table.indexes:
+        connection.execute(CreateIndex(index))
+    connection.execute('CREATE INDEX ix_{0}_user_id_start_time ON {0} (user_id, start_time)'.format(table_name))
+    connection.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(default_partition_name(table_name),
+                                                                         table_name))
+
+
+def migrate_to_partitioned(batch_size=50000, drop_legacy=False):
+    """
+    Moves an unpartitioned run table into a partitioned one. The old table is
+    renamed to run_unpartitioned, the rows are copied over in id order with one
+    transaction per batch and the id sequence is carried on. New runs are
+    written to the partitioned table right away; runs read during the copy may
+    be incomplete, so run it in a quiet period. Returns the number of copied runs.
+    """
+    engine = db.engine
+    with engine.begin() as connection:
+        connection.execute('ALTER TABLE run RENAME TO run_unpartitioned')
+        for index in ['run_pkey'] + [index.name for index in Run.__table__.indexes]:
+            connection.execute('ALTER INDEX IF EXISTS {0} RENAME TO {0}_unpartitioned'.format(index))
+        create_partitioned_runs(connection)
+        first, last, max_id = connection.execute(
+            'SELECT min(start_time), max(start_time), max(id) FROM run_unpartitioned').first()
+        connection.execute("SELECT setval(pg_get_serial_sequence('run', 'id'), %(id)s)", {'id': max_id or 1})
+    now = datetime.utcnow()
+    create_partitions(min(first or now, now), next_month(next_month(now)))
+
+    copied, last_id = 0, 0
+    while last_id < (max_id or 0):
+        with engine.begin() as connection:
+            result = connection.execute(
+                'INSERT INTO run SELECT * FROM run_unpartitioned WHERE id > %(after)s AND id <= %(until)s',
+                {'after': last_id, 'until': last_id + batch_size})
+            copied += result.rowcount
+        last_id += batch_size
+
+    if drop_legacy:
+        with engine.begin() as connection:
+            connection.execute('DROP TABLE run_unpartitioned')
+    return copied
+
+
+def is_partitioned(connection):
+    return connection.execute(
+        "SELECT count(*) FROM pg_partitioned_table WHERE partrelid = 'run'::regclass").scalar() > 0
+
+
+def time_range_filter(query, since=None, until=None):
+    """
+    Restricts a run query to start_time in [since, until), which lets Postgres
+    skip the partitions outside of the range.
+    """
+    if since is not None:
+        query = query.filter(Run.start_time >= since)
+    if until is not None:
+        query = query.filter(Run.start_time < until)
+    return query
+
@@ -0,0 +1,259 @@
+###
+# Incremental maintenance of the per-user run records (RunRecords).
+###
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from server.models import db, Run, RunRecords
+
+FIVE_K = 5000
+ONE_DAY = timedelta(days=1)
+# Days fetched per query when walking a streak backwards.
+STREAK_WINDOW = 64
+
+# Key of session.info holding the (previous, new) snapshots of the flushed runs until commit.
+_PENDING = 'records_pending'
+
+RunSnapshot = namedtuple('RunSnapshot', 'id user_id start_time distance duration')
+
+
+def snapshot(run):
+    """
+    The fields of a run the records depend on, taken before it's changed or deleted.
+    """
+    return RunSnapshot(run.id, run.user_id, run.start_time, run.distance, run.duration)
+
+
+def pace_5k(distance, duration):
+    """
+    Pace in seconds per km of a run of at least 5 km, None for other runs.
+    """
+    if distance and duration and distance >= FIVE_K and duration > 0:
+        return duration * 1000.0 / distance
+    return None
+
+
+def _day_start(day):
+    return datetime(day.year, day.month, day.day)
+
+
+def _fastest_5k(user_id):
+    pace = Run.duration * 1000.0 / Run.distance
+    return db.session.query(Run.id, pace).filter(
+        Run.user_id == user_id, Run.distance >= FIVE_K, Run.duration > 0).order_by(pace, Run.id).first()
+
+
+def _longest_run(user_id):
+    return db.session.query(Run.id, Run.distance).filter(
+        Run.user_id == user_id, Run.distance.isnot(None)).order_by(Run.distance.desc(), Run.id).first()
+
+
+def _has_run_on(user_id, day):
+    return db.session.query(Run.query.filter(
+        Run.user_id == user_id, Run.start_time >= _day_start(day),
+        Run.start_time < _day_start(day + ONE_DAY)).exists()).scalar()
+
+
+def _streak_start(user_id, day):
+    """
+    First day of the streak containing `day`, which has a run. Reads the runs
+    before it window by window until a day without run, so the cost is bounded
+    by the length of the streak.
+    """
+    start = day
+    while True:
+        low = start - timedelta(days=STREAK_WINDOW)
+        days = {start_time.date() for start_time, in db.session.query(Run.start_time).filter(
+            Run.user_id == user_id, Run.start_time >= _day_start(low), Run.start_time < _day_start(start))}
+        while start - ONE_DAY in days:
+            start -= ONE_DAY
+        if start - ONE_DAY >= low:
+            return start
+
+
+def _latest_streak(user_id):
+    last = db.session.query(db.func.max(Run.start_time)).filter(Run.user_id == user_id).scalar()
+    if last is None:
+        return None, None
+    end = last.date()
+    return _streak_start(user_id, end), end
+
+
+def _set_fastest(records, fastest):
+    records.fastest_5k_run_id, records.fastest_5k_pace = fastest or (None, None)
+
+
+def _set_longest(records, longest):
+    records.longest_run_id, records.longest_run_distance = longest or (None, None)
+
+
+def compute_records(user_id):
+    """
+    Records of a user computed from all their runs, the reference of the incremental updates.
+    """
+    return _fill(RunRecords(user_id=user_id), user_id)
+
+
+def _fill(records, user_id):
+    _set_fastest(records, _fastest_5k(user_id))
+    _set_longest(records, _longest_run(user_id))
+    records.streak_start, records.streak_end = _latest_streak(user_id)
+    return records
+
+
+def _locked_records(user_id):
+    """
+    The records row of the user locked for update, computed from scratch when missing.
+    """
+    records = RunRecords.query.filter_by(user_id=user_id).with_for_update().first()
+    if records is not None:
+        return records, False
+    try:
+        with db.session.begin_nested():
+            records = compute_records(user_id)
+            db.session.add(records)
+    except IntegrityError:
+        # Created concurrently.
+        return RunRecords.query.filter_by(user_id=user_id).with_for_update().first(), False
+    return records, True
+
+
+def _add(records, run):
+    pace = pace_5k(run.distance, run.duration)
+    if pace is not None and (records.fastest_5k_run_id is None
+                             or (pace, run.id) < (records.fastest_5k_pace, records.fastest_5k_run_id)):
+        _set_fastest(records, (run.id, pace))
+    if run.distance is not None and (records.longest_run_id is None
+                                     or (-run.distance, run.id) < (-records.longest_run_distance,
+                                                                   records.longest_run_id)):
+        _set_longest(records, (run.id, run.distance))
+
+    day = run.start_time.date()
+    if records.streak_end is None or day > records.streak_end + ONE_DAY:
+        records.streak_start = records.streak_end = day
+    elif day == records.streak_end + ONE_DAY:
+        records.streak_end = day
+    elif day == records.streak_start - ONE_DAY:
+        # The streak may now join an earlier one.
+        records.streak_start = _streak_start(run.user_id, day)
+
+
+def _remove(records, run):
+    """
+    Takes back a run which was deleted or changed. Only the records it holds
+    are recomputed, with one indexed query each.
+    """
+    if run.id == records.fastest_5k_run_id:
+        _set_fastest(records, _fastest_5k(run.user_id))
+    if run.id == records.longest_run_id:
+        _set_longest(records, _longest_run(run.user_id))
+
+    day = run.start_time.date()
+    if records.streak_end is None or not records.streak_start <= day <= records.streak_end \
+            or _has_run_on(run.user_id, day):
+        return
+    if day == records.streak_end:
+        records.streak_start, records.streak_end = _latest_streak(run.user_id)
+    else:
+        records.streak_start = day + ONE_DAY
+
+
+def run_created(run):
+    if run.user_id is None:
+        return
+    records, computed = _locked_records(run.user_id)
+    if not computed:
+        _add(records, run)
+
+
+def run_updated(previous, run):
+    if previous.user_id != run.user_id:
+        # Moved to another user, taken back from the records of the previous one.
+        run_deleted(previous)
+        run_created(run)
+        return
+    records, computed = _locked_records(run.user_id)
+    if not computed:
+        _remove(records, previous)
+        _add(records, run)
+
+
+def run_deleted(previous):
+    if previous.user_id is None:
+        return
+    records, computed = _locked_records(previous.user_id)
+    if not computed:
+        _remove(records, previous)
+
+
+def _previous(run):
+    state = inspect(run)
+
+    def value(name):
+        history = state.attrs[name].history
+        return history.deleted[0] if history.deleted else getattr(run, name)
+    return RunSnapshot(*(value(name) for name in RunSnapshot._fields))
+
+
+@event.listens_for(Session, 'after_flush')
+def runs_flushed(session, flush_context):
+    """
+    Collects the runs inserted, changed or deleted by the flush, whose records
+    are updated before the transaction commits.
+    """
+    changes = [(None, snapshot(run)) for run in session.new if isinstance(run, Run)]
+    for run in session.dirty:
+        if isinstance(run, Run):
+            previous = _previous(run)
+            if previous != snapshot(run):
+                changes.append((previous, snapshot(run)))
+    changes.extend((snapshot(run), None) for run in session.deleted if isinstance(run, Run))
+    if changes:
+        session.info.setdefault(_PENDING, []).extend(changes)
+
+
+@event.listens_for(Session, 'before_commit')
+def update_records(session):
+    """
+    Updates the records of the flushed runs in the transaction of the runs, so
+    that they are committed together.
+    """
+    # Runs added since the last flush are only flushed by the commit, after this hook.
+    session.flush()
+    for previous, run in session.info.pop(_PENDING, ()):
+        if previous is None:
+            run_created(run)
+        elif run is None:
+            run_deleted(previous)
+        else:
+            run_updated(previous, run)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_pending(session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING, None)
+
+
+def recompute(user_id):
+    """
+    Recomputes the records of a user from all their runs, e.g. after runs were
+    removed without the ORM. Committed with the caller's transaction.
+    """
+    records, computed = _locked_records(user_id)
+    return records if computed else _fill(records, user_id)
+
+
+def get_records(user_id):
+    """
+    The records row of a user, a single lookup by user_id once it exists.
+    """
+    records = RunRecords.query.filter_by(user_id=user_id).first()
+    if records is None:
+        records, _ = _locked_records(user_id)
+        db.session.commit()
+    return records
@@ -1,16 +1,42 @@
-from flask_jwt_extended import jwt_required
-from flask_rest_jsonapi import Api, ResourceDetail, ResourceList, JsonApiException
-from sqlalchemy import func
+from datetime import datetime
 
-from server.models import db, User, Run, Role
+from flask import current_app, request
+from flask_rest_jsonapi import Api, ResourceDetail, ResourceList, JsonApiException
+from flask_rest_jsonapi.data_layers.alchemy import SqlalchemyDataLayer
+from flask_rest_jsonapi.exceptions import BadRequest, InvalidSort, ObjectNotFound
+from flask_rest_jsonapi.schema import get_model_field, get_related_schema
+from marshmallow import class_registry
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import Load, with_expression
+
+from server.archive import get_archive, weekly_report
+from server.models import db, User, Run, RunTrack, roles_registry
+from server.partitioning import time_range_filter
+from server import group_commit, sharding
 from server.schemas import UserSchema, RunSchema, WeeklyRunsReport
-from server.utils.auth_utils import get_user_from_jwt, raise_permission_denied_exception
+from server.tasks import schedule_user_deletion
+from server.utils.auth_utils import get_user_from_jwt, jwt_required, raise_permission_denied_exception
+from server.utils.idempotency import idempotent
 
 from server.utils.weather import get_current_weather_at_location
 
 api = Api()
 
 
+def time_range_args():
+    """
+    Parses the optional `since` and `until` ISO dates of the query string.
+    """
+    bounds = []
+    for name in ('since', 'until'):
+        value = request.args.get(name)
+        try:
+            bounds.append(datetime.fromisoformat(value) if value else None)
+        except ValueError:
+            raise BadRequest("{} must be an ISO 8601 date".format(name), source={'parameter': name})
+    return bounds
+
+
 ###
 # Resource endpoints
 ###
@@ -21,7 +47,7 @@ class UserList(ResourceList):
         """
         Restricts results for GET requests.
         """
-        query_ = self.session.query(User)
+        query_ = self.session.query(User).filter(User.deleted_at.is_(None))
         user = get_user_from_jwt()
         if not user.is_privileged():
             query_ = query_.filter(User.id == user.id)
@@ -32,8 +58,7 @@ class UserList(ResourceList):
         Validates authorization for POST requests.
         """
         data = kwargs['data']
-        privileged_roles = [role.name for role in Role.query.filter_by(privileged=True).all()]
-        if list(set(privileged_roles) & set(data['roles'])):
+        if not roles_registry.privileged_names().isdisjoint(data['roles']):
             # Only Admin can create privileged users.
             user = get_user_from_jwt()
             if not user or not user.has_role("admin"):
@@ -45,10 +70,13 @@ class UserList(ResourceList):
         password = data['password'].encode('utf-8')
         data['password'] = User.get_password_hash(password)
 
-        role_objects = []
-        for role in data['roles']:
-            role_objects.append(Role.query.filter_by(name=role).first())
-        data['roles'] = role_objects
+        try:
+            data['roles'] = roles_registry.resolve(data['roles'])
+        except KeyError as e:
+            raise JsonApiException("Unknown roles: {}".format(", ".join(e.args[0])),
+                                   {'pointer': '/data/attributes/roles'},
+                                   title='Invalid roles',
+                                   status='422')
         try:
             return self._data_layer.create_object(data, kwargs)
         except JsonApiException as e:
@@ -92,6 +120,26 @@ class UserDetail(ResourceDetail):
         if not UserDetail.is_allowed_to_modify(obj):
             raise_permission_denied_exception("User doesn't have permission to access the resource.")
 
+    def retrieve_object_query(self, view_kwargs, filter_field, filter_value):
+        """
+        Users being deleted are no longer visible.
+        """
+        return self.session.query(User).filter(filter_field == filter_value, User.deleted_at.is_(None))
+
+    def delete_object(self, kwargs):
+        """
+        Deactivates the user, the user and their runs are removed in the background.
+        """
+        obj = self._data_layer.get_object(kwargs)
+        if obj is None:
+            raise ObjectNotFound('User: {} not found'.format(kwargs['id']), source={'parameter': 'id'})
+        self._data_layer.before_delete_object(obj, kwargs)
+        self.deletion = schedule_user_deletion(obj)
+
+    def after_delete(self, result):
+        result['meta']['deletion'] = self.deletion.to_dict()
+        return result
+
     schema = UserSchema
     data_layer = {
         'session': db.session,
@@ -99,23 +147,115 @@ class UserDetail(ResourceDetail):
         'methods': {
             'before_get_object': before_get_object,
             'before_update_object': before_update_object,
-            'before_delete_object': before_delete_object
+            'before_delete_object': before_delete_object,
+            'retrieve_object_query': retrieve_object_query
         }
     }
 
 
+def projection(load, model, schema, fields):
+    """
+    Restricts the columns loaded for `model` to the sparse fieldset of its
+    schema, with the foreign keys of the relationships in it. Without a
+    fieldset the deferred columns are loaded too, since all fields are dumped.
+    """
+    names = fields.get(schema.Meta.type_)
+    if names is None:
+        return load.undefer('*')
+    mapper = inspect(model)
+    columns = set()
+    for name in names:
+        attribute = get_model_field(schema, name)
+        if attribute in mapper.column_attrs:
+            columns.add(attribute)
+        elif attribute in mapper.relationships:
+            columns.update(mapper.get_property_by_column(column).key
+                           for column in mapper.relationships[attribute].local_columns)
+    return load.load_only(*columns)
+
+
+class ProjectedDataLayer(SqlalchemyDataLayer):
+    """
+    Selects only the columns of the requested sparse fieldsets, for the
+    resource and its included relationships.
+    """
+
+    def eagerload_includes(self, query, qs):
+        # Joins can't cross databases: with sharded runs, includes are loaded with queries of their own.
+        sharded = sharding.enabled()
+        if not sharded:
+            query = super().eagerload_includes(query, qs)
+        schema, fields = self.resource.schema, qs.fields
+        options = [projection(Load(self.model), self.model, schema, fields)]
+        for include in qs.include:
+            if '.' in include:
+                continue
+            related_schema = get_related_schema(schema, include)
+            if isinstance(related_schema, str):
+                related_schema = class_registry.get_class(related_schema)
+            relationship = getattr(self.model, get_model_field(schema, include))
+            load = Load(self.model).selectinload if sharded else Load(self.model).joinedload
+            options.append(projection(load(relationship),
+                                      relationship.property.mapper.class_, related_schema, fields))
+        return query.options(*options)
+
+
+class RunsDataLayer(ProjectedDataLayer):
+    def get_collection(self, qs, view_kwargs):
+        """
+        Merges the pages of all shards when runs are sharded and the listing
+        isn't restricted to the runs of one user, as for admins.
+        """
+        if not sharding.enabled():
+            return super().get_collection(qs, view_kwargs)
+        query = self.query(view_kwargs)
+        if qs.filters:
+            query = self.filter_query(query, qs.filters, self.model)
+        if not sharding.spans_shards(query):
+            return super().get_collection(qs, view_kwargs)
+
+        sorting = []
+        for sort in qs.sorting:
+            if not hasattr(self.model, sort['field']):
+                raise InvalidSort("{} has no attribute {}".format(self.model.__name__, sort['field']))
+            sorting.append((getattr(self.model, sort['field']), sort['order']))
+        sorting.append((self.model.id, 'asc'))
+        after = request.args.get('after')
+        if after is not None:
+            try:
+                after = sharding.decode_cursor(after, [column for column, _ in sorting])
+            except ValueError:
+                raise BadRequest('Invalid cursor', source={'parameter': 'after'})
+        size = int(qs.pagination.get('size', 1)) and (int(qs.pagination.get('size', 0))
+                                                       or current_app.config['PAGE_SIZE'])
+        number = int(qs.pagination.get('number', 1))
+        count, collection, next_values = sharding.gather(
+            self.eagerload_includes(query, qs), sorting, size, number, after)
+        self.resource.next_cursor = sharding.encode_cursor(next_values) if next_values else None
+        return count, self.after_get_collection(collection, qs, view_kwargs)
+
+
 class RunsList(ResourceList):
     schema = RunSchema
+    decorators = (idempotent,)
 
     @jwt_required
     def before_get(self, args, kwargs):
         pass
 
+    def after_get(self, result):
+        """
+        Listings across shards also return the cursor of the next page, for ?after=.
+        """
+        if getattr(self, 'next_cursor', None):
+            result['meta']['next'] = self.next_cursor
+        return result
+
     def query(self, view_kwargs):
         """
         Restricts GET query results to the user itself.
         """
-        query_ = self.session.query(Run)
+        query_ = time_range_filter(self.session.query(Run), *time_range_args())
         user = get_user_from_jwt()
         if not user.has_role("admin"):
             query_ = query_.filter(Run.user_id == user.id)
@@ -136,9 +276,14 @@ class RunsList(ResourceList):
         data['weather_info'] = get_current_weather_at_location(lat, lng)
         data['date'] = data['start_time'].strftime("%Y-%m-%d")
         data['duration'] = (data['end_time'] - data['start_time']).total_seconds()
+        if group_commit.enabled():
+            # The data layer would check that the user exists, the committer only inserts.
+            self._data_layer.get_related_object(User, 'id', {'id': data['user']})
+            return group_commit.committer.insert(data)
         return self._data_layer.create_object(data, kwargs)
 
     data_layer = {
+        'class': RunsDataLayer,
         'session': db.session,
         'model': Run,
         'methods': {
@@ -147,6 +292,24 @@ class RunsList(ResourceList):
     }
 
 
+class SummaryDataLayer(SqlalchemyDataLayer):
+    def get_collection(self, qs, view_kwargs):
+        """
+        Computes the report from the live and the archived runs when the user
+        has archived runs, otherwise in the database alone.
+        """
+        user = get_user_from_jwt()
+        archive = get_archive()
+        if archive is None or not archive.years(user.id):
+            return super().get_collection(qs, view_kwargs)
+        report = weekly_report(user.id, archive, *time_range_args())
+        if int(qs.pagination.get('size', 1)) == 0:
+            return len(report), report
+        page_size = int(qs.pagination.get('size', 0)) or current_app.config['PAGE_SIZE']
+        offset = (int(qs.pagination.get('number', 1)) - 1) * page_size
+        return len(report), report[offset:offset + page_size]
+
+
 class WeeklySummary(ResourceList):
     schema = WeeklyRunsReport
     methods = ["GET"]
@@ -162,10 +325,12 @@ class WeeklySummary(ResourceList):
             func.avg(Run.distance / Run.duration).label('average_speed'),
             week_number.label('week_number'),
             year.label('year')
-        ).filter_by(user_id=user.id).group_by(year, week_number).order_by(year.desc(), week_number.desc())
-        return query_
+        ).filter(Run.user_id == user.id)
+        query_ = time_range_filter(query_, *time_range_args())
+        return query_.group_by(year, week_number).order_by(year.desc(), week_number.desc())
 
     data_layer = {
+        'class': SummaryDataLayer,
         'session': db.session,
         'model': Run,
         'methods': {
@@ -179,27 +344,53 @@ class RunDetail(ResourceDetail):
 
     def is_self_run_or_admin_role(view_id, run=None):
         user = get_user_from_jwt()
+        if user.is_privileged():
+            return True
         if run is None:
             run = Run.query.filter_by(id=view_id).first()
-        return user.is_privileged() or run.user_id == user.id
+            if run is None:
+                raise ObjectNotFound('Run: {} not found'.format(view_id), source={'parameter': 'id'})
+        if run.owned is not None:
+            return run.owned
+        return run.user_id == user.id
 
-    def before_get_object(self, view_kwargs):
-        if not RunDetail.is_self_run_or_admin_role(view_kwargs.get('id')):
+    def retrieve_object_query(self, view_kwargs, filter_field, filter_value):
+        """
+        Loads the run together with whether it belongs to the user, so that
+        the permission check needs no query of its own.
+        """
+        query_ = self.session.query(Run).filter(filter_field == filter_value)
+        user = get_user_from_jwt()
+        if not user.is_privileged():
+            query_ = sharding.route(query_.options(with_expression(Run.owned, Run.user_id == user.id)), user.id)
+        return query_
+
+    def after_get_object(self, obj, view_kwargs):
+        if obj is None:
+            raise ObjectNotFound('Run: {} not found'.format(view_kwargs.get('id')), source={'parameter': 'id'})
+        if not RunDetail.is_self_run_or_admin_role(view_kwargs.get('id'), obj):
             raise_permission_denied_exception("User doesn't have permission to access the resource.")
 
     def before_update_object(self, obj, data, view_kwargs):
         if not RunDetail.is_self_run_or_admin_role(view_kwargs.get('id'), obj):
             raise_permission_denied_exception("User doesn't have permission to access the resource.")
+        if data.get('user') and not sharding.same_shard(obj.user_id, data['user']):
+            raise BadRequest("Runs can't be moved to a user of another shard",
+                             source={'pointer': '/data/relationships/user'})
 
     def before_delete_object(self, obj, view_kwargs):
         if not RunDetail.is_self_run_or_admin_role(view_kwargs.get('id'), obj):
             raise_permission_denied_exception("User doesn't have permission to access the resource.")
+        # Committed with the run by the data layer.
+        RunTrack.query.filter_by(run_id=obj.id).delete()
 
     data_layer = {
+        'class': ProjectedDataLayer,
         'session': db.session,
         'model': Run,
         'methods': {
-            'before_get_object': before_get_object,
+            'retrieve_object_query': retrieve_object_query,
+            'after_get_object': after_get_object,
             'before_update_object': before_update_object,
             'before_delete_object': before_delete_object
         }
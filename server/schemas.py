@@ -33,6 +33,8 @@ class RunSchema(Schema):
     date = fields.String(dump_only=True)
     # Distance in meters
     distance = fields.Integer(required=True, as_string=True)
+    # Duration in seconds, computed from start_time and end_time
+    duration = fields.Integer(dump_only=True)
     start_lat = fields.Float(required=True, as_string=True)
     start_lng = fields.Float(required=True, as_string=True)
     end_lat = fields.Float(required=True, as_string=True)
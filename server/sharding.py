@@ -0,0 +1,280 @@
+###
+# Runs split across databases by user (RUNS_SHARDS): shard schemas, run ids,
+# listings across shards and the move of runs between layouts.
+###
+import base64
+import binascii
+import heapq
+import json
+import threading
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, Column, event, false, Index, MetaData, or_, select, Table
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import object_session
+
+from server.models import db, IdBlock, Run
+from server.utils.shards import MAIN, shard_for, ShardedSignallingSession, SHARDED_TABLES
+
+
+def shards():
+    return current_app.config.get('RUNS_SHARDS') or []
+
+
+def enabled():
+    return bool(shards())
+
+
+def engine(key):
+    return db.engine if key == MAIN else db.get_engine(current_app, bind=key)
+
+
+def route(query, user_id):
+    """
+    Restricts a run query to the shard of a user, so that the runs of other
+    users aren't found even when the query doesn't filter on the user.
+    """
+    return query.set_shard(shard_for(user_id, shards())) if enabled() else query
+
+
+def same_shard(user_id, other_user_id):
+    return shard_for(user_id, shards()) == shard_for(other_user_id, shards())
+
+
+def spans_shards(query):
+    session = query.session
+    return isinstance(session, ShardedSignallingSession) and query._shard_id is None and len(
+        session.route(query._bind_mapper(), query.statement)) > 1
+
+
+def shard_metadata():
+    """
+    The sharded tables as created on the shards: without foreign keys to the
+    tables of the main database, and indexed by user.
+    """
+    metadata = MetaData()
+    for name in sorted(SHARDED_TABLES):
+        table = db.metadata.tables[name]
+        Table(name, metadata,
+              *[Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable,
+                       index=column.index, autoincrement=False) for column in table.columns])
+        Index('ix_{}_user_id_id'.format(name), metadata.tables[name].c.user_id, metadata.tables[name].c.id)
+    return metadata
+
+
+def create_shards():
+    metadata = shard_metadata()
+    for key in shards():
+        metadata.create_all(engine(key))
+
+
+def drop_shards():
+    metadata = shard_metadata()
+    for key in shards():
+        metadata.drop_all(engine(key))
+
+
+class IdAllocator:
+    """
+    Hands out run ids, unique across shards, from blocks reserved in the main
+    database (hi/lo). A block is reserved in a transaction of its own, so that
+    a rolled back request never returns it; the ids of a block left unused when
+    the process exits are skipped.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def next_id(self, block_size):
+        with self._lock:
+            if self._next >= self._end:
+                self._next = self._reserve(block_size)
+                self._end = self._next + block_size
+            self._next += 1
+            return self._next - 1
+
+    def reset(self):
+        with self._lock:
+            self._next = self._end = 0
+
+    def _reserve(self, block_size):
+        blocks = IdBlock.__table__
+        for _ in range(3):
+            try:
+                with db.engine.begin() as connection:
+                    start = connection.execute(select([blocks.c.next_id]).where(
+                        blocks.c.name == self.name).with_for_update()).scalar()
+                    if start is None:
+                        start = max_id(self.name) + 1
+                        connection.execute(blocks.insert().values(name=self.name, next_id=start + block_size))
+                    else:
+                        connection.execute(blocks.update().where(blocks.c.name == self.name).values(
+                            next_id=start + block_size))
+                    return start
+            except IntegrityError:
+                # Another process reserved the first block.
+                continue
+        raise RuntimeError('Could not reserve a block of {} ids'.format(self.name))
+
+
+def max_id(table_name):
+    """
+    Largest id of a sharded table in the main database and the shards.
+    """
+    table = db.metadata.tables[table_name]
+    return max(engine(key).execute(select([db.func.max(table.c.id)])).scalar() or 0
+               for key in [MAIN] + shards())
+
+
+run_ids = IdAllocator('run')
+
+
+@event.listens_for(Run, 'before_insert')
+def assign_run_id(mapper, connection, target):
+    """
+    The shards have sequences of their own, so the ids of sharded runs come from run_ids.
+    """
+    if target.id is None and isinstance(object_session(target), ShardedSignallingSession):
+        target.id = run_ids.next_id(current_app.config['RUNS_SHARD_ID_BLOCK'])
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, columns):
+    """
+    The sort values of a cursor of gather(), raises ValueError when it's invalid.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (TypeError, UnicodeError, binascii.Error, json.JSONDecodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid cursor')
+    return [datetime.fromisoformat(value) if isinstance(value, str) and column.type.python_type is datetime
+            else value for column, value in zip(columns, values)]
+
+
+def _after(sorting, values):
+    """
+    The rows after `values` in the order of `sorting`, a keyset condition.
+    None sorts last ascending and first descending, as in _SortKey.
+    """
+    conditions = []
+    for index, ((column, direction), value) in enumerate(zip(sorting, values)):
+        equal = [previous.is_(None) if previous_value is None else previous == previous_value
+                 for (previous, _), previous_value in zip(sorting[:index], values)]
+        if direction == 'desc':
+            after = column.isnot(None) if value is None else column < value
+        else:
+            after = false() if value is None else or_(column > value, column.is_(None))
+        conditions.append(and_(*equal, after))
+    return or_(*conditions)
+
+
+class _SortKey:
+    """
+    Order of the rows of gather() in Python, None sorting last as in PostgreSQL.
+    """
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other):
+        for value, other_value, direction in zip(self.values, other.values, self.directions):
+            if value == other_value:
+                continue
+            if value is None or other_value is None:
+                less = other_value is None
+            else:
+                less = value < other_value
+            return less if direction == 'asc' else not less
+        return False
+
+
+def gather(query, sorting, size, number=1, after=None):
+    """
+    A page of the rows of a run query on all shards, sorted by `sorting`, a
+    list of (column, 'asc' or 'desc') ending with a unique column. Every shard
+    returns its first rows in that order and the pages are merged. `after`
+    are the sort values of the last row of the previous page: each shard then
+    reads one page whatever the depth, while page `number` costs number * size
+    rows per shard. Returns (count, rows, values after the page or None).
+    """
+    columns = [column for column, _ in sorting]
+    ordering = [column.desc().nullsfirst() if direction == 'desc' else column.asc().nullslast()
+                for column, direction in sorting]
+    directions = [direction for _, direction in sorting]
+    skip = 0 if after is not None or not size else (number - 1) * size
+    count, streams = 0, []
+    for key in shards():
+        shard_query = query.set_shard(key)
+        count += shard_query.order_by(None).count()
+        if after is not None:
+            shard_query = shard_query.filter(_after(sorting, after))
+        shard_query = shard_query.order_by(None).order_by(*ordering)
+        if size:
+            shard_query = shard_query.limit(skip + size + 1)
+        streams.append(shard_query.all())
+
+    def sort_key(row):
+        return _SortKey([getattr(row, column.key) for column in columns], directions)
+    rows = list(heapq.merge(*streams, key=sort_key))
+    page = rows[skip:skip + size] if size else rows[skip:]
+    more = size and len(rows) > skip + size
+    return count, page, [getattr(page[-1], column.key) for column in columns] if more else None
+
+
+def reshard(sources, batch_size=5000):
+    """
+    Moves the runs of the databases `sources` (bind keys, or 'main' for the
+    run table of the main database) which aren't in the shard of their user
+    under RUNS_SHARDS there, in id order. Each batch is copied in one
+    transaction then deleted from its source in another, a run already in its
+    target is only deleted, so an interrupted move is completed by running it
+    again. Runs being moved aren't found by the app in the meantime, reshard
+    during a maintenance window. Runs without a user have no shard, they stay
+    in their source and are logged. Returns the number of moved runs.
+    """
+    moved = 0
+    metadata = shard_metadata()
+    for name in sorted(SHARDED_TABLES):
+        table = metadata.tables[name]
+        for source in sources:
+            last_id, orphans = 0, []
+            while True:
+                with engine(source).connect() as connection:
+                    rows = connection.execute(select([table]).where(table.c.id > last_id)
+                                              .order_by(table.c.id).limit(batch_size)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                by_target = {}
+                for row in rows:
+                    if row.user_id is None:
+                        orphans.append(row.id)
+                        continue
+                    target = shard_for(row.user_id, shards())
+                    if target != source:
+                        by_target.setdefault(target, []).append(dict(row))
+                for target, target_rows in by_target.items():
+                    with engine(target).begin() as connection:
+                        ids = [row['id'] for row in target_rows]
+                        present = {id_ for id_, in connection.execute(select([table.c.id]).where(table.c.id.in_(ids)))}
+                        missing = [row for row in target_rows if row['id'] not in present]
+                        if missing:
+                            connection.execute(table.insert(), missing)
+                    with engine(source).begin() as connection:
+                        connection.execute(table.delete().where(table.c.id.in_(ids)))
+                    moved += len(target_rows)
+            if orphans:
+                current_app.logger.warning("%s rows of %s without a user left in %s: %s", len(orphans), name, source,
+                                           ', '.join(map(str, orphans)))
+    return moved
@@ -0,0 +1,152 @@
+###
+# Spatial queries over the start point of runs: geohash ranges, or PostGIS when enabled.
+###
+import math
+
+from flask import current_app
+from sqlalchemy import and_, cast, event, Float, literal_column, or_, text
+
+from server import sharding
+from server.models import db, Run
+from server.utils import geohash
+from server.utils.shards import MAIN
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+# Over-fetch factor of the approximate distance ordering of the nearby runs.
+APPROXIMATION_SLACK = 2
+
+
+def parse_point(lat, lng):
+    try:
+        lat, lng = float(lat), float(lng)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+@event.listens_for(Run, 'before_insert')
+@event.listens_for(Run, 'before_update')
+def set_start_geohash(mapper, connection, target):
+    point = parse_point(target.start_lat, target.start_lng)
+    target.start_geohash = geohash.encode(*point) if point else None
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lng, radius):
+    """
+    Bounding box of the circle, clamped to the valid coordinates.
+    """
+    dlat = radius / METERS_PER_DEGREE
+    dlng = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return max(-90.0, lat - dlat), max(-180.0, lng - dlng), min(90.0, lat + dlat), min(180.0, lng + dlng)
+
+
+def use_postgis():
+    return current_app.config.get('RUNS_SPATIAL_BACKEND') == 'postgis'
+
+
+def within_bbox(query, min_lat, min_lng, max_lat, max_lng):
+    """
+    Restricts a run query to start points in the bounding box. The geohash
+    ranges of the covering cells select the candidates through the index, the
+    exact bounds are checked on them.
+    """
+    if use_postgis():
+        return query.filter(text(
+            'run.start_geog && ST_MakeEnvelope(:min_lng, :min_lat, :max_lng, :max_lat, 4326)::geography'
+        ).bindparams(min_lat=min_lat, min_lng=min_lng, max_lat=max_lat, max_lng=max_lng))
+    ranges = geohash.prefix_ranges(geohash.cover(min_lat, min_lng, max_lat, max_lng))
+    column = Run.start_geohash
+    query = query.filter(or_(*[
+        and_(column >= start, column < end) if end else column >= start for start, end in ranges]))
+    lat, lng = cast(Run.start_lat, Float), cast(Run.start_lng, Float)
+    return query.filter(lat.between(min_lat, max_lat), lng.between(min_lng, max_lng))
+
+
+def nearby(query, lat, lng, radius, limit):
+    """
+    Runs of the query starting within `radius` meters of the point, closest
+    first, as (run, distance in meters) pairs. A query on several shards takes
+    the closest runs of each shard.
+    """
+    if sharding.spans_shards(query):
+        matches = [match for key in sharding.shards()
+                   for match in nearby(query.set_shard(key), lat, lng, radius, limit)]
+        return sorted(matches, key=lambda match: (match[1], match[0].id))[:limit]
+    if use_postgis():
+        point = 'ST_SetSRID(ST_MakePoint(:lng, :lat), 4326)::geography'
+        distance = literal_column('ST_Distance(run.start_geog, {})'.format(point))
+        rows = query.add_columns(distance).filter(
+            text('ST_DWithin(run.start_geog, {}, :radius)'.format(point))
+        ).order_by(text('run.start_geog <-> {}'.format(point))).params(
+            lat=lat, lng=lng, radius=radius).limit(limit).all()
+        return [(run, float(meters)) for run, meters in rows]
+    # Closest candidates by the equirectangular distance in degrees, bounded in
+    # SQL, with some slack for its error before the exact haversine check.
+    scale = math.cos(math.radians(lat))
+    dlat, dlng = cast(Run.start_lat, Float) - lat, (cast(Run.start_lng, Float) - lng) * scale
+    approximate = dlat * dlat + dlng * dlng
+    reach = (radius * APPROXIMATION_SLACK / METERS_PER_DEGREE) ** 2
+    candidates = within_bbox(query, *radius_bbox(lat, lng, radius)).filter(approximate <= reach).order_by(
+        approximate, Run.id).limit(limit * APPROXIMATION_SLACK)
+    matches = []
+    for run in candidates:
+        meters = haversine(lat, lng, float(run.start_lat), float(run.start_lng))
+        if meters <= radius:
+            matches.append((run, meters))
+    return sorted(matches, key=lambda match: (match[1], match[0].id))[:limit]
+
+
+def enable_postgis():
+    """
+    Adds the PostGIS geography column of the start points, generated from
+    start_lat/start_lng, with its GiST index, in the main database and the shards.
+    """
+    for key in [MAIN] + sharding.shards():
+        with sharding.engine(key).begin() as connection:
+            connection.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+            connection.execute(
+                'ALTER TABLE run ADD COLUMN IF NOT EXISTS start_geog geography(Point, 4326) GENERATED ALWAYS AS '
+                '(ST_SetSRID(ST_MakePoint(start_lng::float8, start_lat::float8), 4326)::geography) STORED')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_run_start_geog ON run USING gist (start_geog)')
+
+
+def backfill_geohashes(batch_size=10000):
+    """
+    Computes the missing geohashes of runs inserted without the ORM, shard by
+    shard in id order with one transaction per batch. Returns the number of
+    updated runs.
+    """
+    updated = 0
+    for shard in sharding.shards() or [None]:
+        query = db.session.query(Run.id, Run.start_lat, Run.start_lng)
+        if shard is not None:
+            query = query.set_shard(shard)
+        last_id = 0
+        while True:
+            rows = query.filter(Run.id > last_id, Run.start_geohash.is_(None)).order_by(Run.id).limit(
+                batch_size).all()
+            if not rows:
+                break
+            values = []
+            for run_id, lat, lng in rows:
+                point = parse_point(lat, lng)
+                if point:
+                    values.append({'run_id': run_id, 'geohash': geohash.encode(*point)})
+            if values:
+                table = Run.__table__
+                db.session.execute(table.update().where(table.c.id == db.bindparam('run_id')).values(
+                    start_geohash=db.bindparam('geohash')), values,
+                    bind=sharding.engine(shard) if shard is not None else None)
+            db.session.commit()
+            updated += len(values)
+            last_id = rows[-1][0]
+    return updated
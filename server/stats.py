@@ -0,0 +1,148 @@
+###
+# Run statistics computed on columnar NumPy arrays.
+###
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func
+
+from server.archive import get_archive, live_archived_ids
+from server.models import db, Run
+from server.partitioning import time_range_filter
+
+# start_time as datetime64[s], distance in meters and duration in seconds as float64 (NaN when missing).
+RunArrays = namedtuple('RunArrays', 'start_time distance duration')
+
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+def arrays_from_rows(rows):
+    """
+    Builds the RunArrays of (epoch seconds, distance, duration) rows. The rows
+    are all numbers, so NumPy converts them in one pass.
+    """
+    values = np.array(rows, dtype=float).reshape(-1, 3)
+    start_time = values[:, 0].astype('int64').astype('datetime64[s]')
+    return RunArrays(start_time, values[:, 1].copy(), values[:, 2].copy())
+
+
+def load_runs(user_id, since=None, until=None):
+    """
+    Loads the runs of a user into columnar arrays with a single query,
+    including the archived runs, ordered by start_time.
+    """
+    # Epoch seconds rather than datetimes, converting datetime objects dominates otherwise.
+    query = db.session.query(func.date_part('epoch', Run.start_time), Run.distance, Run.duration).filter(
+        Run.user_id == user_id)
+    rows = time_range_filter(query, since, until).order_by(Run.start_time).all()
+    columns = list(arrays_from_rows(rows))
+
+    archive = get_archive()
+    if archive is not None and archive.years(user_id):
+        for table in archive.scan(user_id, since, until, live_archived_ids(user_id, archive)):
+            columns[0] = np.concatenate([columns[0], table['start_time'].to_numpy().astype('datetime64[s]')])
+            for index, name in ((1, 'distance'), (2, 'duration')):
+                values = table[name].to_numpy(zero_copy_only=False).astype(float)
+                columns[index] = np.concatenate([columns[index], values])
+        order = np.argsort(columns[0], kind='stable')
+        columns = [column[order] for column in columns]
+    return RunArrays(*columns)
+
+
+def _number(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def _day(value):
+    return str(value.astype('datetime64[D]'))
+
+
+def rolling_mean(values, window):
+    """
+    Means of every `window` consecutive values.
+    """
+    if len(values) < window:
+        return np.empty(0)
+    sums = np.cumsum(np.concatenate([[0.0], values]))
+    return (sums[window:] - sums[:-window]) / window
+
+
+def streaks(days, today):
+    """
+    Returns (current, longest) number of consecutive days with a run. The
+    current streak is kept alive until the end of the day after the last run.
+    """
+    if not len(days):
+        return 0, 0
+    unique_days = np.unique(days)
+    breaks = np.flatnonzero(np.diff(unique_days) != np.timedelta64(1, 'D')) + 1
+    lengths = np.diff(np.concatenate([[0], breaks, [len(unique_days)]]))
+    current = int(lengths[-1]) if today - unique_days[-1] <= np.timedelta64(1, 'D') else 0
+    return current, int(lengths.max())
+
+
+def personal_bests(runs, pace):
+    bests = {}
+    if np.any(runs.distance > 0):
+        longest = np.nanargmax(runs.distance)
+        bests['longest_run'] = {'distance': _number(runs.distance[longest]), 'date': _day(runs.start_time[longest])}
+    for name, minimum in (('fastest_1k', 1000), ('fastest_5k', 5000), ('fastest_10k', 10000)):
+        candidates = np.flatnonzero((runs.distance >= minimum) & ~np.isnan(pace))
+        if len(candidates):
+            fastest = candidates[np.argmin(pace[candidates])]
+            # Estimated time over the distance at the average pace of the run.
+            bests[name] = {'time': _number(pace[fastest] * minimum / 1000), 'pace': _number(pace[fastest]),
+                           'date': _day(runs.start_time[fastest])}
+    return bests
+
+
+def training_load(days_ago, duration):
+    """
+    Acute (last 7 days) and chronic (weekly average of the last 28 days) load
+    in minutes of running, and their ratio.
+    """
+    minutes = np.nan_to_num(duration) / 60
+    acute = float(minutes[(days_ago >= 0) & (days_ago < 7)].sum())
+    chronic = float(minutes[(days_ago >= 0) & (days_ago < 28)].sum()) / 4
+    return {'acute': acute, 'chronic': chronic, 'ratio': acute / chronic if chronic else None}
+
+
+def compute_stats(runs, now=None, window=10):
+    """
+    Derived metrics of the runs: totals, speed and pace (seconds per km) with
+    their percentiles, rolling distances and pace, personal bests, streaks
+    and training load.
+    """
+    today = np.datetime64(now or datetime.utcnow(), 'D')
+    count = len(runs.start_time)
+    valid = (runs.distance > 0) & (runs.duration > 0)
+    speed = np.divide(runs.distance, runs.duration, out=np.full(count, np.nan), where=valid)
+    pace = np.divide(runs.duration * 1000, runs.distance, out=np.full(count, np.nan), where=valid)
+    paces = pace[valid]
+    days = runs.start_time.astype('datetime64[D]')
+    days_ago = (today - days).astype(int)
+    current_streak, longest_streak = streaks(days, today)
+    recent_paces = rolling_mean(paces, window)
+
+    return {
+        'runs': count,
+        'total_distance': float(np.nansum(runs.distance)),
+        'total_duration': float(np.nansum(runs.duration)),
+        'average_speed': _number(np.mean(speed[valid])) if len(paces) else None,
+        'average_pace': _number(np.mean(paces)) if len(paces) else None,
+        'pace_percentiles': {str(q): _number(value) for q, value in zip(
+            PERCENTILES, np.percentile(paces, PERCENTILES))} if len(paces) else {},
+        'distance_percentiles': {str(q): _number(value) for q, value in zip(
+            PERCENTILES, np.nanpercentile(runs.distance, PERCENTILES))} if valid.any() else {},
+        'rolling': {
+            'distance_7_days': float(np.nansum(runs.distance[(days_ago >= 0) & (days_ago < 7)])),
+            'distance_28_days': float(np.nansum(runs.distance[(days_ago >= 0) & (days_ago < 28)])),
+            'pace_last_{}_runs'.format(window): _number(recent_paces[-1]) if len(recent_paces) else None,
+            'best_pace_over_{}_runs'.format(window): _number(recent_paces.min()) if len(recent_paces) else None,
+        },
+        'personal_bests': personal_bests(runs, pace),
+        'streaks': {'current': current_streak, 'longest': longest_streak},
+        'training_load': training_load(days_ago, runs.duration),
+    }
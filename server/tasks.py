@@ -0,0 +1,108 @@
+###
+# Background tasks
+###
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from server import changes
+from server.archive import get_archive
+from server.jobs import task
+from server.models import (db, roles_users, BlacklistToken, IdempotencyKey, Run, RunChange, RunRecords, RunTrack,
+                           User, UserDeletion)
+from server.utils.background import run_in_background
+from server.weather_backfill import backfill
+
+
+def schedule_user_deletion(user):
+    """
+    Deactivates the user right away and hands the removal of the rows to a
+    background job. Returns the UserDeletion tracking its progress.
+    """
+    user.active = False
+    user.deleted_at = datetime.utcnow()
+    deletion = UserDeletion(user_id=user.id, status='pending')
+    db.session.add(deletion)
+    db.session.commit()
+    run_in_background(purge_user, deletion.id)
+    return deletion
+
+
+@task
+def purge_user(deletion_id):
+    """
+    Deletes the runs of a deleted user in bounded batches, each in its own
+    transaction, then the user itself.
+    """
+    deletion = UserDeletion.query.get(deletion_id)
+    if deletion is None or deletion.status == 'done':
+        return
+    batch_size = current_app.config.get('USER_PURGE_BATCH_SIZE', 5000)
+    user_id = deletion.user_id
+    try:
+        deletion.status = 'running'
+        deletion.runs_total = (deletion.runs_deleted or 0) + Run.query.filter_by(user_id=user_id).count()
+        db.session.commit()
+        while True:
+            run_ids = [run_id for run_id, in db.session.query(Run.id).filter_by(user_id=user_id).limit(batch_size)]
+            if not run_ids:
+                break
+            RunTrack.query.filter(RunTrack.run_id.in_(run_ids)).delete(synchronize_session=False)
+            Run.query.filter(Run.user_id == user_id, Run.id.in_(run_ids)).delete(synchronize_session=False)
+            deletion.runs_deleted = (deletion.runs_deleted or 0) + len(run_ids)
+            db.session.commit()
+        archive = get_archive()
+        if archive is not None:
+            # Tracks of archived runs, left by archiving before it deleted them with their runs.
+            for table in archive.scan(user_id):
+                run_ids = table['id'].to_pylist()
+                for offset in range(0, len(run_ids), batch_size):
+                    RunTrack.query.filter(RunTrack.run_id.in_(run_ids[offset:offset + batch_size])).delete(
+                        synchronize_session=False)
+                    db.session.commit()
+            archive.remove_user(user_id)
+        RunRecords.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+        RunChange.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+        db.session.execute(roles_users.delete().where(roles_users.c.user_id == user_id))
+        User.query.filter_by(id=user_id).delete(synchronize_session=False)
+        deletion.status = 'done'
+        deletion.finished_at = datetime.utcnow()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        deletion.status = 'failed'
+        db.session.commit()
+        raise
+
+
+def resume_user_deletions():
+    """
+    Runs the deletions which haven't completed, e.g. after a restart.
+    """
+    pending = UserDeletion.query.filter(UserDeletion.status != 'done').order_by(UserDeletion.id).all()
+    for deletion in pending:
+        purge_user(deletion.id)
+    return len(pending)
+
+
+@task
+def purge_blacklist():
+    return BlacklistToken.purge(current_app.config.get('JWT_REVOCATION_WATERMARK'))
+
+
+@task
+def purge_idempotency_keys():
+    return IdempotencyKey.purge()
+
+
+@task
+def compact_run_changes():
+    return changes.compact(timedelta(days=current_app.config['RUN_CHANGES_TOMBSTONE_RETENTION_DAYS']))
+
+
+@task
+def backfill_weather(batch_size=1000, stale=False):
+    """
+    Weather backfill from its checkpoint, a retried job resumes where it failed.
+    """
+    return backfill(batch_size, stale)
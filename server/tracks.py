@@ -0,0 +1,153 @@
+###
+# GPS tracks of runs, stored as delta encoded and compressed blocks of points.
+###
+import struct
+import zlib
+
+import numpy as np
+
+from server.models import db, RunTrack
+
+EARTH_RADIUS = 6371008.8
+# Coordinates are stored in microdegrees (~0.1 m) and times in milliseconds since the first point.
+COORDINATE_SCALE = 1e6
+# magic, points per block, points, blocks, time of the first point in ms since the epoch
+HEADER = struct.Struct('<4sIIIq')
+MAGIC = b'RTK2'
+# Headers by magic, RTK1 tracks were written with at most 65535 points per block.
+HEADERS = {MAGIC: HEADER, b'RTK1': struct.Struct('<4sHIIq')}
+
+
+class TrackError(ValueError):
+    pass
+
+
+def parse_points(points, max_points):
+    """
+    Validates [[lat, lng, unix time], ...] and returns float64 arrays.
+    """
+    if not isinstance(points, list) or len(points) < 2:
+        raise TrackError("A track needs at least 2 points of [lat, lng, time]")
+    if len(points) > max_points:
+        raise TrackError("A track can have at most {} points".format(max_points))
+    try:
+        values = np.array(points, dtype=float)
+    except (TypeError, ValueError):
+        raise TrackError("Points must be [lat, lng, time] numbers")
+    if values.ndim != 2 or values.shape[1] != 3 or not np.isfinite(values).all():
+        raise TrackError("Points must be [lat, lng, time] numbers")
+    lat, lng, time = values.T
+    if (np.abs(lat) > 90).any() or (np.abs(lng) > 180).any():
+        raise TrackError("Coordinates out of range")
+    if (np.diff(time) < 0).any():
+        raise TrackError("Point times must not decrease")
+    if time[-1] - time[0] >= 2 ** 31 / 1000:
+        raise TrackError("A track can't span more than 24 days")
+    return lat, lng, time
+
+
+def encode(lat, lng, time, block_size=1024):
+    """
+    Encodes a track into blocks of `block_size` points. Each block holds the
+    deltas of the quantized coordinates and times, its first point relative
+    to zero, so that blocks decode independently.
+    """
+    start_ms = int(round(time[0] * 1000))
+    columns = np.stack([np.round(lat * COORDINATE_SCALE), np.round(lng * COORDINATE_SCALE),
+                        np.round(time * 1000) - start_ms]).astype(np.int64)
+    blocks = []
+    for offset in range(0, columns.shape[1], block_size):
+        block = columns[:, offset:offset + block_size]
+        deltas = np.diff(block, axis=1, prepend=0).astype('<i4')
+        blocks.append(zlib.compress(deltas.tobytes(), 6))
+    offsets = np.cumsum([0] + [len(block) for block in blocks]).astype('<u4')
+    header = HEADER.pack(MAGIC, block_size, columns.shape[1], len(blocks), start_ms)
+    return header + offsets.tobytes() + b''.join(blocks)
+
+
+def decode(data, start=0, end=None):
+    """
+    Decodes the points [start, end) of an encoded track into (lat, lng, time)
+    arrays, only decompressing the blocks of the range.
+    """
+    header = HEADERS.get(bytes(data[:4]))
+    if header is None:
+        raise TrackError("Unknown track encoding")
+    _, block_size, count, block_count, start_ms = header.unpack_from(data)
+    end = count if end is None else min(end, count)
+    start = max(0, min(start, end))
+    offsets = np.frombuffer(data, '<u4', block_count + 1, header.size)
+    body = header.size + offsets.nbytes
+    first_block, last_block = start // block_size, (max(end, 1) - 1) // block_size
+    columns = []
+    for index in range(first_block, last_block + 1 if end > start else first_block):
+        raw = zlib.decompress(data[body + offsets[index]:body + offsets[index + 1]])
+        columns.append(np.cumsum(np.frombuffer(raw, '<i4').reshape(3, -1), axis=1, dtype=np.int64))
+    if not columns:
+        return np.empty(0), np.empty(0), np.empty(0)
+    values = np.concatenate(columns, axis=1)[:, start - first_block * block_size:end - first_block * block_size]
+    return (values[0] / COORDINATE_SCALE, values[1] / COORDINATE_SCALE,
+            (values[2] + start_ms) / 1000)
+
+
+def to_points(lat, lng, time):
+    return np.stack([lat, lng, time], axis=1).tolist()
+
+
+def haversine_distance(lat, lng):
+    """
+    Length in meters of the path through the points.
+    """
+    lat, lng = np.radians(lat), np.radians(lng)
+    a = (np.sin(np.diff(lat) / 2) ** 2
+         + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lng) / 2) ** 2)
+    return float(2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1))).sum())
+
+
+def simplify(lat, lng, tolerance):
+    """
+    Douglas-Peucker simplification, returns the indexes of the points to keep
+    so that no dropped point is further than `tolerance` meters from the
+    simplified path. Uses an equirectangular projection around the track,
+    the distances of a segment's points are computed at once.
+    """
+    count = len(lat)
+    if count < 3 or tolerance <= 0:
+        return np.arange(count)
+    y = np.radians(lat) * EARTH_RADIUS
+    x = np.radians(lng) * EARTH_RADIUS * np.cos(np.radians(np.mean(lat)))
+    keep = np.zeros(count, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            # Distance to the segment, clamped to its end points.
+            t = np.clip((px * dx + py * dy) / length ** 2, 0, 1)
+            distances = np.hypot(px - t * dx, py - t * dy)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return np.flatnonzero(keep)
+
+
+def save_track(run, lat, lng, time, block_size):
+    """
+    Stores the track of a run, replacing the previous one. Returns the RunTrack.
+    """
+    track = RunTrack.query.filter_by(run_id=run.id).first() or RunTrack(run_id=run.id)
+    track.data = encode(lat, lng, time, block_size)
+    track.points = len(lat)
+    track.distance = haversine_distance(lat, lng)
+    db.session.add(track)
+    return track
@@ -1,10 +1,18 @@
 from functools import wraps
 
-from flask import abort, make_response, jsonify, request
-from flask_jwt_extended import get_jwt_claims, verify_jwt_in_request
+from flask import abort, make_response, jsonify, request, _request_ctx_stack
+from flask_jwt_extended import get_jwt_claims, get_raw_jwt, verify_jwt_in_request
+from flask_jwt_extended.config import config as jwt_config
+from flask_jwt_extended.utils import verify_token_not_blacklisted
 from flask_rest_jsonapi import JsonApiException
 
 from server.models import User
+from server.utils.token_cache import verified_tokens
+
+try:
+    from flask import _app_ctx_stack as jwt_ctx_stack
+except ImportError:  # pragma: no cover
+    jwt_ctx_stack = _request_ctx_stack
 
 
 def raise_permission_denied_exception(reason):
@@ -15,13 +23,50 @@ def raise_permission_denied_exception(reason):
         status='403')
 
 
+def verify_jwt_once():
+    """
+    Verifies the access token of the current request at most once per request.
+    Recently verified tokens are served from the claims cache, skipping the
+    signature check but still consulting the blacklist.
+    """
+    request_ctx = _request_ctx_stack.top
+    if getattr(request_ctx, 'jwt_verified', False):
+        return
+    raw_token = request.headers.get(jwt_config.header_name)
+    claims = verified_tokens.get(raw_token) if raw_token else None
+    if claims is not None:
+        verify_token_not_blacklisted(claims, 'access')
+        jwt_ctx_stack.top.jwt = claims
+    else:
+        verify_jwt_in_request()
+        if raw_token and request.method not in jwt_config.exempt_methods:
+            verified_tokens.put(raw_token, get_raw_jwt())
+    request_ctx.jwt_verified = True
+
+
+def jwt_required(fn):
+    """
+    Drop-in replacement of flask_jwt_extended's jwt_required backed by verify_jwt_once.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        verify_jwt_once()
+        return fn(*args, **kwargs)
+    return wrapper
+
+
 def get_user_from_jwt():
-    verify_jwt_in_request()
+    verify_jwt_once()
+    request_ctx = _request_ctx_stack.top
+    user = getattr(request_ctx, 'jwt_user', None)
+    if user is not None:
+        return user
     try:
         user_id = get_jwt_claims()['id']
-        user = User.query.filter_by(id=user_id).first()
+        user = User.query.filter_by(id=user_id, deleted_at=None).first()
         if not user:
             raise Exception
+        request_ctx.jwt_user = user
         return user
     except Exception as e:
         print(e)
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from server.models import db
+
+executor = None
+
+
+def _get_executor(app):
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=app.config.get('BACKGROUND_JOBS_THREADS', 2))
+    return executor
+
+
+def _run_in_app_context(app, fn, args):
+    with app.app_context():
+        try:
+            fn(*args)
+        except Exception:
+            app.logger.exception("Background job %s failed", fn.__name__)
+        finally:
+            db.session.remove()
+
+
+def run_in_background(fn, *args):
+    """
+    Runs fn(*args) according to BACKGROUND_JOBS_MODE: in the job queue run by
+    `manage.py worker` ('queue', fn must be a registered task), in a thread of
+    this process ('thread'), right away in the caller ('sync'), or not at all
+    ('deferred') leaving it to a manage.py command. Raises ValueError for
+    any other mode, rather than dropping the job.
+    """
+    app = current_app._get_current_object()
+    mode = app.config.get('BACKGROUND_JOBS_MODE', 'thread')
+    if mode == 'queue':
+        from server.jobs import enqueue
+
+        enqueue(fn, *args)
+    elif mode == 'sync':
+        try:
+            fn(*args)
+        except Exception:
+            # The caller's own work is committed already, the job is left to be resumed.
+            db.session.rollback()
+            app.logger.exception("Background job %s failed", fn.__name__)
+    elif mode == 'thread':
+        _get_executor(app).submit(_run_in_app_context, app, fn, args)
+    elif mode != 'deferred':
+        raise ValueError('Unknown BACKGROUND_JOBS_MODE {!r}'.format(mode))
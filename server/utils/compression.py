@@ -0,0 +1,197 @@
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import current_app, request
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        # wbits 31 writes the gzip header and trailer.
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        import brotli
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level):
+        import zstandard
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+COMPRESSORS = {'br': BrotliCompressor, 'zstd': ZstdCompressor, 'gzip': GzipCompressor}
+_available = None
+
+
+def available_encodings():
+    """
+    Encodings whose library is installed, brotli and zstandard are optional.
+    """
+    global _available
+    if _available is None:
+        available = {'gzip'}
+        for encoding, module in (('br', 'brotli'), ('zstd', 'zstandard')):
+            try:
+                __import__(module)
+                available.add(encoding)
+            except ImportError:
+                pass
+        _available = available
+    return _available
+
+
+def negotiate(accept_encoding, preference):
+    """
+    The encoding of `preference` (best first) with the highest quality in the
+    Accept-Encoding header, None when the client accepts none of them.
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in preference:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(compressor, data):
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_stream(compressor, chunks):
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressedCache:
+    """
+    LRU of compressed bodies keyed by (ETag, encoding, level), bounded by the
+    total size of the bodies.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body, max_size):
+        if len(body) > max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            self._size += len(body) - (len(previous) if previous is not None else 0)
+            self._entries[key] = body
+            while self._size > max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Compression:
+    """
+    Compresses the responses whose client accepts it, see the COMPRESSION_* settings.
+    """
+
+    def __init__(self):
+        self.cache = CompressedCache()
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        config = current_app.config
+        if not config['COMPRESSION_ENABLED']:
+            return response
+        levels = config['COMPRESSION_LEVELS'].get(response.mimetype)
+        response.vary.add('Accept-Encoding')
+        if levels is None or response.status_code < 200 or response.status_code in (204, 304) \
+                or response.direct_passthrough or 'Content-Encoding' in response.headers \
+                or 'no-transform' in response.headers.get('Cache-Control', ''):
+            return response
+        preference = [encoding for encoding in config['COMPRESSION_ENCODINGS']
+                      if encoding in available_encodings() and encoding in levels]
+        encoding = negotiate(request.headers.get('Accept-Encoding', ''), preference)
+        if encoding is None:
+            return response
+        level = levels[encoding]
+
+        if response.is_streamed:
+            response.response = compress_stream(COMPRESSORS[encoding](level), response.response)
+            response.headers.pop('Content-Length', None)
+        else:
+            if response.content_length is not None and response.content_length < config['COMPRESSION_MIN_SIZE']:
+                return response
+            body = self._compressed_body(response, encoding, level, config['COMPRESSION_CACHE_SIZE'])
+            response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def _compressed_body(self, response, encoding, level, cache_size):
+        if not cache_size:
+            return compress(COMPRESSORS[encoding](level), response.get_data())
+        etag, _ = response.get_etag()
+        if etag is None:
+            response.add_etag()
+            etag, _ = response.get_etag()
+        key = (etag, encoding, level)
+        body = self.cache.get(key)
+        if body is None:
+            body = compress(COMPRESSORS[encoding](level), response.get_data())
+            self.cache.put(key, body, cache_size)
+        # The compressed representation needs its own validator.
+        response.set_etag('{}-{}'.format(etag, encoding))
+        return body
+
+
+compression = Compression()
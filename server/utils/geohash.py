@@ -0,0 +1,79 @@
+###
+# Geohash encoding and covering of bounding boxes with geohash cells.
+###
+import math
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode(lat, lng, precision=12):
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        interval, coordinate = (lng_range, lng) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """
+    (height, width) in degrees of the cells of a precision.
+    """
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def successor(geohash):
+    """
+    The smallest geohash of the same length sorting after all the hashes
+    prefixed by `geohash`, None for the last one.
+    """
+    chars = list(geohash)
+    while chars:
+        index = BASE32.index(chars[-1])
+        if index + 1 < len(BASE32):
+            chars[-1] = BASE32[index + 1]
+            return ''.join(chars)
+        chars.pop()
+    return None
+
+
+def cover(min_lat, min_lng, max_lat, max_lng, max_cells=32):
+    """
+    Geohash prefixes of the cells covering the bounding box, using the longest
+    precision which needs at most `max_cells` cells.
+    """
+    for precision in range(12, 0, -1):
+        height, width = cell_size(precision)
+        rows = range(math.floor((min_lat + 90) / height), math.floor((max_lat + 90) / height) + 1)
+        columns = range(math.floor((min_lng + 180) / width), math.floor((max_lng + 180) / width) + 1)
+        if len(rows) * len(columns) <= max_cells or precision == 1:
+            return sorted({encode(min(90.0, (row + 0.5) * height - 90), min(180.0, (column + 0.5) * width - 180),
+                                  precision)
+                           for row in rows for column in columns})
+
+
+def prefix_ranges(prefixes):
+    """
+    Merges sorted prefixes into [start, end) string ranges, end None when unbounded.
+    """
+    ranges = []
+    for prefix in prefixes:
+        end = successor(prefix)
+        if ranges and ranges[-1][1] == prefix:
+            ranges[-1][1] = end
+        else:
+            ranges.append([prefix, end])
+    return ranges
@@ -0,0 +1,112 @@
+import hashlib
+import zlib
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy.exc import IntegrityError
+
+from server.models import db, IdempotencyKey
+from server.utils.auth_utils import verify_jwt_once
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+def _digest(*parts):
+    return hashlib.sha256(b'\0'.join(part.encode('utf-8') if isinstance(part, str) else part
+                                     for part in parts)).hexdigest()
+
+
+def _claim(key, fingerprint):
+    """
+    Inserts the in-progress entry of the key. Returns None when claimed,
+    otherwise the entry of the earlier request with the same key.
+    """
+    now = datetime.utcnow()
+    for _ in range(2):
+        try:
+            db.session.add(IdempotencyKey(key=key, fingerprint=fingerprint, expires_at=now + timedelta(
+                seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])))
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+        entry = IdempotencyKey.query.filter_by(key=key).first()
+        if entry is None:
+            continue
+        stale = now - timedelta(seconds=current_app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+        if entry.expires_at > now and not (entry.status is None and entry.created_at < stale):
+            return entry
+        # Expired, or left in progress by a request which never completed: taken over
+        # unless another retry got there first.
+        IdempotencyKey.query.filter_by(id=entry.id, created_at=entry.created_at).delete()
+        db.session.commit()
+    return IdempotencyKey.query.filter_by(key=key).first()
+
+
+def _replay(entry):
+    response = make_response(zlib.decompress(entry.body) if entry.body else b'', entry.status)
+    if entry.content_type:
+        response.headers['Content-Type'] = entry.content_type
+    if entry.location:
+        response.headers['Location'] = entry.location
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _release(key):
+    db.session.rollback()
+    IdempotencyKey.query.filter_by(key=key, status=None).delete()
+    db.session.commit()
+
+
+def idempotent(fn):
+    """
+    Makes POST requests with an Idempotency-Key header safe to retry: the
+    response of the first request with a key is stored and returned to the
+    retries with the same key and body without running the view again. A retry
+    arriving while the first request is still running gets a 409. Responses
+    with a 5xx status are not stored, so the request can be retried.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(HEADER)
+        if request.method != 'POST' or client_key is None:
+            return fn(*args, **kwargs)
+        if not client_key or len(client_key) > MAX_KEY_LENGTH:
+            return jsonify({"message": "{} must have 1 to {} characters".format(HEADER, MAX_KEY_LENGTH)}), 400
+        verify_jwt_once()
+        key = _digest(str(get_jwt_identity()), request.path, client_key)
+        fingerprint = _digest(request.get_data())
+
+        entry = _claim(key, fingerprint)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                return jsonify({"message": "{} was already used for another request".format(HEADER)}), 422
+            if entry.status is None:
+                response = make_response(jsonify({"message": "A request with this {} is in progress".format(
+                    HEADER)}), 409)
+                response.headers['Retry-After'] = '1'
+                return response
+            return _replay(entry)
+
+        try:
+            response = make_response(fn(*args, **kwargs))
+        except Exception:
+            _release(key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            _release(key)
+            return response
+        db.session.rollback()
+        IdempotencyKey.query.filter_by(key=key).update({
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type'),
+            'location': response.headers.get('Location'),
+            'body': zlib.compress(response.get_data()),
+        })
+        db.session.commit()
+        return response
+    return wrapper
@@ -0,0 +1,153 @@
+###
+# Bulk user provisioning
+###
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt as bcrypt_lib
+from flask import current_app
+from marshmallow_jsonapi.exceptions import IncorrectTypeError
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from server.models import db, roles_registry, roles_users, User
+from server.schemas import UserSchema
+
+CONFLICT = "The user_id or email already exists."
+
+
+def _hash_password(password, rounds):
+    return bcrypt_lib.hashpw(password.encode('utf-8'), bcrypt_lib.gensalt(rounds)).decode('utf-8')
+
+
+def hash_passwords(passwords, rounds, processes=None):
+    """
+    Hashes the passwords across a process pool, bcrypt is CPU bound.
+    """
+    if len(passwords) < current_app.config.get('BULK_PROVISIONING_POOL_THRESHOLD', 16):
+        return [_hash_password(password, rounds) for password in passwords]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        chunksize = max(1, len(passwords) // ((processes or os.cpu_count() or 1) * 4))
+        return list(pool.map(_hash_password, passwords, [rounds] * len(passwords), chunksize=chunksize))
+
+
+def _result(index, user_id, status, title=None, detail=None):
+    result = {'index': index, 'id': user_id, 'status': status}
+    if title is not None:
+        result['title'] = title
+    if detail is not None:
+        result['detail'] = detail
+    return result
+
+
+def _validate(rows, allow_privileged):
+    """
+    Loads the rows through the UserSchema. Returns the per-row results of the
+    invalid rows and the (index, data) pairs of the valid ones.
+    """
+    schema = UserSchema()
+    privileged_roles = roles_registry.privileged_names()
+    known_roles = roles_registry.names()
+    results, valid = {}, []
+    for index, row in enumerate(rows):
+        user_id = row.get('id') if isinstance(row, dict) else None
+        try:
+            data, errors = schema.load({'data': row})
+        except IncorrectTypeError as e:
+            results[index] = _result(index, user_id, '422', 'Validation error', str(e))
+            continue
+        if errors:
+            details = [error['detail'] for error in errors.get('errors', [])]
+            results[index] = _result(index, user_id, '422', 'Validation error', details)
+            continue
+        data.setdefault('roles', ['user'])
+        unknown = [role for role in data['roles'] if role not in known_roles]
+        if not data.get('id'):
+            results[index] = _result(index, user_id, '422', 'Validation error', "The user id is required.")
+        elif unknown:
+            results[index] = _result(index, user_id, '422', 'Invalid roles',
+                                     "Unknown roles: {}".format(", ".join(unknown)))
+        elif not allow_privileged and not privileged_roles.isdisjoint(data['roles']):
+            results[index] = _result(index, user_id, '403', 'Permission denied',
+                                     "Only admins can create users with privileged roles")
+        else:
+            valid.append((index, data))
+    return results, valid
+
+
+def _find_conflicts(valid):
+    """
+    Splits off the rows whose id or email exists already or repeats in the batch.
+    """
+    ids = [data['id'] for _, data in valid]
+    emails = [data['email'] for _, data in valid if data.get('email')]
+    existing = db.session.query(User.id, User.email).filter(
+        or_(User.id.in_(ids), User.email.in_(emails))).all()
+    taken_ids = {user_id for user_id, _ in existing}
+    taken_emails = {email for _, email in existing if email}
+    accepted, conflicts = [], []
+    for index, data in valid:
+        email = data.get('email')
+        if data['id'] in taken_ids or (email and email in taken_emails):
+            conflicts.append(index)
+            continue
+        taken_ids.add(data['id'])
+        if email:
+            taken_emails.add(email)
+        accepted.append((index, data))
+    return accepted, conflicts
+
+
+def _user_row(data, password_hash):
+    return {
+        'id': data['id'],
+        'first_name': data.get('first_name'),
+        'last_name': data.get('last_name'),
+        'email': data.get('email'),
+        'password': password_hash,
+        'active': data.get('active', True),
+    }
+
+
+def _insert(users, role_links):
+    db.session.execute(User.__table__.insert(), users)
+    if role_links:
+        db.session.execute(roles_users.insert(), role_links)
+
+
+def _role_links(user_id, roles):
+    return [{'user_id': user_id, 'role_id': role_id} for role_id in roles_registry.role_ids(roles)]
+
+
+def provision_users(rows, allow_privileged=False, processes=None):
+    """
+    Creates users in bulk from JSON:API resource objects. Rows which fail
+    validation or conflict with existing users are reported and skipped, the
+    others are inserted together. Returns the per-row results.
+    """
+    results, valid = _validate(rows, allow_privileged)
+    accepted, conflicts = _find_conflicts(valid) if valid else ([], [])
+    for index in conflicts:
+        results[index] = _result(index, rows[index].get('id'), '409', CONFLICT)
+
+    rounds = int(os.getenv('BCRYPT_LOG_ROUNDS') or current_app.config['BCRYPT_LOG_ROUNDS'])
+    hashes = hash_passwords([data['password'] for _, data in accepted], rounds, processes)
+    users = [_user_row(data, password_hash) for (_, data), password_hash in zip(accepted, hashes)]
+    role_links = [link for _, data in accepted for link in _role_links(data['id'], data['roles'])]
+    try:
+        _insert(users, role_links)
+        db.session.commit()
+        for index, data in accepted:
+            results[index] = _result(index, data['id'], '201')
+    except IntegrityError:
+        # Users created concurrently, fall back to one savepoint per row.
+        db.session.rollback()
+        for (index, data), user in zip(accepted, users):
+            try:
+                with db.session.begin_nested():
+                    _insert([user], _role_links(data['id'], data['roles']))
+                results[index] = _result(index, data['id'], '201')
+            except IntegrityError:
+                results[index] = _result(index, data['id'], '409', CONFLICT)
+        db.session.commit()
+    return [results[index] for index in range(len(rows))]
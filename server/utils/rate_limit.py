@@ -0,0 +1,149 @@
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from importlib import import_module
+
+
+class BucketStore(ABC):
+    """
+    Storage of token buckets. Implementations must make consume() atomic.
+    """
+
+    @abstractmethod
+    def consume(self, key, capacity, refill_rate):
+        """
+        Takes one token from the bucket at `key`, refilled at `refill_rate` tokens
+        per second up to `capacity`. Returns 0 when a token was taken, otherwise the
+        number of seconds until one becomes available.
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Drops all the buckets of the store.
+        """
+
+
+class InMemoryBucketStore(BucketStore):
+    """
+    Per-process store, every worker keeps its own buckets. Beyond `max_keys`
+    buckets the least recently used one is dropped, it starts full if its key
+    comes back.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+            wait = (1 - tokens) / refill_rate if tokens < 1 else 0
+            self._buckets[key] = (tokens if wait else tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBucketStore(BucketStore):
+    """
+    Store shared by all the workers, kept in Redis. Requires the `redis` package.
+    """
+    CONSUME_SCRIPT = """
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+    local capacity = tonumber(ARGV[1])
+    local refill_rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated_at) * refill_rate)
+    local wait = 0
+    if tokens < 1 then
+        wait = (1 - tokens) / refill_rate
+    else
+        tokens = tokens - 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_rate))
+    return tostring(wait)
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='login_rate_limit:'):
+        import redis
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+        self._consume = self._redis.register_script(self.CONSUME_SCRIPT)
+
+    def consume(self, key, capacity, refill_rate):
+        return float(self._consume(keys=[self.prefix + key], args=[capacity, refill_rate, time.time()]))
+
+    def clear(self):
+        keys = list(self._redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self._redis.delete(*keys)
+
+
+def load_store(path, options=None, prefix=None):
+    """
+    Creates the BucketStore of a dotted class path, e.g. LOGIN_RATE_LIMIT_STORE.
+    The keys of a RedisBucketStore get `prefix` unless `options` has one.
+    """
+    module_name, class_name = path.rsplit('.', 1)
+    store_class = getattr(import_module(module_name), class_name)
+    options = dict(options or {})
+    if prefix is not None and issubclass(store_class, RedisBucketStore):
+        options.setdefault('prefix', prefix)
+    return store_class(**options)
+
+
+def wait_for_token(store, key, capacity, period):
+    """
+    Blocks until the bucket at `key`, of `capacity` tokens per `period` seconds, gives a token.
+    """
+    while True:
+        wait = store.consume(key, capacity, capacity / period)
+        if not wait:
+            return
+        time.sleep(wait)
+
+
+class LoginRateLimiter:
+    """
+    Token-bucket limiter of login attempts, keyed per user_id and per client IP.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+
+    def init_app(self, app):
+        if self.store is None:
+            store_class = app.config.get('LOGIN_RATE_LIMIT_STORE', 'server.utils.rate_limit.InMemoryBucketStore')
+            self.store = load_store(store_class, app.config.get('LOGIN_RATE_LIMIT_STORE_OPTIONS', {}))
+
+    def retry_after(self, config, user_id, ip_address):
+        """
+        Consumes one attempt for the IP and the user. Returns the seconds to wait
+        before retrying, or 0 when the attempt is allowed.
+        """
+        if not config.get('LOGIN_RATE_LIMIT_ENABLED', True):
+            return 0
+        limits = [('ip:' + str(ip_address), config['LOGIN_RATE_LIMIT_PER_IP'])]
+        if user_id:
+            limits.append(('user:' + str(user_id), config['LOGIN_RATE_LIMIT_PER_USER']))
+        for key, (capacity, period) in limits:
+            wait = self.store.consume(key, capacity, capacity / period)
+            if wait:
+                return int(math.ceil(wait))
+        return 0
+
+
+login_rate_limiter = LoginRateLimiter()
@@ -0,0 +1,199 @@
+"""
+Hash sharding of the run table by user_id across the databases of RUNS_SHARDS.
+
+RUNS_SHARDS lists bind keys of SQLALCHEMY_BINDS. When it's set, the sessions of
+the app are ShardedSignallingSessions: the rows of SHARDED_TABLES live in the
+shard of their user and every other table stays in the main database. Queries
+on runs go to the shard of the user_id they compare with, or to all shards.
+"""
+import zlib
+
+from flask_sqlalchemy import BaseQuery, SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.orm import object_session, Query
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.util import find_tables
+
+# Identity token and shard id of the rows of the main database.
+MAIN = 'main'
+# Tables split across the shards, all of them with a user_id column.
+SHARDED_TABLES = frozenset(['run'])
+
+
+class ShardingError(Exception):
+    pass
+
+
+def shard_for(user_id, shards):
+    """
+    The shard of the runs of a user among the bind keys `shards`, None without
+    shards. crc32 keeps the placement stable across processes, unlike hash().
+    """
+    if not shards:
+        return None
+    return shards[zlib.crc32(user_id.encode('utf-8')) % len(shards)]
+
+
+def is_sharded(mapper):
+    return mapper is not None and mapper.persist_selectable.name in SHARDED_TABLES
+
+
+def sharded_tables(clause):
+    if clause is None:
+        return set()
+    return {table.name for table in find_tables(clause, include_crud=True)} & SHARDED_TABLES
+
+
+def user_ids(clause):
+    """
+    The values `clause` compares for equality with the user_id of a sharded table.
+    """
+    values = set()
+    for element in visitors.iterate(clause, {}):
+        if not isinstance(element, BinaryExpression) or element.operator is not operators.eq:
+            continue
+        for column, value in ((element.left, element.right), (element.right, element.left)):
+            table = getattr(column, 'table', None)
+            if (getattr(column, 'name', None) == 'user_id' and getattr(table, 'name', None) in SHARDED_TABLES
+                    and isinstance(value, BindParameter)):
+                values.add(value.effective_value)
+    return values
+
+
+def main_connection(target, connection):
+    """
+    The connection to the main database in the transaction of `target`, which
+    listeners of sharded models use for the tables of the main database.
+    `connection`, that of the flush, otherwise.
+    """
+    session = object_session(target)
+    if isinstance(session, ShardedSignallingSession):
+        return session.connection(shard_id=MAIN)
+    return connection
+
+
+class ShardedSignallingSession(SignallingSession, ShardedSession):
+    """
+    Session of the app when RUNS_SHARDS is set. Rows of sharded tables get the
+    shard of their user_id as identity token, all others MAIN.
+    """
+
+    def __init__(self, db, shards, **options):
+        SignallingSession.__init__(self, db, **options)
+        self.shards = list(shards)
+        self.shard_chooser = self.choose_shard
+        self.id_chooser = self.choose_id_shards
+        self.query_chooser = self.choose_query_shards
+        self.connection_callable = self.connection
+        self._engines = {shard: db.get_engine(self.app, bind=shard) for shard in self.shards}
+
+    def route(self, mapper, statement):
+        """
+        Shards a statement runs on: MAIN for the tables of the main database,
+        otherwise the shard of the user it's restricted to, or all shards.
+        """
+        if not is_sharded(mapper) and not sharded_tables(statement):
+            return [MAIN]
+        shards = {shard_for(user_id, self.shards) for user_id in user_ids(statement)} if statement is not None else ()
+        return [shard for shard in self.shards if shard in shards] or list(self.shards)
+
+    def choose_shard(self, mapper, instance, clause=None):
+        if instance is not None and is_sharded(mapper):
+            if instance.user_id is None:
+                raise ShardingError("{} without a user can't be stored in a shard".format(mapper.class_.__name__))
+            return shard_for(instance.user_id, self.shards)
+        shards = self.route(mapper, clause)
+        if len(shards) > 1:
+            raise ShardingError('Statement on sharded tables without a user_id, use a query or set_shard()')
+        return shards[0]
+
+    def choose_id_shards(self, query, ident):
+        return list(self.shards) if is_sharded(query._bind_mapper()) else [MAIN]
+
+    def choose_query_shards(self, query):
+        return self.route(query._bind_mapper(), query.statement)
+
+    def get_bind(self, mapper=None, shard_id=None, instance=None, clause=None, **kw):
+        if shard_id is None:
+            shard_id = self._choose_shard_and_assign(mapper, instance, clause=clause)
+        if shard_id == MAIN:
+            return SignallingSession.get_bind(self, mapper, clause)
+        return self._engines[shard_id]
+
+
+class ShardAwareQuery(BaseQuery, ShardedQuery):
+    """
+    Query class of the models, executed on the shards chosen by its session
+    when that is sharded, as a plain query otherwise. The results of several
+    shards are concatenated, see server.sharding.gather() for ordered pages.
+    """
+
+    def __init__(self, entities, session=None):
+        Query.__init__(self, entities, session)
+        self._shard_id = None
+
+    @property
+    def sharded(self):
+        return isinstance(self.session, ShardedSignallingSession)
+
+    @property
+    def id_chooser(self):
+        return self.session.id_chooser
+
+    @property
+    def query_chooser(self):
+        return self.session.query_chooser
+
+    def _execute_and_instances(self, context):
+        if not self.sharded:
+            return Query._execute_and_instances(self, context)
+
+        def iter_for_shard(shard_id):
+            context.attributes['shard_id'] = context.identity_token = shard_id
+            result = self._connection_from_session(
+                mapper=self._bind_mapper(), shard_id=shard_id).execute(context.statement, self._params)
+            return self.instances(result, context)
+
+        shard_id = context.identity_token or self._shard_id
+        if shard_id is not None:
+            return iter_for_shard(shard_id)
+        partial = []
+        # Routed on the compiled statement, query.statement would compile it again.
+        for shard_id in self.session.route(self._bind_mapper(), context.statement):
+            partial.extend(iter_for_shard(shard_id))
+        return iter(partial)
+
+    def _execute_crud(self, stmt, mapper):
+        if not self.sharded:
+            return Query._execute_crud(self, stmt, mapper)
+        return ShardedQuery._execute_crud(self, stmt, mapper)
+
+    def _identity_lookup(self, mapper, primary_key_identity, identity_token=None, **kw):
+        if not self.sharded:
+            return Query._identity_lookup(self, mapper, primary_key_identity, identity_token=identity_token, **kw)
+        return ShardedQuery._identity_lookup(self, mapper, primary_key_identity, identity_token=identity_token, **kw)
+
+    def _get_impl(self, primary_key_identity, db_load_fn, identity_token=None):
+        if not self.sharded:
+            return Query._get_impl(self, primary_key_identity, db_load_fn, identity_token=identity_token)
+        return ShardedQuery._get_impl(self, primary_key_identity, db_load_fn, identity_token=identity_token)
+
+
+class ShardingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy creating sharded sessions for apps with RUNS_SHARDS.
+    """
+
+    def create_session(self, options):
+        plain = orm.sessionmaker(class_=SignallingSession, db=self, **options)
+        sharded = orm.sessionmaker(class_=ShardedSignallingSession, db=self, **options)
+
+        def session_factory(**kwargs):
+            config = self.get_app().config
+            if config.get('RUNS_SHARDS'):
+                kwargs.setdefault('twophase', config.get('RUNS_SHARDS_TWOPHASE', False))
+                return sharded(shards=config['RUNS_SHARDS'], **kwargs)
+            return plain(**kwargs)
+        return session_factory
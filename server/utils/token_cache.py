@@ -0,0 +1,65 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of recently verified tokens, keyed by the digest of the raw
+    Authorization header and holding the decoded claims until the token expires.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(raw_token):
+        return hashlib.sha256(raw_token.encode('utf-8')).digest()
+
+    @staticmethod
+    def _max_size():
+        return current_app.config.get('JWT_VERIFIED_TOKEN_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+
+    def get(self, raw_token):
+        key = self._digest(raw_token)
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is None:
+                return None
+            expires = claims.get('exp')
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, raw_token, claims):
+        max_size = self._max_size()
+        if not max_size or not claims:
+            return
+        key = self._digest(raw_token)
+        with self._lock:
+            self._entries[key] = claims
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, raw_token):
+        with self._lock:
+            self._entries.pop(self._digest(raw_token), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+verified_tokens = VerifiedTokenCache()
@@ -0,0 +1,31 @@
+from contextlib import contextmanager
+
+from server.models import db
+
+# Key of session.info set while single_transaction() is in progress.
+IN_SINGLE_TRANSACTION = 'single_transaction'
+
+
+@contextmanager
+def single_transaction():
+    """
+    Turns the commits of the data layers and resource hooks into flushes, so
+    that the transaction is committed once at the end, or rolled back entirely.
+    """
+    session = db.session()
+    session.commit = session.flush
+    session.info[IN_SINGLE_TRANSACTION] = True
+    try:
+        try:
+            yield
+        finally:
+            del session.commit
+            session.info.pop(IN_SINGLE_TRANSACTION, None)
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+
+
+def in_single_transaction():
+    return db.session.info.get(IN_SINGLE_TRANSACTION, False)
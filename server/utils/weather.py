@@ -1,6 +1,6 @@
+import calendar
 import os
-
-import pyowm
+import time
 
 owm = None
 
@@ -8,6 +8,8 @@ owm = None
 def get_owm_client():
     global owm
     if owm is None:
+        # pyowm is slow to import, it's loaded on the first weather lookup.
+        import pyowm
         api_key = os.getenv('OWM_API_KEY')
         assert api_key is not None
         owm = pyowm.OWM(api_key)
@@ -18,3 +20,19 @@ def get_current_weather_at_location(lat, lng):
     client = get_owm_client()
     weather_result = client.weather_at_coords(lat, lng).get_weather()
     return weather_result.to_JSON()
+
+
+def get_weather_at_time(lat, lng, when):
+    """
+    Weather at a location and UTC time: the current weather for the last hour,
+    otherwise the closest observation of the hour around `when` from the history
+    API. Returns None when the history has no observation for it.
+    """
+    timestamp = int(calendar.timegm(when.timetuple()))
+    if time.time() - timestamp < 3600:
+        return get_current_weather_at_location(lat, lng)
+    history = get_owm_client().weather_history_at_coords(lat, lng, start=timestamp - 3600, end=timestamp + 3600)
+    if not history:
+        return None
+    closest = min(history, key=lambda weather: abs(weather.get_reference_time() - timestamp))
+    return closest.to_JSON()
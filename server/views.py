@@ -1,14 +1,33 @@
-from flask import Blueprint, request, make_response, jsonify
+import csv
+import io
+import json
+
+from flask import Blueprint, Response, current_app, request, make_response, jsonify, stream_with_context
 from flask_jwt_extended import (
-    JWTManager, jwt_required, create_access_token,
-    get_raw_jwt)
+    JWTManager, create_access_token, create_refresh_token, decode_token,
+    get_jwt_identity, get_raw_jwt, jwt_refresh_token_required)
+from flask_rest_jsonapi import JsonApiException
+from flask_rest_jsonapi.utils import JSONEncoder
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import undefer
 
 
-from server.models import User, BlacklistToken, user_datastore
-from server.resources import api, UserList, UserDetail, RunsList, RunDetail, WeeklySummary
+from server.archive import iter_runs
+from server.models import db, User, BlacklistToken, Run, RunTrack, UserDeletion, user_datastore
+from server.resources import api, time_range_args, UserList, UserDetail, RunsList, RunDetail, WeeklySummary
+from server.schemas import RunSchema
+from server.utils.auth_utils import get_user_from_jwt, jwt_required
+from server.utils.idempotency import idempotent
+from server.utils.provisioning import provision_users
+from server.utils.rate_limit import login_rate_limiter
+from server.utils.token_cache import verified_tokens
+from server import changes, events, operations, records, sharding, spatial, warmup
 
 auth_blueprint = Blueprint('/auth', __name__)
+health_blueprint = Blueprint('/health', __name__)
+users_blueprint = Blueprint('/users', __name__)
+runs_blueprint = Blueprint('/runs', __name__)
+operations_blueprint = Blueprint('/operations', __name__)
 jwt = JWTManager()
 
 
@@ -26,20 +45,39 @@ def user_identity_lookup(user):
 
 @jwt.token_in_blacklist_loader
 def check_if_token_in_blacklist(decrypted_token):
+    watermark = current_app.config.get('JWT_REVOCATION_WATERMARK')
+    if watermark is not None and decrypted_token.get('iat', 0) < watermark:
+        # Everything issued before the watermark is revoked, no lookup needed.
+        return True
     jti = decrypted_token['jti']
     return BlacklistToken.check_blacklist(jti)
 
 
+def create_token_pair(user):
+    return {
+        'auth_token': create_access_token(identity=user),
+        'refresh_token': create_refresh_token(identity=user)
+    }
+
+
 @auth_blueprint.route('/login', methods=["POST"])
 def login():
     post_data = request.get_json()
-    user = user_datastore.find_user(id=post_data.get('user_id'))
+    retry_after = login_rate_limiter.retry_after(current_app.config, post_data.get('user_id'), request.remote_addr)
+    if retry_after:
+        response_object = {
+            'status': 'fail',
+            'message': 'Too many login attempts.'
+        }
+        response = make_response(jsonify(response_object), 429)
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    user = user_datastore.find_user(id=post_data.get('user_id'), deleted_at=None)
     if user and user.verify_password(post_data.get('password')):
-        access_token = create_access_token(identity=user)
         response_object = {
             'status': 'success',
             'message': 'User successfully logged in.',
-            'auth_token': access_token
+            **create_token_pair(user)
         }
         return make_response(jsonify(response_object)), 200
     else:
@@ -50,18 +88,362 @@ def login():
         return make_response(jsonify(response_object)), 404
 
 
+@auth_blueprint.route('/refresh', methods=["POST"])
+@jwt_refresh_token_required
+def refresh():
+    """
+    Rotates the refresh token: the presented one is revoked and a new pair is issued.
+    """
+    user = user_datastore.find_user(id=get_jwt_identity(), deleted_at=None)
+    if not user:
+        response_object = {
+            'status': 'fail',
+            'message': 'User does not exist.'
+        }
+        return make_response(jsonify(response_object)), 404
+    try:
+        BlacklistToken.from_decoded_token(get_raw_jwt()).save()
+    except IntegrityError:
+        # The same refresh token was rotated concurrently.
+        db.session.rollback()
+        return jsonify({"message": "Token has been revoked"}), 401
+    response_object = {
+        'status': 'success',
+        'message': 'Token successfully refreshed.',
+        **create_token_pair(user)
+    }
+    return make_response(jsonify(response_object)), 200
+
+
 @auth_blueprint.route('/logout', methods=["POST"])
 @jwt_required
 def logout():
-    jti = get_raw_jwt()['jti']
-    blacklist_entry = BlacklistToken(token=jti)
+    blacklist_entry = BlacklistToken.from_decoded_token(get_raw_jwt())
+    post_data = request.get_json(silent=True) or {}
     try:
         blacklist_entry.save()
+        verified_tokens.discard(request.headers.get('Authorization'))
+        if post_data.get('refresh_token'):
+            refresh_token = decode_token(post_data['refresh_token'], allow_expired=True)
+            if refresh_token['identity'] == get_jwt_identity():
+                BlacklistToken.from_decoded_token(refresh_token).save()
         return jsonify({"message": "Logged out successfully"}), 200
     except IntegrityError as e:
+        db.session.rollback()
         return jsonify({"message": "Already logged out"}), 200
 
 
+@users_blueprint.route('/bulk', methods=["POST"])
+@jwt_required
+@idempotent
+def bulk_create_users():
+    """
+    Creates many users at once, reporting the outcome of every row.
+    """
+    user = get_user_from_jwt()
+    if not user.is_privileged():
+        return jsonify({"message": "Only admins and user managers can create users in bulk"}), 403
+    rows = (request.get_json(silent=True) or {}).get('data')
+    if not isinstance(rows, list) or not rows:
+        return jsonify({"message": "Expected a list of user resource objects in data"}), 422
+    max_rows = current_app.config['BULK_PROVISIONING_MAX_ROWS']
+    if len(rows) > max_rows:
+        return jsonify({"message": "At most {} users can be created at once".format(max_rows)}), 413
+    results = provision_users(rows, allow_privileged=user.has_role("admin"),
+                              processes=current_app.config['BULK_PROVISIONING_PROCESSES'])
+    created = sum(1 for result in results if result['status'] == '201')
+    return jsonify({"data": results, "meta": {"created": created, "failed": len(results) - created}}), 200
+
+
+@users_blueprint.route('/deletions/<int:deletion_id>', methods=["GET"])
+@jwt_required
+def user_deletion_progress(deletion_id):
+    """
+    Progress of the background removal of a deleted user.
+    """
+    if not get_user_from_jwt().is_privileged():
+        return jsonify({"message": "User doesn't have permission to access the resource."}), 403
+    deletion = UserDeletion.query.get(deletion_id)
+    if deletion is None:
+        return jsonify({"message": "Deletion {} not found".format(deletion_id)}), 404
+    return jsonify({"data": deletion.to_dict()}), 200
+
+
+# Largest radius in meters of the nearby search.
+MAX_RADIUS = 100000
+
+EXPORT_COLUMNS = ['id', 'start_time', 'end_time', 'date', 'distance', 'duration',
+                  'start_lat', 'start_lng', 'end_lat', 'end_lng', 'weather_info']
+
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    for index, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if index % 1000 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@runs_blueprint.route('/export', methods=["GET"])
+@jwt_required
+def export_runs():
+    """
+    Streams all runs of the user as CSV, including the archived ones. Admins
+    can export the runs of another user with `user_id`.
+    """
+    user = get_user_from_jwt()
+    user_id = request.args.get('user_id', user.id)
+    if user_id != user.id and not user.has_role("admin"):
+        return jsonify({"message": "User doesn't have permission to access the resource."}), 403
+    return Response(stream_with_context(export_csv(iter_runs(user_id))), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=runs.csv'})
+
+
+def get_own_run(run_id):
+    """
+    Returns (run, None) or (None, error response) for the run of the track endpoints.
+    """
+    run = Run.query.get(run_id)
+    if run is None:
+        return None, (jsonify({"message": "Run {} not found".format(run_id)}), 404)
+    if not RunDetail.is_self_run_or_admin_role(run_id, run):
+        return None, (jsonify({"message": "User doesn't have permission to access the resource."}), 403)
+    return run, None
+
+
+@runs_blueprint.route('/<int:run_id>/track', methods=["PUT"])
+@jwt_required
+def upload_track(run_id):
+    """
+    Stores the GPS track of a run, given as {"points": [[lat, lng, unix time], ...]}.
+    The distance of the run is set to the length of the track.
+    """
+    from server import tracks
+
+    run, error = get_own_run(run_id)
+    if error:
+        return error
+    try:
+        lat, lng, time = tracks.parse_points((request.get_json(silent=True) or {}).get('points'),
+                                             current_app.config['TRACK_MAX_POINTS'])
+    except tracks.TrackError as e:
+        return jsonify({"message": str(e)}), 422
+    track = tracks.save_track(run, lat, lng, time, current_app.config['TRACK_BLOCK_SIZE'])
+    run.distance = int(round(track.distance))
+    db.session.commit()
+    return jsonify({"data": {"type": "track", "id": run_id, "attributes": {
+        "points": track.points, "distance": track.distance, "bytes": len(track.data)}}}), 200
+
+
+@runs_blueprint.route('/<int:run_id>/track', methods=["GET"])
+@jwt_required
+def get_track(run_id):
+    """
+    Returns the points [start, end) of the track of a run, simplified to
+    `tolerance` meters when given.
+    """
+    from server import tracks
+
+    run, error = get_own_run(run_id)
+    if error:
+        return error
+    track = RunTrack.query.filter_by(run_id=run_id).first()
+    if track is None:
+        return jsonify({"message": "Run {} has no track".format(run_id)}), 404
+    try:
+        start = int(request.args.get('start', 0))
+        end = int(request.args['end']) if 'end' in request.args else None
+        tolerance = float(request.args.get('tolerance', 0))
+    except ValueError:
+        return jsonify({"message": "start and end must be integers and tolerance a number"}), 400
+    lat, lng, time = tracks.decode(track.data, start, end)
+    keep = tracks.simplify(lat, lng, tolerance)
+    points = tracks.to_points(lat[keep], lng[keep], time[keep])
+    return jsonify({"data": {"type": "track", "id": run_id, "attributes": {"points": points}},
+                    "meta": {"points": track.points, "distance": track.distance, "returned": len(points)}}), 200
+
+
+def spatial_query():
+    """
+    Returns (query, limit) or (None, error response) for the spatial endpoints.
+    Admins search all runs, other users their own.
+    """
+    max_results = current_app.config['RUNS_SPATIAL_MAX_RESULTS']
+    limit = request.args.get('limit', str(max_results))
+    if not limit.isdigit() or not 1 <= int(limit) <= max_results:
+        return None, (jsonify({"message": "limit must be between 1 and {}".format(max_results)}), 400)
+    user = get_user_from_jwt()
+    query = Run.query.options(undefer(Run.weather_info))
+    if not user.has_role("admin"):
+        query = query.filter(Run.user_id == user.id)
+    return (query, int(limit)), None
+
+
+def parse_floats(value, count):
+    try:
+        values = [float(part) for part in value.split(',')]
+    except ValueError:
+        return None
+    return values if len(values) == count else None
+
+
+@runs_blueprint.route('/nearby', methods=["GET"])
+@jwt_required
+def nearby_runs():
+    """
+    Runs starting within `radius` meters (default 1000) of `lat`/`lng`, closest first.
+    """
+    search, error = spatial_query()
+    if error:
+        return error
+    point = spatial.parse_point(request.args.get('lat'), request.args.get('lng'))
+    radius = parse_floats(request.args.get('radius', '1000'), 1)
+    if point is None or radius is None or not 0 < radius[0] <= MAX_RADIUS:
+        return jsonify({"message": "lat and lng must be valid coordinates and radius "
+                                   "between 0 and {} meters".format(MAX_RADIUS)}), 400
+    query, limit = search
+    matches = spatial.nearby(query, point[0], point[1], radius[0], limit)
+    return jsonify({"data": RunSchema(many=True).dump([run for run, _ in matches]).data["data"],
+                    "meta": {"count": len(matches),
+                             "distances": {str(run.id): round(meters, 1) for run, meters in matches}}}), 200
+
+
+@runs_blueprint.route('/within', methods=["GET"])
+@jwt_required
+def runs_within():
+    """
+    Runs starting inside `bbox=min_lat,min_lng,max_lat,max_lng`, in id order.
+    """
+    search, error = spatial_query()
+    if error:
+        return error
+    bbox = parse_floats(request.args.get('bbox', ''), 4)
+    if bbox is None or None in (spatial.parse_point(*bbox[:2]), spatial.parse_point(*bbox[2:])) \
+            or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        return jsonify({"message": "bbox must be min_lat,min_lng,max_lat,max_lng"}), 400
+    query, limit = search
+    query = spatial.within_bbox(query, *bbox)
+    if sharding.spans_shards(query):
+        _, runs, _ = sharding.gather(query, [(Run.id, 'asc')], limit)
+    else:
+        runs = query.order_by(Run.id).limit(limit).all()
+    return jsonify({"data": RunSchema(many=True).dump(runs).data["data"], "meta": {"count": len(runs)}}), 200
+
+
+@runs_blueprint.route('/changes', methods=["GET"])
+@jwt_required
+def run_changes():
+    """
+    Runs created or updated and ids of runs deleted after the `since` token
+    (0 for a full sync), with the token to pass next in `meta.next`. Admins
+    can read the changes of another user with `user_id`.
+    """
+    user = get_user_from_jwt()
+    user_id = request.args.get('user_id', user.id)
+    if user_id != user.id and not user.has_role("admin"):
+        return jsonify({"message": "User doesn't have permission to access the resource."}), 403
+    since, limit = request.args.get('since', '0'), request.args.get('limit', str(changes.MAX_LIMIT))
+    if not since.isdigit() or not limit.isdigit() or not 1 <= int(limit) <= changes.MAX_LIMIT:
+        return jsonify({"message": "since must be a sync token and limit between 1 and {}".format(
+            changes.MAX_LIMIT)}), 400
+    try:
+        runs, deleted, next_token, has_more = changes.changes_since(user_id, int(since), int(limit))
+    except changes.ExpiredToken as e:
+        return jsonify({"message": str(e)}), 410
+    return jsonify({"data": RunSchema(many=True).dump(runs).data["data"],
+                    "meta": {"deleted": deleted, "next": str(next_token), "has_more": has_more}}), 200
+
+
+@runs_blueprint.route('/summary/events', methods=["GET"])
+@jwt_required
+def summary_events():
+    """
+    Server-sent events with the weekly summary row of every week whose runs
+    change, until the access token expires.
+    """
+    user = get_user_from_jwt()
+    stream = events.summary_stream(user.id, get_raw_jwt().get('exp'))
+    # The stream mostly waits, it must not keep a pool connection.
+    db.session.remove()
+    return Response(stream_with_context(stream), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@runs_blueprint.route('/records', methods=["GET"])
+@jwt_required
+def run_records():
+    """
+    Personal bests and current streak of the user, read from the maintained records.
+    """
+    user = get_user_from_jwt()
+    return jsonify({"data": {"type": "records", "id": user.id, "attributes": records.get_records(user.id).to_dict()}}), 200
+
+
+@runs_blueprint.route('/stats', methods=["GET"])
+@jwt_required
+def run_stats():
+    """
+    Derived statistics of the runs of the user, optionally restricted with
+    `since`/`until` and with the rolling pace over `window` runs.
+    """
+    from server.stats import compute_stats, load_runs
+
+    user = get_user_from_jwt()
+    window = request.args.get('window', '10')
+    if not window.isdigit() or int(window) < 1:
+        return jsonify({"message": "window must be a positive integer"}), 400
+    try:
+        since, until = time_range_args()
+    except JsonApiException as e:
+        return jsonify({"message": e.detail}), 400
+    stats = compute_stats(load_runs(user.id, since, until), window=int(window))
+    return jsonify({"data": {"type": "stats", "id": user.id, "attributes": stats}}), 200
+
+
+@operations_blueprint.route('', methods=["POST"])
+@jwt_required
+@idempotent
+def atomic_operations():
+    """
+    Applies the JSON:API atomic operations of the request on runs and users,
+    all or none of them, in one transaction.
+    """
+    headers = {'Content-Type': operations.MEDIA_TYPE}
+    document = request.get_json(silent=True)
+    ops = document.get('atomic:operations') if isinstance(document, dict) else None
+    if not isinstance(ops, list) or not ops:
+        error = {'status': '400', 'title': 'Bad request', 'detail': 'Expected a list of operations',
+                 'source': {'pointer': '/atomic:operations'}}
+        return make_response(json.dumps({"errors": [error]}), 400, headers)
+    max_operations = current_app.config['ATOMIC_OPERATIONS_MAX']
+    if len(ops) > max_operations:
+        error = {'status': '413', 'title': 'Too many operations',
+                 'detail': 'At most {} operations can be applied at once'.format(max_operations)}
+        return make_response(json.dumps({"errors": [error]}), 413, headers)
+    try:
+        results = operations.execute(ops)
+    except operations.OperationsError as e:
+        return make_response(json.dumps({"errors": e.errors}), int(e.status), headers)
+    if not any(results):
+        return make_response('', 204)
+    return make_response(json.dumps({"atomic:results": results}, cls=JSONEncoder), 200, headers)
+
+
+@health_blueprint.route('/ready', methods=["GET"])
+def ready():
+    """
+    Readiness probe, fails until the worker finished its warmup.
+    """
+    if warmup.ready.is_set() or not warmup.hooked:
+        return jsonify({"status": "ready"}), 200
+    return jsonify({"status": "warming up"}), 503
+
+
 api.route(UserList, 'user_list', '/users')
 api.route(UserDetail, 'user_detail', '/users/<string:id>')
 api.route(RunsList, 'runs_list', '/runs')
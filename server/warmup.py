@@ -0,0 +1,56 @@
+###
+# Worker warmup, primes the per-process state before a worker accepts traffic.
+###
+import threading
+
+from sqlalchemy.orm import configure_mappers
+
+from server.models import db, roles_registry, Run, User
+from server.schemas import UserSchema, RunSchema, WeeklyRunsReport
+
+# Set once the current process is warmed up, reported by the readiness endpoint.
+ready = threading.Event()
+# Whether the server warms up its workers with the hooks of gunicorn.conf.py.
+# Other servers (`flask run`, the tests) serve before any warmup, their
+# process is ready from the start.
+hooked = False
+
+
+def prepare(app):
+    """
+    Builds the state which can be shared by preforked workers: mapper
+    configuration and compiled schemas. Meant to run in the master before
+    forking so that workers share it copy-on-write.
+    """
+    configure_mappers()
+    user = User(id='warmup')
+    with app.test_request_context():
+        for schema, obj in ((UserSchema, user),
+                            (RunSchema, Run(id=0, user=user)),
+                            (WeeklyRunsReport, None)):
+            schema().dump(obj)
+            schema(many=True).dump([])
+
+
+def warm_worker(app):
+    """
+    Opens the pool connections and preloads the roles in a forked worker,
+    then marks the process as ready.
+    """
+    with app.app_context():
+        # Connections inherited from the master can't be shared across processes.
+        db.engine.dispose()
+        connections = [db.engine.connect() for _ in range(app.config.get('WARMUP_POOL_CONNECTIONS', 2))]
+        for connection in connections:
+            connection.close()
+        roles_registry.load()
+        db.session.remove()
+    ready.set()
+
+
+def warmup(app):
+    """
+    Full warmup of a single process app, e.g. when not running under gunicorn.
+    """
+    prepare(app)
+    warm_worker(app)
@@ -0,0 +1,149 @@
+###
+# Weather backfill of runs stored without weather (provider down, imports), and
+# with `stale` re-enrichment of runs whose weather was fetched long after they
+# ended. Runs close in space and time share one provider call.
+###
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import case, or_
+
+from server import changes, sharding
+from server.models import db, Checkpoint, Run
+from server.spatial import parse_point
+from server.utils import geohash, weather
+from server.utils.rate_limit import load_store, wait_for_token
+
+CHECKPOINT = 'weather_backfill'
+# Checkpoint of the --stale scans, which cover the runs with weather too.
+STALE_CHECKPOINT = 'weather_backfill_stale'
+# Keys of the provider bucket in a RedisBucketStore, apart from the login buckets.
+STORE_PREFIX = 'weather_rate_limit:'
+# Weathers kept for the (cell, bucket) groups spanning several batches.
+CACHE_SIZE = 10000
+
+store = None
+
+
+def rate_limit():
+    """
+    Waits for a provider call to be allowed by WEATHER_RATE_LIMIT.
+    """
+    global store
+    config = current_app.config
+    if store is None:
+        store = load_store(config['WEATHER_RATE_LIMIT_STORE'], config['WEATHER_RATE_LIMIT_STORE_OPTIONS'],
+                           prefix=STORE_PREFIX)
+    wait_for_token(store, 'weather', *config['WEATHER_RATE_LIMIT'])
+
+
+def _checkpoint(name, restart):
+    checkpoint = Checkpoint.query.filter_by(name=name).first()
+    if checkpoint is None:
+        checkpoint = Checkpoint(name=name, last_id=0, processed=0, updated=0)
+        db.session.add(checkpoint)
+    elif restart:
+        checkpoint.last_id = checkpoint.processed = checkpoint.updated = 0
+    db.session.commit()
+    return checkpoint
+
+
+def _bucket(start_time, minutes):
+    return int((start_time - datetime(1970, 1, 1)).total_seconds() // (minutes * 60))
+
+
+def backfill(batch_size=1000, stale=False, restart=False, progress=None, fetch=None):
+    """
+    Fetches the weather of the runs without one, and with `stale` of the runs
+    whose weather was fetched over WEATHER_BACKFILL_STALE_HOURS after their end,
+    in id order with one transaction per batch. The runs of a batch are grouped
+    by geohash cell of their end point and start time bucket, each group taking
+    the weather at the middle of its bucket. The position is saved with each
+    batch, in a checkpoint of their own for the `stale` scans, and an
+    interrupted backfill resumes there unless `restart`. Runs the provider had
+    no weather for are kept ahead of the checkpoint, for the next backfill. Calls `progress` with
+    a dict of counters after each batch. Returns the counters.
+    `fetch(lat, lng, when)` defaults to server.utils.weather.get_weather_at_time.
+    """
+    config = current_app.config
+    fetch = fetch or weather.get_weather_at_time
+    precision = config['WEATHER_BACKFILL_PRECISION']
+    minutes = config['WEATHER_BACKFILL_BUCKET_MINUTES']
+    stale_after = timedelta(hours=config['WEATHER_BACKFILL_STALE_HOURS'])
+    missing = or_(Run.weather_info.is_(None), Run.weather_info == '')
+    stats = {'processed': 0, 'updated': 0, 'unavailable': 0, 'calls': 0, 'remaining': 0}
+    started = time.monotonic()
+    cache = OrderedDict()
+
+    # Run ids are unique across shards, but each shard is scanned in id order
+    # on its own, with a checkpoint of its own.
+    name = STALE_CHECKPOINT if stale else CHECKPOINT
+    for shard in sharding.shards() or [None]:
+        checkpoint = _checkpoint(name if shard is None else '{}:{}'.format(name, shard), restart)
+
+        def scoped(query):
+            return query.set_shard(shard) if shard is not None else query
+
+        def candidates(after, *columns):
+            query = scoped(db.session.query(*columns).filter(Run.id > after))
+            return query if stale else query.filter(missing)
+
+        # The scan goes on past the runs the provider had no weather for, the
+        # checkpoint stays before the first of them so that the next backfill retries them.
+        position, unavailable = checkpoint.last_id, None
+        stats['remaining'] += candidates(position, db.func.count(Run.id)).scalar()
+        while True:
+            rows = candidates(position, Run.id, Run.user_id, Run.start_time, Run.end_time, Run.end_lat, Run.end_lng,
+                              Run.created_at, case([(missing, True)], else_=False).label('missing')
+                              ).order_by(Run.id).limit(batch_size).all()
+            if not rows:
+                break
+            groups = OrderedDict()
+            for row in rows:
+                point = parse_point(row.end_lat, row.end_lng)
+                if not point or row.start_time is None:
+                    continue
+                if not row.missing and not (row.end_time and row.created_at > row.end_time + stale_after):
+                    continue
+                key = (geohash.encode(*point, precision=precision), _bucket(row.start_time, minutes))
+                groups.setdefault(key, (point, []))[1].append((row.id, row.user_id))
+
+            updated = 0
+            try:
+                for key, (point, runs) in groups.items():
+                    if key in cache:
+                        info = cache[key]
+                    else:
+                        rate_limit()
+                        stats['calls'] += 1
+                        when = datetime(1970, 1, 1) + timedelta(minutes=(key[1] + 0.5) * minutes)
+                        info = cache[key] = fetch(*point, when)
+                        if len(cache) > CACHE_SIZE:
+                            cache.popitem(last=False)
+                    if info is None:
+                        stats['unavailable'] += len(runs)
+                        first = min(run_id for run_id, _ in runs)
+                        unavailable = first if unavailable is None else min(unavailable, first)
+                        continue
+                    scoped(Run.query.filter(Run.id.in_([run_id for run_id, _ in runs]))).update(
+                        {'weather_info': info}, synchronize_session=False)
+                    changes.log_updated(runs)
+                    updated += len(runs)
+                checkpoint.last_id = rows[-1].id if unavailable is None else unavailable - 1
+                checkpoint.processed += len(rows)
+                checkpoint.updated += updated
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            position = rows[-1].id
+            stats['processed'] += len(rows)
+            stats['updated'] += updated
+            stats['remaining'] = max(0, stats['remaining'] - len(rows))
+            if progress is not None:
+                elapsed = time.monotonic() - started
+                progress(dict(stats, runs_per_second=stats['processed'] / elapsed if elapsed else 0))
+    return stats
+
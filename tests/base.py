@@ -1,6 +1,8 @@
 import json
+from contextlib import contextmanager
 
 from flask_testing import TestCase
+from sqlalchemy import event
 
 from server import app, db
 from server.models import Role, User
@@ -97,6 +99,22 @@ class BaseTestCase(TestCase):
         )
         return response
 
+    def make_put_request(self, endpoint, data, auth_token=None):
+        headers = None
+        if auth_token is not None:
+            headers = dict(Authorization='Bearer ' + auth_token)
+
+        if type(data) is dict:
+            data = json.dumps(data)
+
+        response = self.client.put(
+            endpoint,
+            data=data,
+            content_type='application/json',
+            headers=headers
+        )
+        return response
+
     def create_user(self, user_id, auth_token=None, password="random", roles=['user']):
         """
         Creates a new user.
@@ -122,6 +140,22 @@ class BaseTestCase(TestCase):
     def log_out_user(self, auth_token):
         return self.make_post_request('/user/logout', data=None, auth_token=auth_token)
 
+    @contextmanager
+    def count_queries(self):
+        """
+        Collects the SQL statements executed within the block.
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
 
 def create_admin_user():
     User(id='admin',
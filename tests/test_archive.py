@@ -0,0 +1,94 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from server import app
+from server.archive import archive_runs, get_archive, RunArchive
+from server.models import db, Run, RunChange, RunRecords, RunTrack
+from tests.base import BaseTestCase
+
+
+class TestRunArchive(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.create_user("user1")
+        self.token = self.get_login_token("user1")
+        start = datetime(2018, 12, 20, 7, 0)
+        for day in range(0, 500, 3):
+            start_time = start + timedelta(days=day, minutes=day % 50)
+            duration = 1200 + day * 7
+            Run(user_id="user1", start_time=start_time, end_time=start_time + timedelta(seconds=duration),
+                distance=3000 + day * 13, duration=duration, date=start_time.strftime("%Y-%m-%d"),
+                start_lat="12.89", start_lng="77.64", end_lat="12.9", end_lng="77.65").save()
+
+    def tearDown(self):
+        app.config['RUNS_ARCHIVE_DIR'] = None
+        self.archive_dir.cleanup()
+        super().tearDown()
+
+    def get_results(self):
+        results = []
+        for endpoint in ("/runs/summary?page[size]=0", "/runs/summary?since=2019-03-01&until=2019-09-01",
+                         "/runs/summary?page[size]=5&page[number]=2", "/runs/export"):
+            response = self.make_get_request(endpoint, self.token)
+            self.assertStatus(response, 200)
+            results.append(response.get_data(as_text=True))
+        return results
+
+    def test_archived_results_match_live_results(self):
+        live = self.get_results()
+        app.config['RUNS_ARCHIVE_DIR'] = self.archive_dir.name
+        users, runs = archive_runs(datetime(2020, 1, 1))
+        self.assertEqual((1, 126), (users, runs))
+        self.assertEqual(41, Run.query.count())
+        self.assertEqual([2018, 2019], get_archive().years("user1"))
+        self.assertEqual(live, self.get_results())
+        self.assertEqual(167, self.get_results()[3].count('\n') - 1)
+
+    def test_archiving_logs_deletions_and_updates_records(self):
+        self.assertEqual(200, self.make_get_request("/runs/records", self.token).status_code)
+        app.config['RUNS_ARCHIVE_DIR'] = self.archive_dir.name
+        archive_runs(datetime(2020, 1, 1))
+        self.assertEqual(126, RunChange.query.filter_by(user_id="user1", deleted=True).count())
+        live_ids = {run.id for run in Run.query}
+        records = RunRecords.query.filter_by(user_id="user1").one()
+        self.assertIn(records.longest_run_id, live_ids)
+        self.assertIn(records.fastest_5k_run_id, live_ids)
+
+    def test_interrupted_archiving(self):
+        live = self.get_results()
+        app.config['RUNS_ARCHIVE_DIR'] = self.archive_dir.name
+        archive_runs(datetime(2019, 6, 1))
+        # Archive the runs again without deleting them, the live copies take precedence.
+        archive = RunArchive(self.archive_dir.name)
+        table = archive.read_year("user1", 2019)
+        rows = [row for row in db.session.execute(Run.__table__.select().where(Run.start_time < datetime(2020, 1, 1)))]
+        archive.write_year("user1", 2019, table.from_pylist([dict(row) for row in rows], schema=table.schema))
+        self.assertEqual(live, self.get_results())
+
+    def test_purge_removes_archive(self):
+        app.config['RUNS_ARCHIVE_DIR'] = self.archive_dir.name
+        archive_runs(datetime(2020, 1, 1))
+        admin_token = self.get_login_token("admin", "random")
+        response = self.make_delete_request("/users/user1", admin_token)
+        self.assertStatus(response, 200)
+        self.assertFalse(os.path.exists(os.path.join(self.archive_dir.name, "user1")))
+
+    def test_tracks_of_archived_runs_deleted(self):
+        first, last = db.session.query(db.func.min(Run.id), db.func.max(Run.id)).one()
+        for run_id in (first, last):
+            RunTrack(run_id=run_id, points=0, distance=0, data=b'').save()
+        app.config['RUNS_ARCHIVE_DIR'] = self.archive_dir.name
+        archive_runs(datetime(2020, 1, 1))
+        self.assertEqual([last], [track.run_id for track in RunTrack.query])
+
+        # A track left by an earlier archiving goes with the user.
+        RunTrack(run_id=first, points=0, distance=0, data=b'').save()
+        admin_token = self.get_login_token("admin", "random")
+        self.assertStatus(self.make_delete_request("/users/user1", admin_token), 200)
+        self.assertEqual(0, RunTrack.query.count())
+
+    def test_export_permissions(self):
+        response = self.make_get_request("/runs/export?user_id=admin", self.token)
+        self.assertStatus(response, 403)
@@ -2,6 +2,9 @@ import time
 import unittest
 import datetime
 
+from server.models import BlacklistToken
+from server.utils.rate_limit import login_rate_limiter, InMemoryBucketStore
+from server.utils.token_cache import verified_tokens
 from tests.base import BaseTestCase
 
 
@@ -124,6 +127,126 @@ class TestAuthBlueprint(BaseTestCase):
         self.assertEqual(message, "Token has expired")
         self.app.config['JWT_ACCESS_TOKEN_EXPIRES'] = datetime.timedelta(minutes=15)
 
+    def test_verified_token_is_cached(self):
+        user_id = "joe"
+        self.create_user(user_id)
+        auth_token = self.get_login_token(user_id)
+        response = self.make_get_request("/runs", auth_token)
+        self.assertStatus(response, 200)
+        claims = verified_tokens.get('Bearer ' + auth_token)
+        self.assertEqual(claims['identity'], user_id)
+
+        # Cached claims are still checked against the blacklist.
+        response = self.log_out_user(auth_token)
+        self.assertStatus(response, 200)
+        response = self.make_get_request("/runs", auth_token)
+        self.assertStatus(response, 401)
+        self.assertEqual(response.get_json()['message'], "Token has been revoked")
+
+    def test_verified_token_cache_disabled(self):
+        self.app.config['JWT_VERIFIED_TOKEN_CACHE_SIZE'] = 0
+        user_id = "joe"
+        self.create_user(user_id)
+        auth_token = self.get_login_token(user_id)
+        response = self.make_get_request("/runs", auth_token)
+        self.assertStatus(response, 200)
+        self.assertIsNone(verified_tokens.get('Bearer ' + auth_token))
+        self.app.config['JWT_VERIFIED_TOKEN_CACHE_SIZE'] = 1024
+
+    def test_refresh_token_rotation(self):
+        user_id = "joe"
+        self.create_user(user_id)
+        refresh_token = self.login_user(user_id).get_json()['refresh_token']
+        response = self.make_post_request('/user/refresh', data=None, auth_token=refresh_token)
+        self.assertStatus(response, 200)
+        tokens = response.get_json()
+        response = self.make_get_request("/runs", tokens['auth_token'])
+        self.assertStatus(response, 200)
+
+        # The rotated refresh token can't be used again.
+        response = self.make_post_request('/user/refresh', data=None, auth_token=refresh_token)
+        self.assertStatus(response, 401)
+        self.assertEqual(response.get_json()['message'], "Token has been revoked")
+        response = self.make_post_request('/user/refresh', data=None, auth_token=tokens['refresh_token'])
+        self.assertStatus(response, 200)
+
+    def test_refresh_with_access_token(self):
+        user_id = "joe"
+        self.create_user(user_id)
+        auth_token = self.get_login_token(user_id)
+        response = self.make_post_request('/user/refresh', data=None, auth_token=auth_token)
+        self.assertStatus(response, 422)
+        self.assertEqual(response.get_json()['message'], "Only refresh tokens are allowed")
+
+    def test_logout_revokes_refresh_token(self):
+        user_id = "joe"
+        self.create_user(user_id)
+        tokens = self.login_user(user_id).get_json()
+        response = self.make_post_request('/user/logout', {'refresh_token': tokens['refresh_token']},
+                                          auth_token=tokens['auth_token'])
+        self.assertStatus(response, 200)
+        response = self.make_post_request('/user/refresh', data=None, auth_token=tokens['refresh_token'])
+        self.assertStatus(response, 401)
+
+    def test_purge_blacklist(self):
+        now = datetime.datetime.utcnow()
+        BlacklistToken(token="expired", expires_at=now - datetime.timedelta(minutes=1)).save()
+        BlacklistToken(token="active", expires_at=now + datetime.timedelta(minutes=1)).save()
+        self.assertEqual(BlacklistToken.purge(), 1)
+        self.assertEqual([entry.token for entry in BlacklistToken.query.all()], ["active"])
+
+        watermark = int(time.time()) + 1
+        self.assertEqual(BlacklistToken.purge(watermark), 1)
+        self.assertEqual(BlacklistToken.query.count(), 0)
+
+    def test_revocation_watermark(self):
+        user_id = "joe"
+        self.create_user(user_id)
+        auth_token = self.get_login_token(user_id)
+        self.app.config['JWT_REVOCATION_WATERMARK'] = int(time.time()) + 1
+        response = self.make_get_request("/runs", auth_token)
+        self.assertStatus(response, 401)
+        self.assertEqual(response.get_json()['message'], "Token has been revoked")
+        self.app.config['JWT_REVOCATION_WATERMARK'] = None
+
+    def test_login_rate_limit_per_user(self):
+        self.app.config['LOGIN_RATE_LIMIT_ENABLED'] = True
+        login_rate_limiter.store.clear()
+        user_id = "joe"
+        self.create_user(user_id)
+        for _ in range(5):
+            response = self.login_user(user_id, password="wrong password")
+            self.assertStatus(response, 404)
+        response = self.login_user(user_id)
+        self.assertStatus(response, 429)
+        self.assertEqual(response.get_json()['message'], "Too many login attempts.")
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+
+        # Other users aren't throttled.
+        self.create_user("jane")
+        self.assertStatus(self.login_user("jane"), 200)
+        self.app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+
+    def test_login_rate_limit_per_ip(self):
+        self.app.config['LOGIN_RATE_LIMIT_ENABLED'] = True
+        self.app.config['LOGIN_RATE_LIMIT_PER_IP'] = (3, 60)
+        login_rate_limiter.store.clear()
+        for user_id in ["joe", "jane", "john"]:
+            self.assertStatus(self.login_user(user_id), 404)
+        response = self.login_user("admin")
+        self.assertStatus(response, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.app.config['LOGIN_RATE_LIMIT_PER_IP'] = (30, 60)
+        self.app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+
+    def test_in_memory_buckets_bounded(self):
+        store = InMemoryBucketStore(max_keys=2)
+        self.assertEqual(0, store.consume("ip:1", 1, 0.01))
+        self.assertGreater(store.consume("ip:1", 1, 0.01), 0)
+        for key in ["ip:2", "ip:3"]:
+            self.assertEqual(0, store.consume(key, 1, 0.01))
+        # ip:1, the least recently used, was dropped for ip:3.
+        self.assertEqual(["ip:2", "ip:3"], list(store._buckets))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+from copy import deepcopy
+from datetime import timedelta
+
+from server.changes import backfill, compact
+from server.models import db, Run, RunChange, RunChangeCompaction
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+
+class TestRunChanges(BaseTestCase):
+    def create_run(self, token, user_id="user1"):
+        run_object = deepcopy(sample_run_object)
+        run_object["data"]["relationships"]["user"]["data"]["id"] = user_id
+        return self.make_post_request("/runs", run_object, token).get_json()["data"]["id"]
+
+    def update_run(self, token, run_id, distance):
+        data = {"data": {"type": "run", "id": run_id, "attributes": {"distance": distance}}}
+        return self.make_patch_request("/runs/{}".format(run_id), data, token)
+
+    def get_changes(self, token, since, expected_status=200, **params):
+        query = ''.join('&{}={}'.format(key, value) for key, value in params.items())
+        response = self.make_get_request("/runs/changes?since={}{}".format(since, query), token)
+        self.assertStatus(response, expected_status)
+        return response.get_json()
+
+    def test_delta_sync(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        first, second = self.create_run(token), self.create_run(token)
+
+        body = self.get_changes(token, 0)
+        self.assertEqual([first, second], [run["id"] for run in body["data"]])
+        self.assertEqual([], body["meta"]["deleted"])
+        self.assertFalse(body["meta"]["has_more"])
+        token_1 = body["meta"]["next"]
+        self.assertEqual([], self.get_changes(token, token_1)["data"])
+
+        self.assertStatus(self.update_run(token, first, "4200"), 200)
+        self.assertStatus(self.make_delete_request("/runs/{}".format(second), token), 200)
+        third = self.create_run(token)
+        body = self.get_changes(token, token_1)
+        self.assertEqual([first, third], [run["id"] for run in body["data"]])
+        self.assertEqual("4200", body["data"][0]["attributes"]["distance"])
+        self.assertEqual([second], body["meta"]["deleted"])
+
+    def test_paging_and_permissions(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        ids = [self.create_run(token) for _ in range(5)]
+        self.create_user("user2")
+        other_token = self.get_login_token("user2")
+        self.create_run(other_token, "user2")
+
+        seen, since = [], 0
+        while True:
+            body = self.get_changes(token, since, limit=2)
+            seen += [run["id"] for run in body["data"]]
+            since = body["meta"]["next"]
+            if not body["meta"]["has_more"]:
+                break
+        self.assertEqual(ids, seen)
+
+        self.get_changes(other_token, 0, 403, user_id="user1")
+        self.assertEqual(5, len(self.get_changes(self.get_login_token("admin"), 0, user_id="user1")["data"]))
+        self.get_changes(token, "abc", 400)
+
+    def test_compaction(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        kept, deleted = self.create_run(token), self.create_run(token)
+        since = self.get_changes(token, 0)["meta"]["next"]
+        for distance in ("4000", "5000"):
+            self.update_run(token, kept, distance)
+        self.make_delete_request("/runs/{}".format(deleted), token)
+
+        self.assertEqual((3, 0), compact(timedelta(days=30)))
+        self.assertEqual(2, RunChange.query.count())
+        body = self.get_changes(token, since)
+        self.assertEqual([kept], [run["id"] for run in body["data"]])
+        self.assertEqual([deleted], body["meta"]["deleted"])
+
+        self.assertEqual((0, 1), compact(timedelta(0)))
+        self.assertEqual(RunChange.query.filter_by(run_id=deleted).count(), 0)
+        self.get_changes(token, since, 410)
+        # A full sync still works after the tombstones are gone.
+        self.assertEqual([kept], [run["id"] for run in self.get_changes(token, 0)["data"]])
+        self.assertEqual(1, RunChangeCompaction.query.count())
+
+    def test_backfill(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        ids = [self.create_run(token) for _ in range(3)]
+        RunChange.query.filter(RunChange.run_id != ids[1]).delete()
+        db.session.commit()
+        self.assertEqual(2, backfill(batch_size=2))
+        self.assertEqual(0, backfill())
+        self.assertEqual(sorted(ids), sorted(run["id"] for run in self.get_changes(token, 0)["data"]))
+        self.assertEqual(3, Run.query.count())
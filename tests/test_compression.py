@@ -0,0 +1,78 @@
+import gzip
+import json
+import unittest
+
+import brotli
+import zstandard
+
+from server.utils.compression import compression, negotiate
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+
+class TestNegotiation(unittest.TestCase):
+    def test_negotiate(self):
+        preference = ['br', 'zstd', 'gzip']
+        self.assertEqual('br', negotiate('gzip, deflate, br', preference))
+        self.assertEqual('gzip', negotiate('gzip;q=1.0, br;q=0.5', preference))
+        self.assertEqual('zstd', negotiate('zstd', preference))
+        self.assertEqual('br', negotiate('*', preference))
+        self.assertEqual('zstd', negotiate('br;q=0, *;q=0.1', preference))
+        self.assertIsNone(negotiate('identity', preference))
+        self.assertIsNone(negotiate('', preference))
+
+
+class TestCompression(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_user("user1")
+        self.token = self.get_login_token("user1")
+        for _ in range(10):
+            self.make_post_request("/runs", sample_run_object, self.token)
+
+    def get(self, endpoint, encoding):
+        return self.client.get(endpoint, headers={'Authorization': 'Bearer ' + self.token,
+                                                  'Accept-Encoding': encoding})
+
+    def test_json_api_responses_are_compressed(self):
+        plain = self.get("/runs", 'identity')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        decompress = {'gzip': gzip.decompress, 'br': brotli.decompress,
+                      'zstd': zstandard.ZstdDecompressor().decompressobj().decompress}
+        for encoding, decode in decompress.items():
+            response = self.get("/runs", encoding)
+            self.assertStatus(response, 200)
+            self.assertEqual(encoding, response.headers['Content-Encoding'])
+            self.assertLess(len(response.get_data()), len(plain.get_data()))
+            self.assertEqual(plain.get_json(), json.loads(decode(response.get_data())))
+
+    def test_small_responses_are_not_compressed(self):
+        self.app.config['COMPRESSION_MIN_SIZE'] = 10 ** 6
+        self.assertNotIn('Content-Encoding', self.get("/runs", 'gzip').headers)
+
+    def test_export_is_compressed_while_streaming(self):
+        plain = self.get("/runs/export", 'identity').get_data()
+        response = self.get("/runs/export", 'gzip')
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(plain, gzip.decompress(response.get_data()))
+
+    def test_compressed_bodies_cached_by_etag(self):
+        self.app.config['COMPRESSION_CACHE_SIZE'] = 10 ** 6
+        compression.cache.clear()
+        first = self.get("/runs", 'br')
+        second = self.get("/runs", 'br')
+        self.assertEqual(1, len(compression.cache))
+        self.assertEqual(first.get_data(), second.get_data())
+        self.assertTrue(first.headers['ETag'].endswith('-br"'))
+
+        self.make_post_request("/runs", sample_run_object, self.token)
+        self.get("/runs", 'br')
+        self.assertEqual(2, len(compression.cache))
+
+        self.app.config['COMPRESSION_CACHE_SIZE'] = 1
+        self.get("/runs", 'gzip')
+        self.assertEqual(2, len(compression.cache))
+        compression.cache.clear()
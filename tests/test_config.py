@@ -1,9 +1,11 @@
+import subprocess
+import sys
 import unittest
 
 from flask import current_app
 from flask_testing import TestCase
 
-from server import app
+from server import app, create_app
 
 
 class TestDevelopmentConfig(TestCase):
@@ -42,5 +44,25 @@ class TestProductionConfig(TestCase):
         self.assertTrue(app.config['DEBUG'] is False)
 
 
+class TestAppFactory(TestCase):
+    def create_app(self):
+        return create_app('server.config.TestingConfig')
+
+    def test_app_factory(self):
+        self.assertTrue(self.app.config['TESTING'])
+        self.assertIn('/user/login', [rule.rule for rule in self.app.url_map.iter_rules()])
+
+    def test_heavy_imports_are_deferred(self):
+        script = ("import sys; from server import create_app; create_app('server.config.TestingConfig'); "
+                  "print(sorted({'pyowm', 'coverage', 'flask_migrate', 'numpy', 'pyarrow', "
+                  "'brotli', 'zstandard'} & set(sys.modules)))")
+        output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+        self.assertEqual(output.strip(), '[]')
+        # Flask-Security comes with the models, when the app is created.
+        script = "import sys, server; print('flask_security' in sys.modules)"
+        output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+        self.assertEqual(output.strip(), 'False')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,75 @@
+import json
+import unittest
+from copy import deepcopy
+from datetime import datetime
+
+from server.events import broker, RESYNC, Subscription, week_of, week_ranges
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+
+def parse_event(chunk):
+    fields = dict(line.split(': ', 1) for line in chunk.decode().strip().splitlines())
+    return fields['event'], json.loads(fields['data'])
+
+
+class TestSummaryWeeks(unittest.TestCase):
+    def test_week_ranges(self):
+        self.assertEqual((2019, 1), week_of(datetime(2019, 12, 30)))
+        self.assertEqual([(datetime(2019, 1, 1), datetime(2019, 1, 7)),
+                          (datetime(2019, 12, 30), datetime(2020, 1, 1))], week_ranges(2019, 1))
+        self.assertEqual([(datetime(2020, 3, 2), datetime(2020, 3, 9))], week_ranges(2020, 10))
+
+    def test_subscription_is_bounded(self):
+        subscription = Subscription('user1', max_pending=2)
+        self.assertIsNone(subscription.wait(0))
+        subscription.notify((2020, 1))
+        subscription.notify((2020, 1))
+        self.assertEqual({(2020, 1)}, subscription.wait(0))
+        for week in range(1, 4):
+            subscription.notify((2020, week))
+        self.assertIs(RESYNC, subscription.wait(0))
+        self.assertIsNone(subscription.wait(0))
+
+
+class TestSummaryEvents(BaseTestCase):
+    def open_stream(self, token):
+        response = self.client.get("/runs/summary/events", headers={'Authorization': 'Bearer ' + token},
+                                   buffered=False)
+        self.assertStatus(response, 200)
+        self.assertEqual('text/event-stream', response.mimetype)
+        stream = iter(response.response)
+        self.assertTrue(next(stream).startswith(b'retry: '))
+        return response, stream
+
+    def test_summary_pushed_on_run_changes(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        response, stream = self.open_stream(token)
+        self.assertEqual(1, len(broker))
+
+        run_id = self.make_post_request("/runs", sample_run_object, token).get_json()["data"]["id"]
+        name, row = parse_event(next(stream))
+        self.assertEqual('summary', name)
+        self.assertEqual({'year': 2020, 'week_number': 4, 'average_distance': 3100.0}, {
+            key: row[key] for key in ('year', 'week_number', 'average_distance')})
+
+        # Runs of other users aren't pushed.
+        self.create_user("user2")
+        other_run = deepcopy(sample_run_object)
+        other_run["data"]["relationships"]["user"]["data"]["id"] = "user2"
+        self.make_post_request("/runs", other_run, self.get_login_token("user2"))
+
+        self.make_delete_request("/runs/{}".format(run_id), token)
+        name, row = parse_event(next(stream))
+        self.assertEqual((2020, 4, None), (row['year'], row['week_number'], row['average_distance']))
+
+        response.close()
+        self.assertEqual(0, len(broker))
+
+    def test_keepalive(self):
+        self.app.config['SUMMARY_EVENTS_HEARTBEAT'] = 0.01
+        self.create_user("user1")
+        response, stream = self.open_stream(self.get_login_token("user1"))
+        self.assertEqual(b': keepalive\n\n', next(stream))
+        response.close()
@@ -0,0 +1,104 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from copy import deepcopy
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from server.group_commit import committer
+from server.models import db, Run, RunRecords
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+
+VALID = {'user': 'user1', 'start_time': datetime(2020, 1, 20, 7), 'end_time': datetime(2020, 1, 20, 7, 30),
+         'distance': 5000, 'duration': 1800, 'date': '2020-01-20'}
+
+
+def run_object(distance):
+    data = deepcopy(sample_run_object)
+    data["data"]["attributes"]["distance"] = str(distance)
+    return data
+
+
+class TestGroupCommit(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_user("user1")
+        self.token = self.get_login_token("user1")
+        self.app.config['RUNS_GROUP_COMMIT_WINDOW_MS'] = 200
+
+    def test_concurrent_inserts_committed_together(self):
+        commits = []
+
+        def commit(connection):
+            commits.append(connection)
+
+        event.listen(db.engine, 'commit', commit)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                responses = list(pool.map(
+                    lambda distance: self.make_post_request("/runs", run_object(distance), self.token),
+                    range(3000, 11000, 1000)))
+        finally:
+            event.remove(db.engine, 'commit', commit)
+        for response in responses:
+            self.assertStatus(response, 201)
+        ids = [response.get_json()["data"]["id"] for response in responses]
+        self.assertEqual(8, len(set(ids)))
+        self.assertEqual(["3000", "4000", "5000", "6000", "7000", "8000", "9000", "10000"],
+                         [response.get_json()["data"]["attributes"]["distance"] for response in responses])
+        self.assertEqual(sorted(ids), sorted(run.id for run in Run.query.filter_by(user_id="user1")))
+        records = RunRecords.query.filter_by(user_id="user1").one()
+        self.assertEqual(10000, records.longest_run_distance)
+        # The 8 runs and their records took fewer commits than the 16 of separate requests.
+        self.assertLess(len(commits), 8)
+
+    def insert(self, data):
+        with self.app.app_context():
+            try:
+                return committer.insert(data).id
+            finally:
+                db.session.remove()
+
+    def test_failing_insert_only_fails_its_request(self):
+        existing = self.insert(VALID)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            inserted, failed = [pool.submit(self.insert, data) for data in (VALID, dict(VALID, id=existing))]
+        self.assertEqual([existing, inserted.result()], [run.id for run in Run.query.order_by(Run.id)])
+        self.assertIsInstance(failed.exception(), IntegrityError)
+
+    def test_timed_out_runs_withdrawn(self):
+        self.app.config.update(RUNS_GROUP_COMMIT_WINDOW_MS=10, RUNS_GROUP_COMMIT_TIMEOUT=0.5)
+        inserts = []
+
+        def slow_insert(conn, cursor, statement, *args):
+            if statement.startswith("INSERT INTO run ") and not inserts:
+                inserts.append(statement)
+                time.sleep(1.5)
+
+        event.listen(db.engine, 'before_cursor_execute', slow_insert)
+        try:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                slow = pool.submit(self.insert, VALID)
+                time.sleep(0.2)
+                timed_out = pool.submit(self.insert, VALID)
+                self.assertIsInstance(timed_out.exception(), TimeoutError)
+                slow.result()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', slow_insert)
+        # Inserted after the run of the request which timed out was dequeued.
+        last = self.insert(VALID)
+        self.assertEqual([slow.result(), last], [run.id for run in Run.query.order_by(Run.id)])
+
+    def test_dead_committer_replaced(self):
+        self.insert(VALID)
+        thread = committer._thread
+        # An item which isn't a (data, future) pair kills the thread.
+        committer._queue.put(None)
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.insert(VALID)
+        self.assertIsNot(thread, committer._thread)
+        self.assertEqual(2, Run.query.count())
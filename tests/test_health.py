@@ -0,0 +1,29 @@
+from sqlalchemy.orm import class_mapper
+
+from server import warmup
+from server.models import Run
+from tests.base import BaseTestCase
+
+
+class TestReadiness(BaseTestCase):
+
+    def tearDown(self):
+        warmup.hooked = False
+        super().tearDown()
+
+    def test_ready_after_warmup(self):
+        warmup.hooked = True
+        warmup.ready.clear()
+        response = self.make_get_request('/health/ready')
+        self.assertStatus(response, 503)
+        self.assertEqual(response.get_json()['status'], "warming up")
+
+        warmup.warmup(self.app)
+        self.assertTrue(class_mapper(Run).configured)
+        response = self.make_get_request('/health/ready')
+        self.assertStatus(response, 200)
+        self.assertEqual(response.get_json()['status'], "ready")
+
+    def test_ready_without_warmup_hooks(self):
+        warmup.ready.clear()
+        self.assertStatus(self.make_get_request('/health/ready'), 200)
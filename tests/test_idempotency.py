@@ -0,0 +1,87 @@
+import json
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+from server.models import db, IdempotencyKey, Run
+from server.utils.idempotency import _digest
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+
+class TestIdempotencyKeys(BaseTestCase):
+    def post_run(self, token, key, run_object=sample_run_object):
+        return self.client.post("/runs", data=json.dumps(run_object), content_type='application/json',
+                                headers={'Authorization': 'Bearer ' + token, 'Idempotency-Key': key})
+
+    def test_retries_replay_the_first_response(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        first = self.post_run(token, "key-1")
+        self.assertStatus(first, 201)
+
+        retry = self.post_run(token, "key-1")
+        self.assertStatus(retry, 201)
+        self.assertEqual(first.get_json(), retry.get_json())
+        self.assertEqual('true', retry.headers['Idempotent-Replayed'])
+        self.assertEqual(1, Run.query.count())
+
+        self.assertStatus(self.post_run(token, "key-2"), 201)
+        self.assertEqual(2, Run.query.count())
+
+    def test_key_reused_for_another_request(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        self.assertStatus(self.post_run(token, "key-1"), 201)
+        run_object = deepcopy(sample_run_object)
+        run_object["data"]["attributes"]["distance"] = "5000"
+        self.assertStatus(self.post_run(token, "key-1", run_object), 422)
+        self.assertEqual(1, Run.query.count())
+
+    def test_keys_are_scoped_per_user(self):
+        self.create_user("user1")
+        self.create_user("user2")
+        self.assertStatus(self.post_run(self.get_login_token("user1"), "key-1"), 201)
+        response = self.post_run(self.get_login_token("user2"), "key-1")
+        # The body names user1, the request of user2 runs and is denied.
+        self.assertStatus(response, 403)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+
+    def test_concurrent_and_abandoned_requests(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        key = _digest("user1", "/runs", "key-1")
+        fingerprint = _digest(json.dumps(sample_run_object).encode('utf-8'))
+        entry = IdempotencyKey(key=key, fingerprint=fingerprint, expires_at=datetime.utcnow() + timedelta(hours=1))
+        entry.save()
+
+        response = self.post_run(token, "key-1")
+        self.assertStatus(response, 409)
+        self.assertEqual('1', response.headers['Retry-After'])
+        self.assertEqual(0, Run.query.count())
+
+        # The first request died without completing, the retry takes the key over.
+        entry.created_at = datetime.utcnow() - timedelta(minutes=5)
+        db.session.commit()
+        self.assertStatus(self.post_run(token, "key-1"), 201)
+        self.assertStatus(self.post_run(token, "key-1"), 201)
+        self.assertEqual(1, Run.query.count())
+
+    def test_expired_keys(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        self.assertStatus(self.post_run(token, "key-1"), 201)
+        IdempotencyKey.query.update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        self.assertEqual(1, IdempotencyKey.purge())
+        self.assertStatus(self.post_run(token, "key-1"), 201)
+        self.assertEqual(2, Run.query.count())
+
+    def test_bulk_user_creation(self):
+        token = self.get_login_token("admin")
+        payload = json.dumps({"data": [{"type": "user", "id": "bulk1", "attributes": {"password": "random"}}]})
+        headers = {'Authorization': 'Bearer ' + token, 'Idempotency-Key': 'import-1'}
+        first = self.client.post("/users/bulk", data=payload, content_type='application/json', headers=headers)
+        retry = self.client.post("/users/bulk", data=payload, content_type='application/json', headers=headers)
+        self.assertEqual(1, first.get_json()["meta"]["created"])
+        self.assertEqual(first.get_json(), retry.get_json())
+        self.assertEqual('true', retry.headers['Idempotent-Replayed'])
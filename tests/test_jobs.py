@@ -0,0 +1,124 @@
+import time
+from datetime import datetime, timedelta
+
+from server import jobs
+from server.jobs import claim, enqueue, execute, metrics, task, Worker
+from server.models import db, Job, Run, User, UserDeletion
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+calls = []
+
+
+@task
+def record_job_call(value):
+    calls.append(value)
+
+
+@task
+def failing_job():
+    raise RuntimeError('provider unavailable')
+
+
+@task
+def slow_job(seconds):
+    time.sleep(seconds)
+    calls.append(claim())
+
+
+class TestJobQueue(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        del calls[:]
+
+    def run_worker(self, concurrency=1):
+        Worker(self.app, concurrency, burst=True).run()
+
+    def test_jobs_run_by_priority(self):
+        for value, priority in (('low', 0), ('high', 10), ('mid', 5), ('later', 20)):
+            enqueue(record_job_call, value, priority=priority, delay=3600 if value == 'later' else 0)
+        self.run_worker()
+        self.assertEqual(['high', 'mid', 'low'], calls)
+        self.assertEqual({'done': 3, 'queued': 1}, metrics()['status'])
+        self.assertRaises(ValueError, enqueue, 'unknown_task')
+
+    def test_failed_jobs_retried_with_backoff(self):
+        self.app.config['JOBS_MAX_ATTEMPTS'] = 2
+        job_id = enqueue(failing_job).id
+        self.assertFalse(execute(claim()))
+        job = Job.query.get(job_id)
+        self.assertEqual(('queued', 1), (job.status, job.attempts))
+        self.assertIn('provider unavailable', job.last_error)
+        delay = (job.run_at - datetime.utcnow()).total_seconds()
+        self.assertTrue(4 < delay <= 10, delay)
+        self.assertIsNone(claim())
+
+        self.assertFalse(execute(claim(now=job.run_at)))
+        job = Job.query.get(job_id)
+        self.assertEqual(('failed', 2), (job.status, job.attempts))
+        self.assertIsNone(claim(now=datetime.utcnow() + timedelta(days=1)))
+
+    def test_jobs_of_dead_workers_run_again(self):
+        job_id = enqueue(record_job_call, 'value').id
+        self.assertEqual(job_id, claim().id)
+        self.assertIsNone(claim())
+        later = datetime.utcnow() + timedelta(seconds=self.app.config['JOBS_LEASE_SECONDS'] + 1)
+        job = claim(now=later)
+        self.assertEqual((job_id, 2), (job.id, job.attempts))
+        self.assertTrue(execute(job))
+        self.assertEqual(['value'], calls)
+
+    def test_reclaimed_jobs_left_to_their_new_attempt(self):
+        later = datetime.utcnow() + timedelta(seconds=self.app.config['JOBS_LEASE_SECONDS'] + 1)
+        for fn, args in ((record_job_call, ('value',)), (failing_job, ())):
+            job_id = enqueue(fn, *args).id
+            stale = claim()
+            current = claim(now=later)
+            self.assertEqual((job_id, 2), (current.id, current.attempts))
+            execute(stale)
+            job = Job.query.get(job_id)
+            self.assertEqual(('running', 2, None), (job.status, job.attempts, job.last_error))
+            Job.query.filter_by(id=job_id).delete()
+            db.session.commit()
+
+    def test_leases_renewed_while_running(self):
+        self.app.config['JOBS_LEASE_SECONDS'] = 0.3
+        enqueue(slow_job, 0.6)
+        self.assertTrue(execute(claim()))
+        self.assertEqual([None], calls)
+
+    def test_expired_jobs_without_attempts_left_failed(self):
+        job_id = enqueue(record_job_call, 'value', max_attempts=1).id
+        claim()
+        later = datetime.utcnow() + timedelta(seconds=self.app.config['JOBS_LEASE_SECONDS'] + 1)
+        self.assertIsNone(claim(now=later))
+        job = Job.query.get(job_id)
+        self.assertEqual(('failed', 1), (job.status, job.attempts))
+        self.assertIn('Lease expired', job.last_error)
+
+    def test_metrics(self):
+        for value in range(5):
+            enqueue(record_job_call, value, priority=value % 2)
+        self.assertEqual({0: 3, 1: 2}, metrics()['due'])
+        self.run_worker(concurrency=3)
+        self.assertEqual(list(range(5)), sorted(calls))
+        stats = metrics()
+        self.assertEqual({'done': 5}, stats['status'])
+        self.assertEqual(5, stats['finished'])
+        self.assertEqual(0, stats['oldest_due_seconds'])
+        self.assertGreaterEqual(stats['wait_seconds']['p95'], stats['wait_seconds']['p50'])
+        self.assertEqual(0, jobs.purge_jobs())
+        self.assertEqual(5, jobs.purge_jobs(days=-1))
+
+    def test_user_deletion_queued(self):
+        self.app.config['BACKGROUND_JOBS_MODE'] = 'queue'
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        self.make_post_request("/runs", sample_run_object, token)
+        self.assertStatus(self.make_delete_request("/users/user1", token), 200)
+        self.assertEqual(['purge_user'], [job.name for job in Job.query.all()])
+        self.assertEqual(1, Run.query.count())
+        self.run_worker()
+        self.assertEqual(0, Run.query.count())
+        self.assertIsNone(User.query.get("user1"))
+        self.assertEqual('done', UserDeletion.query.one().status)
@@ -0,0 +1,102 @@
+from copy import deepcopy
+
+from server.models import Run, User
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+
+def add_run(user_id="user1"):
+    data = deepcopy(sample_run_object["data"])
+    data["relationships"]["user"]["data"]["id"] = user_id
+    return {"op": "add", "data": data}
+
+
+class TestAtomicOperations(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_user("user1")
+        self.create_user("user2")
+        self.token = self.get_login_token("user1")
+
+    def post_operations(self, operations, token=None):
+        return self.make_post_request("/operations", {"atomic:operations": operations}, token or self.token)
+
+    def test_operations_applied_in_order(self):
+        run_id = self.make_post_request("/runs", sample_run_object, self.token).get_json()["data"]["id"]
+        with self.count_queries() as queries:
+            response = self.post_operations([
+                add_run(),
+                {"op": "update", "ref": {"type": "run", "id": str(run_id)},
+                 "data": {"type": "run", "attributes": {"distance": "5000"}}},
+                {"op": "update", "data": {"type": "user", "id": "user1", "attributes": {"first_name": "Ann"}}},
+                {"op": "remove", "ref": {"type": "run", "id": str(run_id)}},
+            ])
+        self.assertStatus(response, 200)
+        self.assertIn('ext="https://jsonapi.org/ext/atomic"', response.headers['Content-Type'])
+        results = response.get_json()["atomic:results"]
+        self.assertEqual(4, len(results))
+        self.assertEqual("3100", results[0]["data"]["attributes"]["distance"])
+        self.assertEqual("5000", results[1]["data"]["attributes"]["distance"])
+        self.assertEqual("Ann", results[2]["data"]["attributes"]["first_name"])
+        self.assertEqual({}, results[3])
+        self.assertEqual([results[0]["data"]["id"]], [run.id for run in Run.query.filter_by(user_id="user1")])
+        self.assertEqual("Ann", User.query.get("user1").first_name)
+        # The token is verified once for all operations.
+        self.assertEqual(1, sum(1 for query in queries if "FROM blacklist_token" in query))
+
+    def test_failing_operation_rolls_back_all(self):
+        response = self.post_operations([
+            add_run(),
+            {"op": "update", "data": {"type": "user", "id": "user1", "attributes": {"first_name": "Ann"}}},
+            add_run("user2"),
+        ])
+        self.assertStatus(response, 403)
+        error = response.get_json()["errors"][0]
+        self.assertEqual("/atomic:operations/2", error["source"]["pointer"])
+        self.assertEqual(0, Run.query.count())
+        self.assertIsNone(User.query.get("user1").first_name)
+
+        invalid = add_run()
+        del invalid["data"]["attributes"]["distance"]
+        response = self.post_operations([add_run(), invalid])
+        self.assertStatus(response, 422)
+        self.assertEqual("/atomic:operations/1/data/attributes/distance",
+                         response.get_json()["errors"][0]["source"]["pointer"])
+        self.assertEqual(0, Run.query.count())
+
+    def test_permission_hooks_applied(self):
+        run_id = self.make_post_request("/runs", sample_run_object, self.token).get_json()["data"]["id"]
+        token = self.get_login_token("user2")
+        response = self.post_operations([{"op": "remove", "ref": {"type": "run", "id": str(run_id)}}], token)
+        self.assertStatus(response, 403)
+        response = self.post_operations([{"op": "update", "data": {"type": "user", "id": "user1",
+                                                                     "attributes": {"first_name": "Bob"}}}], token)
+        self.assertStatus(response, 403)
+        self.assertEqual(1, Run.query.count())
+
+    def test_local_ids(self):
+        admin_token = self.get_login_token("admin")
+        run = add_run("user3")
+        run["data"]["lid"] = "run"
+        response = self.post_operations([
+            {"op": "add", "data": {"type": "user", "id": "user3", "attributes": {
+                "password": "random", "email": "user3@testmail.com", "roles": ["user"]}}},
+            run,
+            {"op": "update", "ref": {"type": "run", "lid": "run"},
+             "data": {"type": "run", "attributes": {"distance": "4000"}}},
+        ], admin_token)
+        self.assertStatus(response, 200)
+        run_id = response.get_json()["atomic:results"][1]["data"]["id"]
+        self.assertEqual(run_id, response.get_json()["atomic:results"][2]["data"]["id"])
+        self.assertEqual(4000, Run.query.filter_by(user_id="user3").one().distance)
+
+    def test_invalid_requests(self):
+        self.assertStatus(self.post_operations([]), 400)
+        response = self.post_operations([{"op": "remove", "ref": {"type": "user", "id": "user1"}}])
+        self.assertStatus(response, 400)
+        self.assertEqual("/atomic:operations/0/op", response.get_json()["errors"][0]["source"]["pointer"])
+        response = self.post_operations([{"op": "update", "ref": {"type": "run", "lid": "missing"},
+                                          "data": {"type": "run", "attributes": {}}}])
+        self.assertStatus(response, 400)
+        self.app.config['ATOMIC_OPERATIONS_MAX'] = 1
+        self.assertStatus(self.post_operations([add_run(), add_run()]), 413)
@@ -0,0 +1,36 @@
+from datetime import datetime
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from server.partitioning import create_partitioned_runs, months_between, next_month, partition_name, partitioned_table
+
+
+class TestRunPartitioning(unittest.TestCase):
+    def test_month_ranges(self):
+        self.assertEqual(datetime(2021, 1, 1), next_month(datetime(2020, 12, 31, 23, 59)))
+        self.assertEqual([datetime(2020, 11, 1), datetime(2020, 12, 1), datetime(2021, 1, 1)],
+                         list(months_between(datetime(2020, 11, 20), datetime(2021, 1, 3))))
+        self.assertEqual('run_y2020m03', partition_name(datetime(2020, 3, 1)))
+
+    def test_partitioned_table_ddl(self):
+        ddl = str(CreateTable(partitioned_table()).compile(dialect=postgresql.dialect()))
+        self.assertIn('PRIMARY KEY (id, start_time)', ddl)
+        self.assertIn('PARTITION BY RANGE (start_time)', ddl)
+
+    def test_partitioned_table_keeps_model_indexes(self):
+        statements = []
+        engine = create_engine('postgresql://', strategy='mock',
+                               executor=lambda sql, *args, **kwargs: statements.append(str(
+                                   sql.compile(dialect=engine.dialect) if hasattr(sql, 'compile') else sql)))
+        create_partitioned_runs(engine)
+        self.assertIn('CREATE INDEX ix_run_start_geohash ON run (start_geohash)', statements)
+        self.assertIn('CREATE TABLE run_default PARTITION OF run DEFAULT', statements)
+
+        del statements[:]
+        create_partitioned_runs(engine, 'run_copy')
+        self.assertIn('CREATE INDEX ix_run_copy_start_geohash ON run_copy (start_geohash)', statements)
+        self.assertIn('CREATE INDEX ix_run_copy_user_id_start_time ON run_copy (user_id, start_time)', statements)
+        self.assertIn('CREATE TABLE run_copy_default PARTITION OF run_copy DEFAULT', statements)
@@ -0,0 +1,44 @@
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+
+class TestSparseFieldsets(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_user("user1")
+        self.token = self.get_login_token("user1")
+        self.run_ids = [self.make_post_request("/runs", sample_run_object, self.token).get_json()["data"]["id"]
+                        for _ in range(3)]
+
+    def get_runs(self, endpoint):
+        with self.count_queries() as queries:
+            response = self.make_get_request(endpoint, self.token)
+        self.assertStatus(response, 200)
+        return response.get_json(), [query for query in queries if 'FROM run' in query]
+
+    def test_only_requested_columns_are_selected(self):
+        body, queries = self.get_runs("/runs?fields[run]=distance,duration")
+        self.assertEqual({"distance", "duration"}, set(body["data"][0]["attributes"]))
+        select = queries[-1]
+        self.assertIn("run.distance", select)
+        self.assertNotIn("run.weather_info", select)
+        self.assertNotIn("run.start_lat", select)
+
+    def test_weather_info_loaded_in_one_query(self):
+        body, queries = self.get_runs("/runs")
+        self.assertIn("weather_info", body["data"][0]["attributes"])
+        # The count and the page, no query per run for the deferred column.
+        self.assertEqual(2, len(queries))
+        self.assertIn("run.weather_info", queries[-1])
+
+        body, queries = self.get_runs("/runs/{}?fields[run]=weather_info".format(self.run_ids[0]))
+        self.assertEqual({"weather_info"}, set(body["data"]["attributes"]))
+        self.assertIn("run.weather_info", queries[-1])
+        self.assertNotIn("run.distance", queries[-1])
+
+    def test_included_relationship_fieldsets(self):
+        body, queries = self.get_runs("/runs?include=user&fields[run]=distance,user&fields[user]=first_name")
+        self.assertEqual("user1", body["data"][0]["relationships"]["user"]["data"]["id"])
+        self.assertEqual({"first_name"}, set(body["included"][0]["attributes"]))
+        self.assertIn("run.user_id", queries[-1])
+        self.assertNotIn("password", queries[-1])
@@ -0,0 +1,142 @@
+from copy import deepcopy
+from datetime import datetime, timedelta
+
+from hypothesis import HealthCheck, settings, strategies as st
+from hypothesis.stateful import Bundle, RuleBasedStateMachine, initialize, invariant, rule
+from sqlalchemy import event
+
+from server import records
+from server.models import db, Run, RunRecords
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+FIELDS = ('fastest_5k_run_id', 'fastest_5k_pace', 'longest_run_id', 'longest_run_distance',
+          'streak_start', 'streak_end')
+
+
+class TestRunRecords(BaseTestCase):
+    def create_run(self, token, start_time, minutes, distance):
+        run_object = deepcopy(sample_run_object)
+        attributes = run_object["data"]["attributes"]
+        attributes["start_time"] = start_time.isoformat()
+        attributes["end_time"] = (start_time + timedelta(minutes=minutes)).isoformat()
+        attributes["distance"] = str(distance)
+        response = self.make_post_request("/runs", run_object, token)
+        self.assert_content_type_and_status(response, 201)
+        return response.get_json()["data"]["id"]
+
+    def get_records(self, token):
+        response = self.make_get_request("/runs/records", token)
+        self.assertStatus(response, 200)
+        return response.get_json()["data"]["attributes"]
+
+    def test_records_endpoint(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        today = datetime.utcnow().replace(hour=7, minute=0, second=0, microsecond=0)
+        slow = self.create_run(token, today - timedelta(days=2), 30, 5000)
+        fast = self.create_run(token, today - timedelta(days=1), 25, 6000)
+        long = self.create_run(token, today, 80, 12000)
+
+        result = self.get_records(token)
+        self.assertEqual({'run_id': int(fast), 'pace': 250.0, 'time': 1250.0}, result['fastest_5k'])
+        self.assertEqual({'run_id': int(long), 'distance': 12000}, result['longest_run'])
+        self.assertEqual(3, result['current_streak'])
+
+        self.make_delete_request("/runs/{}".format(fast), token)
+        result = self.get_records(token)
+        self.assertEqual(int(slow), result['fastest_5k']['run_id'])
+        self.assertEqual(1, result['current_streak'])
+        self.assertEqual(1, result['latest_streak']['length'])
+
+        self.make_delete_request("/runs/{}".format(long), token)
+        result = self.get_records(token)
+        self.assertEqual(int(slow), result['longest_run']['run_id'])
+        self.assertEqual(0, result['current_streak'])
+
+        # Besides authentication, a single lookup of the records row.
+        with self.count_queries() as queries:
+            self.get_records(token)
+        self.assertEqual(1, len([query for query in queries if 'FROM run' in query]))
+
+
+    def test_records_committed_with_the_run(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+
+        def fail_records(connection, cursor, statement, parameters, context, executemany):
+            if statement.startswith("INSERT INTO run_records"):
+                raise RuntimeError("connection lost")
+
+        event.listen(db.engine, 'before_cursor_execute', fail_records)
+        try:
+            self.assertStatus(self.make_post_request("/runs", sample_run_object, token), 500)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', fail_records)
+        self.assertEqual(0, Run.query.count())
+        commits = []
+
+        def count_commit(connection):
+            commits.append(connection)
+
+        event.listen(db.engine, 'commit', count_commit)
+        try:
+            self.assert_content_type_and_status(self.make_post_request("/runs", sample_run_object, token), 201)
+        finally:
+            event.remove(db.engine, 'commit', count_commit)
+        self.assertEqual(1, len(commits))
+        self.assertEqual(1, RunRecords.query.filter_by(user_id="user1").count())
+
+
+class RunRecordsMachine(RuleBasedStateMachine):
+    """
+    Applies random sequences of run creations, updates and deletions and
+    compares the incremental records with a full recomputation after each step.
+    """
+    runs = Bundle('runs')
+    start = datetime(2020, 1, 1, 6)
+
+    @initialize()
+    def reset(self):
+        RunRecords.query.delete()
+        Run.query.delete()
+        db.session.commit()
+
+    @rule(target=runs, day=st.integers(0, 30), distance=st.integers(0, 12000), duration=st.integers(0, 5000))
+    def create(self, day, distance, duration):
+        return Run(user_id='user1', start_time=self.start + timedelta(days=day), distance=distance,
+                   duration=duration).save().id
+
+    @rule(run_id=runs, day=st.integers(0, 30), distance=st.integers(0, 12000), duration=st.integers(0, 5000))
+    def update(self, run_id, day, distance, duration):
+        run = Run.query.get(run_id)
+        if run is None:
+            return
+        run.start_time, run.distance, run.duration = self.start + timedelta(days=day), distance, duration
+        db.session.commit()
+
+    @rule(run_id=runs)
+    def delete(self, run_id):
+        run = Run.query.get(run_id)
+        if run is None:
+            return
+        db.session.delete(run)
+        db.session.commit()
+
+    @invariant()
+    def matches_full_recomputation(self):
+        stored = RunRecords.query.filter_by(user_id='user1').first()
+        if stored is None:
+            return
+        expected = records.compute_records('user1')
+        for field in FIELDS:
+            assert getattr(stored, field) == getattr(expected, field), field
+
+
+class TestRunRecordsProperties(BaseTestCase):
+    def test_incremental_records_match_full_recomputation(self):
+        self.create_user("user1")
+        machine = RunRecordsMachine.TestCase
+        machine.settings = settings(max_examples=40, stateful_step_count=25, deadline=None,
+                                    suppress_health_check=list(HealthCheck))
+        machine().runTest()
@@ -214,6 +214,26 @@ class TestRunsEndpoint(BaseTestCase):
         response = self.make_delete_request('/runs/2', admin_token)
         self.assert_content_type_and_status(response, 200)
 
+    def test_run_detail_fetched_once(self):
+        self.create_user_with_run("user1")
+        self.create_user_with_run("user2")
+        user_token = self.get_login_token("user1")
+
+        def run_queries(method, endpoint):
+            with self.count_queries() as queries:
+                response = method(endpoint, user_token)
+            return response, [query for query in queries if "FROM run " in query or "FROM run\n" in query]
+
+        for method in (self.make_get_request, self.make_delete_request):
+            response, queries = run_queries(method, '/runs/2')
+            self.assert_content_type_and_status(response, 403)
+            self.assertEqual(1, len(queries))
+            response, queries = run_queries(method, '/runs/3')
+            self.assert_content_type_and_status(response, 404)
+            self.assertEqual(1, len(queries))
+        response, queries = run_queries(self.make_get_request, '/runs/1?fields[run]=distance')
+        self.assert_content_type_and_status(response, 200)
+        self.assertEqual(1, len(queries))
 
 
 
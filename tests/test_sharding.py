@@ -0,0 +1,197 @@
+import os
+import tempfile
+from copy import deepcopy
+from functools import lru_cache
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+
+from server import sharding
+from server.models import db, Run, RunChange
+from server.spatial import backfill_geohashes
+from server.utils.shards import shard_for
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+SHARDS = ['runs0', 'runs1']
+DIRECTORY = tempfile.TemporaryDirectory()
+
+
+@lru_cache()
+def shard_uris(main_uri):
+    """
+    Databases of the shards: TEST_RUNS_SHARD_URIS, SQLite files when the tests
+    run on SQLite, otherwise databases next to the test database, created on
+    its server when missing.
+    """
+    uris = os.getenv('TEST_RUNS_SHARD_URIS')
+    if uris:
+        return dict(zip(SHARDS, uris.split(',')))
+    if main_uri.startswith('sqlite'):
+        return {key: 'sqlite:///{}/{}.db'.format(DIRECTORY.name, key) for key in SHARDS}
+    uris = {}
+    server = create_engine(main_uri, isolation_level='AUTOCOMMIT')
+    try:
+        with server.connect() as connection:
+            for key in SHARDS:
+                url = make_url(main_uri)
+                url.database = '{}_{}'.format(url.database, key)
+                if not connection.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                                          name=url.database).scalar():
+                    connection.execute('CREATE DATABASE "{}"'.format(url.database))
+                uris[key] = str(url)
+    finally:
+        server.dispose()
+    return uris
+
+
+def run_object(user_id, distance=3100, day=20, start=None):
+    data = deepcopy(sample_run_object)
+    data["data"]["relationships"]["user"]["data"]["id"] = user_id
+    attributes = data["data"]["attributes"]
+    if start:
+        attributes["start_lat"], attributes["start_lng"] = start
+    attributes["distance"] = str(distance)
+    attributes["start_time"] = "2020-01-{}T16:34:34".format(day)
+    attributes["end_time"] = "2020-01-{}T16:54:45".format(day)
+    return data
+
+
+class TestShardedRuns(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['SQLALCHEMY_BINDS'] = shard_uris(self.app.config['SQLALCHEMY_DATABASE_URI'])
+        self.app.config['RUNS_SHARDS'] = SHARDS
+        db.session.remove()
+        sharding.drop_shards()
+        sharding.create_shards()
+        sharding.run_ids.reset()
+        # One user in each shard.
+        candidates = ['user{}'.format(number) for number in range(1, 20)]
+        self.users = [next(user_id for user_id in candidates if shard_for(user_id, SHARDS) == shard)
+                      for shard in SHARDS]
+        for user_id in self.users:
+            self.create_user(user_id)
+        self.tokens = [self.get_login_token(user_id) for user_id in self.users]
+
+    def tearDown(self):
+        super().tearDown()
+        self.app.config['RUNS_SHARDS'] = []
+        self.app.config.pop('SQLALCHEMY_BINDS', None)
+
+    def shard_run_ids(self, shard):
+        table = Run.__table__
+        return sorted(run_id for run_id, in sharding.engine(shard).execute(db.select([table.c.id])))
+
+    def post_runs(self, user_index, distances):
+        return [self.make_post_request("/runs", run_object(self.users[user_index], distance, 20 + index),
+                                       self.tokens[user_index]).get_json()["data"]["id"]
+                for index, distance in enumerate(distances)]
+
+    def test_runs_stored_in_the_shard_of_their_user(self):
+        first = self.post_runs(0, [3000, 5000])
+        second = self.post_runs(1, [4000])
+        self.assertEqual(len(set(first + second)), 3)
+        self.assertEqual(sorted(map(int, first)), self.shard_run_ids(SHARDS[0]))
+        self.assertEqual([int(second[0])], self.shard_run_ids(SHARDS[1]))
+        self.assertEqual([], self.shard_run_ids('main'))
+        # The change log stays in the main database.
+        self.assertEqual(3, RunChange.query.count())
+
+        statements = {shard: [] for shard in SHARDS}
+        for shard in SHARDS:
+            event.listen(sharding.engine(shard), 'before_cursor_execute',
+                         lambda *args, shard=shard: statements[shard].append(args[2]))
+        response = self.make_get_request("/runs", self.tokens[0])
+        self.assertEqual(sorted(first), sorted(run["id"] for run in response.get_json()["data"]))
+        summary = self.make_get_request("/runs/summary", self.tokens[0]).get_json()
+        self.assertEqual(4000, float(summary["data"][0]["attributes"]["average_distance"]))
+        self.assertEqual([], statements[SHARDS[1]])
+
+        self.assertStatus(self.make_get_request("/runs/{}".format(second[0]), self.tokens[0]), 404)
+        response = self.make_patch_request("/runs/{}".format(first[0]), {"data": {
+            "type": "run", "id": first[0], "attributes": {"distance": "3500"}}}, self.tokens[0])
+        self.assertStatus(response, 200)
+        self.assertStatus(self.make_delete_request("/runs/{}".format(first[1]), self.tokens[0]), 200)
+        self.assertEqual([int(first[0])], self.shard_run_ids(SHARDS[0]))
+
+        admin_token = self.get_login_token("admin")
+        response = self.make_get_request("/runs/{}".format(second[0]), admin_token)
+        self.assertEqual("4000", response.get_json()["data"]["attributes"]["distance"])
+        response = self.make_patch_request("/runs/{}".format(second[0]), {"data": {
+            "type": "run", "id": second[0], "relationships": {
+                "user": {"data": {"type": "user", "id": self.users[0]}}}}}, admin_token)
+        self.assertStatus(response, 400)
+
+    def test_admin_listing_merges_the_shards(self):
+        self.post_runs(0, [3000, 7000, 5000])
+        self.post_runs(1, [6000, 4000, 8000, 2000])
+        admin_token = self.get_login_token("admin")
+        distances = []
+        url = "/runs?sort=-distance&page[size]=3&include=user"
+        while url:
+            body = self.make_get_request(url, admin_token).get_json()
+            self.assertEqual(7, body["meta"]["count"])
+            self.assertTrue(all(run["relationships"]["user"]["data"] for run in body["data"]))
+            distances.extend(int(run["attributes"]["distance"]) for run in body["data"])
+            url = "/runs?sort=-distance&page[size]=3&include=user&after={}".format(body["meta"]["next"]) \
+                if "next" in body["meta"] else None
+        self.assertEqual([8000, 7000, 6000, 5000, 4000, 3000, 2000], distances)
+
+        body = self.make_get_request("/runs?sort=-distance&page[size]=3&page[number]=2", admin_token).get_json()
+        self.assertEqual(["5000", "4000", "3000"], [run["attributes"]["distance"] for run in body["data"]])
+        self.assertStatus(self.make_get_request("/runs?after=nope", admin_token), 400)
+
+    def test_admin_listing_pages_across_nulls(self):
+        self.post_runs(0, [3000, 5000, 7000])
+        self.post_runs(1, [4000, 6000])
+        for shard in SHARDS:
+            table = Run.__table__
+            sharding.engine(shard).execute(table.update().where(table.c.distance.in_([5000, 6000])).values(
+                distance=None))
+        admin_token = self.get_login_token("admin")
+        for sort, expected in (("distance", ["3000", "4000", "7000", None, None]),
+                               ("-distance", [None, None, "7000", "4000", "3000"])):
+            distances = []
+            url = "/runs?sort={}&page[size]=2".format(sort)
+            while url:
+                body = self.make_get_request(url, admin_token).get_json()
+                distances.extend(run["attributes"]["distance"] for run in body["data"])
+                url = "/runs?sort={}&page[size]=2&after={}".format(sort, body["meta"]["next"]) \
+                    if "next" in body["meta"] else None
+            self.assertEqual(expected, distances)
+
+    def test_admin_spatial_queries_merge_the_shards(self):
+        # Runs 0.001 degree of longitude apart, alternating between the shards.
+        ids = [self.make_post_request("/runs", run_object(self.users[index % 2], start=(
+            "12.97", "{:.3f}".format(77.590 + index * 0.001))), self.tokens[index % 2]).get_json()["data"]["id"]
+            for index in range(6)]
+        admin_token = self.get_login_token("admin")
+        body = self.make_get_request("/runs/nearby?lat=12.97&lng=77.5951&radius=2000&limit=3", admin_token).get_json()
+        self.assertEqual([ids[5], ids[4], ids[3]], [run["id"] for run in body["data"]])
+        body = self.make_get_request("/runs/within?bbox=12.9,77.5,13.0,77.6&limit=3", admin_token).get_json()
+        self.assertEqual(ids[:3], [run["id"] for run in body["data"]])
+
+        for shard in SHARDS:
+            sharding.engine(shard).execute(Run.__table__.update().values(start_geohash=None))
+        self.assertEqual(6, backfill_geohashes(batch_size=2))
+        self.assertEqual([0, 0], [Run.query.set_shard(shard).filter(Run.start_geohash.is_(None)).count()
+                                  for shard in SHARDS])
+
+    def test_reshard_moves_runs_from_the_main_database(self):
+        self.app.config['RUNS_SHARDS'] = []
+        db.session.remove()
+        run_ids = self.post_runs(0, [3000]) + self.post_runs(1, [4000, 5000])
+        # A legacy run without a user, which has no shard.
+        orphan = db.engine.execute(Run.__table__.insert().values(distance=1000)).inserted_primary_key[0]
+        self.app.config['RUNS_SHARDS'] = SHARDS
+        db.session.remove()
+
+        self.assertEqual(3, sharding.reshard(['main'], batch_size=2))
+        self.assertEqual(0, sharding.reshard(['main'], batch_size=2))
+        self.assertEqual([orphan], self.shard_run_ids('main'))
+        self.assertEqual([int(run_ids[0])], self.shard_run_ids(SHARDS[0]))
+        response = self.make_get_request("/runs", self.tokens[1])
+        self.assertEqual(sorted(run_ids[1:]), sorted(run["id"] for run in response.get_json()["data"]))
+        # New runs get ids after the moved ones.
+        self.assertGreater(int(self.post_runs(1, [6000])[0]), max(map(int, run_ids)))
@@ -0,0 +1,105 @@
+import unittest
+from copy import deepcopy
+from datetime import datetime
+
+from sqlalchemy import event
+
+from server.models import db, Run
+from server.spatial import backfill_geohashes, haversine, nearby
+from server.utils import geohash
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+# Start points around Bangalore, the last one ~27 km north of the others.
+POINTS = [("12.9716", "77.5946"), ("12.9760", "77.5990"), ("12.9352", "77.6245"), ("13.1986", "77.7066")]
+
+
+class TestGeohash(unittest.TestCase):
+    def test_encode(self):
+        self.assertEqual('ezs42', geohash.encode(42.6, -5.6, 5))
+        self.assertEqual('u4pruydqqvj', geohash.encode(57.64911, 10.40744, 11))
+
+    def test_cover_contains_the_points_of_the_box(self):
+        box = (12.9, 77.5, 13.0, 77.7)
+        prefixes = geohash.cover(*box)
+        self.assertLessEqual(len(prefixes), 32)
+        for lat in (12.9, 12.95, 13.0):
+            for lng in (77.5, 77.61, 77.7):
+                code = geohash.encode(lat, lng)
+                self.assertTrue(any(start <= code and (end is None or code < end)
+                                    for start, end in geohash.prefix_ranges(prefixes)))
+
+    def test_prefix_ranges(self):
+        self.assertEqual([['b', 'd'], ['z', None]], geohash.prefix_ranges(['b', 'c', 'z']))
+        self.assertEqual('c', geohash.successor('bzz'))
+        self.assertIsNone(geohash.successor('zz'))
+
+
+class TestSpatialEndpoints(BaseTestCase):
+    def create_runs(self, user_id, token):
+        ids = []
+        for lat, lng in POINTS:
+            run_object = deepcopy(sample_run_object)
+            run_object["data"]["attributes"].update(start_lat=lat, start_lng=lng)
+            run_object["data"]["relationships"]["user"]["data"]["id"] = user_id
+            ids.append(self.make_post_request("/runs", run_object, token).get_json()["data"]["id"])
+        return ids
+
+    def test_nearby_runs(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        ids = self.create_runs("user1", token)
+        self.assertEqual(geohash.encode(12.9716, 77.5946), Run.query.get(ids[0]).start_geohash)
+
+        response = self.make_get_request("/runs/nearby?lat=12.9716&lng=77.5946&radius=6000", token)
+        self.assertStatus(response, 200)
+        body = response.get_json()
+        self.assertEqual([ids[0], ids[1], ids[2]], [run["id"] for run in body["data"]])
+        self.assertAlmostEqual(haversine(12.9716, 77.5946, 12.9352, 77.6245),
+                               body["meta"]["distances"][str(ids[2])], places=0)
+
+        response = self.make_get_request("/runs/nearby?lat=12.9716&lng=77.5946&radius=1000&limit=1", token)
+        self.assertEqual([ids[0]], [run["id"] for run in response.get_json()["data"]])
+        self.assertStatus(self.make_get_request("/runs/nearby?lat=91&lng=0", token), 400)
+        self.assertStatus(self.make_get_request("/runs/nearby?lat=1&lng=1&limit=0", token), 400)
+
+    def test_nearby_candidates_bounded(self):
+        self.create_user("user1")
+        start = datetime(2020, 1, 20, 7)
+        db.session.execute(Run.__table__.insert(), [
+            dict(user_id="user1", start_time=start, end_time=start, distance=0, duration=0,
+                 start_lat="12.97", start_lng="{:.4f}".format(77.59 + i * 0.0001)) for i in range(50)])
+        db.session.commit()
+        backfill_geohashes()
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        matches = nearby(Run.query, 12.97, 77.5905, 2000, 3)
+        self.assertIn("LIMIT", statements[-1])
+        self.assertEqual({"77.5904", "77.5905", "77.5906"}, {run.start_lng for run, _ in matches})
+
+    def test_runs_within_bbox(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        ids = self.create_runs("user1", token)
+        self.create_user("user2")
+        other_token = self.get_login_token("user2")
+        self.create_runs("user2", other_token)
+
+        response = self.make_get_request("/runs/within?bbox=12.9,77.5,13.0,77.6", token)
+        self.assertStatus(response, 200)
+        self.assertEqual([ids[0], ids[1]], [run["id"] for run in response.get_json()["data"]])
+
+        admin_token = self.get_login_token("admin")
+        response = self.make_get_request("/runs/within?bbox=12.9,77.5,13.0,77.6", admin_token)
+        self.assertEqual(4, response.get_json()["meta"]["count"])
+        self.assertStatus(self.make_get_request("/runs/within?bbox=13,77,12,78", token), 400)
+
+    def test_backfill_geohashes(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        ids = self.create_runs("user1", token)
+        db.session.execute(Run.__table__.update().values(start_geohash=None))
+        db.session.commit()
+        self.assertEqual(len(ids), backfill_geohashes(batch_size=3))
+        self.assertEqual(geohash.encode(13.1986, 77.7066), Run.query.get(ids[3]).start_geohash)
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from server.models import Run
+from server.stats import compute_stats, RunArrays
+from tests.base import BaseTestCase
+
+
+class TestRunStats(BaseTestCase):
+    def test_compute_stats(self):
+        runs = RunArrays(np.array(['2020-01-01T07:00', '2020-01-02T07:00', '2020-01-03T07:00', '2020-01-10T07:00'],
+                                  dtype='datetime64[s]'),
+                         np.array([5000, 10000, np.nan, 3000]), np.array([1500, 3300, 600, 900]))
+        stats = compute_stats(runs, now=datetime(2020, 1, 11), window=2)
+        self.assertEqual(4, stats['runs'])
+        self.assertEqual(18000, stats['total_distance'])
+        self.assertEqual(310, stats['average_pace'])
+        self.assertEqual(300, stats['pace_percentiles']['50'])
+        self.assertEqual({'current': 1, 'longest': 3}, stats['streaks'])
+        self.assertEqual({'distance': 10000, 'date': '2020-01-02'}, stats['personal_bests']['longest_run'])
+        self.assertEqual(1500, stats['personal_bests']['fastest_5k']['time'])
+        self.assertEqual(315, stats['rolling']['pace_last_2_runs'])
+        self.assertEqual(3000, stats['rolling']['distance_7_days'])
+        self.assertEqual({'acute': 15, 'chronic': 26.25, 'ratio': 15 / 26.25}, stats['training_load'])
+
+    def test_stats_endpoint(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        now = datetime.utcnow().replace(hour=6)
+        for days_ago, distance in ((2, 4000), (1, 6000), (0, 5000)):
+            start_time = now - timedelta(days=days_ago)
+            Run(user_id="user1", start_time=start_time, end_time=start_time + timedelta(minutes=25),
+                distance=distance, duration=1500, date=start_time.strftime("%Y-%m-%d")).save()
+
+        response = self.make_get_request("/runs/stats?window=2", token)
+        self.assertStatus(response, 200)
+        stats = response.get_json()['data']['attributes']
+        self.assertEqual(3, stats['runs'])
+        self.assertEqual(15000, stats['total_distance'])
+        self.assertEqual({'current': 3, 'longest': 3}, stats['streaks'])
+        self.assertEqual(275, stats['rolling']['best_pace_over_2_runs'])
+
+        response = self.make_get_request("/runs/stats?since=2000-01-01&until=2000-02-01", token)
+        self.assertEqual(0, response.get_json()['data']['attributes']['runs'])
+        self.assertStatus(self.make_get_request("/runs/stats?window=0", token), 400)
@@ -154,7 +154,30 @@ class TestRunSummary(BaseTestCase):
         self.assertEqual(2020, latest_week_data["year"])
         self.assertEqual(4, latest_week_data["week_number"])
 
+    def test_summary_report_time_range(self):
+        user1_token = self.create_run_object(
+            15000,
+            datetime.strptime("2020-01-14T15:34", self.date_format),
+            datetime.strptime("2020-01-14T16:54", self.date_format),
+            "user1")
+        self.create_run_object(
+            5000,
+            datetime.strptime("2020-03-23T16:34", self.date_format),
+            datetime.strptime("2020-03-23T16:54", self.date_format),
+            "user1")
+
+        response = self.make_get_request("/runs/summary?since=2020-03-01&until=2020-04-01", user1_token)
+        self.assert_content_type_and_status(response, 200)
+        data = response.get_json()["data"]
+        self.assertEqual(1, len(data))
+        self.assertEqual(13, data[0]["attributes"]["week_number"])
+
+        response = self.make_get_request("/runs?since=2020-01-01&until=2020-02-01", user1_token)
+        self.assert_content_type_and_status(response, 200)
+        self.assertEqual(["2020-01-14"], [run["attributes"]["date"] for run in response.get_json()["data"]])
 
+        response = self.make_get_request("/runs/summary?since=March", user1_token)
+        self.assert_content_type_and_status(response, 400)
 
     def test_summary_create(self):
         # It shouldn't be allowed
@@ -0,0 +1,85 @@
+import unittest
+from copy import deepcopy
+
+import numpy as np
+
+from server.models import Run
+from server.tracks import decode, encode, haversine_distance, HEADER, HEADERS, simplify
+from tests.base import BaseTestCase
+from tests.test_runs import sample_run_object
+
+
+def random_track(count, seed=0):
+    random = np.random.RandomState(seed)
+    lat = 12.9 + np.cumsum(random.normal(0, 2e-5, count))
+    lng = 77.6 + np.cumsum(random.normal(0, 2e-5, count))
+    return lat, lng, 1579538074 + np.arange(count, dtype=float)
+
+
+class TestTrackEncoding(unittest.TestCase):
+    def test_round_trip_and_range_reads(self):
+        lat, lng, time = random_track(3000)
+        data = encode(lat, lng, time, block_size=256)
+        decoded_lat, decoded_lng, decoded_time = decode(data)
+        self.assertLessEqual(np.abs(decoded_lat - lat).max(), 5e-7)
+        self.assertLessEqual(np.abs(decoded_lng - lng).max(), 5e-7)
+        np.testing.assert_array_equal(decoded_time, time)
+
+        for start, end in ((0, 1), (255, 257), (1000, 2900), (2990, 5000), (10, 10)):
+            expected = decode(data)
+            for column, part in zip(expected, decode(data, start, end)):
+                np.testing.assert_array_equal(column[start:end], part)
+
+    def test_large_blocks_and_legacy_headers(self):
+        lat, lng, time = random_track(70000)
+        np.testing.assert_array_equal(time, decode(encode(lat, lng, time, block_size=100000))[2])
+        # The same track with the 16 bit block size of the RTK1 header.
+        data = encode(lat, lng, time, block_size=1024)
+        _, block_size, count, block_count, start_ms = HEADER.unpack_from(data)
+        legacy = HEADERS[b'RTK1'].pack(b'RTK1', block_size, count, block_count, start_ms) + data[HEADER.size:]
+        np.testing.assert_array_equal(time[5:2000], decode(legacy, 5, 2000)[2])
+
+    def test_haversine_distance(self):
+        self.assertAlmostEqual(111195.08, haversine_distance(np.array([0., 1.]), np.array([0., 0.])), places=1)
+
+    def test_simplify(self):
+        line = np.linspace(0, 0.01, 50)
+        np.testing.assert_array_equal([0, 49], simplify(line, line, 1))
+        lat, lng, _ = random_track(2000)
+        keep = simplify(lat, lng, 5)
+        self.assertLess(len(keep), len(lat))
+        self.assertEqual(len(lat), len(simplify(lat, lng, 0)))
+
+
+class TestTrackEndpoints(BaseTestCase):
+    def test_upload_and_read_track(self):
+        self.create_user("user1")
+        token = self.get_login_token("user1")
+        run_object = deepcopy(sample_run_object)
+        run_id = self.make_post_request("/runs", run_object, token).get_json()["data"]["id"]
+        lat, lng, time = random_track(2000)
+        points = np.stack([lat, lng, time], axis=1).tolist()
+
+        response = self.make_put_request("/runs/{}/track".format(run_id), {"points": points}, token)
+        self.assertStatus(response, 200)
+        attributes = response.get_json()["data"]["attributes"]
+        self.assertEqual(2000, attributes["points"])
+        self.assertAlmostEqual(haversine_distance(lat, lng), attributes["distance"])
+        self.assertEqual(round(attributes["distance"]), Run.query.get(run_id).distance)
+
+        response = self.make_get_request("/runs/{}/track?start=100&end=300".format(run_id), token)
+        self.assertStatus(response, 200)
+        returned = response.get_json()["data"]["attributes"]["points"]
+        self.assertEqual(200, len(returned))
+        self.assertAlmostEqual(points[100][0], returned[0][0], places=6)
+
+        response = self.make_get_request("/runs/{}/track?tolerance=10".format(run_id), token)
+        self.assertLess(response.get_json()["meta"]["returned"], 2000)
+
+        response = self.make_put_request("/runs/{}/track".format(run_id), {"points": [[1, 2, 3]]}, token)
+        self.assertStatus(response, 422)
+
+        self.create_user("user2")
+        other_token = self.get_login_token("user2")
+        self.assertStatus(self.make_get_request("/runs/{}/track".format(run_id), other_token), 403)
+        self.assertStatus(self.make_get_request("/runs/12345/track", token), 404)
@@ -1,3 +1,10 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from server.models import db, Role, Run, User, UserDeletion, roles_registry
+from server.tasks import purge_user, resume_user_deletions
+from server.utils.background import run_in_background
 from tests.base import BaseTestCase
 
 
@@ -175,3 +182,134 @@ class TestAuthBlueprint(BaseTestCase):
         # Admin trying to update user manager
         response = self.make_patch_request("/users/user_manager_2", patch_data, admin_token)
         self.assert_content_type_and_status(response, 200)
+
+    def test_roles_registry(self):
+        self.assertEqual(roles_registry.privileged_names(), {"admin", "usermanager"})
+        Role(name="coach", description="Coach role", privileged=True).save()
+        self.assertEqual(roles_registry.privileged_names(), {"admin", "usermanager", "coach"})
+
+        roles = roles_registry.resolve(["user", "coach"])
+        self.assertEqual([role.name for role in roles], ["user", "coach"])
+
+        admin = User.query.filter_by(id="admin").first()
+        with self.count_queries() as statements:
+            self.assertTrue(admin.is_privileged())
+        self.assertEqual(statements, [])
+
+    def test_create_user_with_unknown_role(self):
+        response = self.create_user("user1", roles=["user", "runner"])
+        self.assert_content_type_and_status(response, 422)
+        self.assertIn(b"Unknown roles: runner", response.data)
+
+    @staticmethod
+    def bulk_row(user_id, password="random", roles=['user']):
+        return {"type": "user", "id": user_id,
+                "attributes": {"password": password, "email": f"{user_id}@testmail.com", "roles": roles}}
+
+    def test_bulk_create_users(self):
+        self.app.config['BULK_PROVISIONING_POOL_THRESHOLD'] = 1
+        admin_token = self.get_login_token("admin")
+        rows = [
+            self.bulk_row("user1"),
+            self.bulk_row("admin"),
+            self.bulk_row("user2", password="short"),
+            self.bulk_row("user1"),
+            self.bulk_row("manager1", roles=["usermanager"]),
+        ]
+        response = self.make_post_request("/users/bulk", {"data": rows}, admin_token)
+        self.assertStatus(response, 200)
+        response_json = response.get_json()
+        self.assertEqual([result['status'] for result in response_json['data']],
+                         ['201', '409', '422', '409', '201'])
+        self.assertEqual(response_json['meta'], {'created': 2, 'failed': 3})
+        self.app.config['BULK_PROVISIONING_POOL_THRESHOLD'] = 16
+
+        self.assertStatus(self.login_user("user1"), 200)
+        manager = User.query.filter_by(id="manager1").first()
+        self.assertTrue(manager.has_role("usermanager"))
+
+    def test_bulk_create_users_permissions(self):
+        self.create_user("user1")
+        user1_token = self.get_login_token("user1")
+        response = self.make_post_request("/users/bulk", {"data": [self.bulk_row("user2")]}, user1_token)
+        self.assertStatus(response, 403)
+
+        admin_token = self.get_login_token("admin")
+        self.create_user("manager1", admin_token, roles=["usermanager"])
+        manager_token = self.get_login_token("manager1")
+        rows = [self.bulk_row("user2"), self.bulk_row("admin2", roles=["admin"])]
+        response = self.make_post_request("/users/bulk", {"data": rows}, manager_token)
+        self.assertStatus(response, 200)
+        self.assertEqual([result['status'] for result in response.get_json()['data']], ['201', '403'])
+
+    @staticmethod
+    def insert_runs(user_id, count):
+        start = datetime(2020, 1, 1)
+        db.session.execute(Run.__table__.insert(), [
+            {'user_id': user_id, 'start_time': start + timedelta(days=i), 'end_time': start + timedelta(days=i, hours=1),
+             'distance': 5000, 'duration': 3600}
+            for i in range(count)
+        ])
+        db.session.commit()
+
+    def test_delete_user_is_deferred(self):
+        self.app.config['BACKGROUND_JOBS_MODE'] = 'deferred'
+        self.app.config['USER_PURGE_BATCH_SIZE'] = 500
+        admin_token = self.get_login_token("admin")
+        statement_counts = []
+        for user_id, runs in (("user1", 10), ("user2", 1200)):
+            self.create_user(user_id)
+            self.insert_runs(user_id, runs)
+            with self.count_queries() as statements:
+                response = self.make_delete_request("/users/" + user_id, admin_token)
+            self.assert_content_type_and_status(response, 200)
+            self.assertEqual(response.get_json()['meta']['deletion']['status'], 'pending')
+            statement_counts.append(len(statements))
+        # The request does the same work whatever the number of runs.
+        self.assertEqual(statement_counts[0], statement_counts[1])
+        self.assertEqual(Run.query.filter_by(user_id="user2").count(), 1200)
+        self.app.config['BACKGROUND_JOBS_MODE'] = 'sync'
+
+        # The user is gone for the API right away.
+        response = self.make_get_request("/users/user2", admin_token)
+        self.assertIsNone(response.get_json()['data'])
+        self.assertStatus(self.login_user("user2"), 404)
+
+        deletion = UserDeletion.query.filter_by(user_id="user2").first()
+        purge_user(deletion.id)
+        self.assertEqual(Run.query.filter_by(user_id="user2").count(), 0)
+        self.assertIsNone(User.query.filter_by(id="user2").first())
+
+        response = self.make_get_request("/users/deletions/{}".format(deletion.id), admin_token)
+        self.assertStatus(response, 200)
+        progress = response.get_json()['data']
+        self.assertEqual(progress['status'], 'done')
+        self.assertEqual(progress['runs_total'], 1200)
+        self.assertEqual(progress['runs_deleted'], 1200)
+        self.app.config['USER_PURGE_BATCH_SIZE'] = 5000
+
+    def test_unknown_background_mode_rejected(self):
+        self.app.config['BACKGROUND_JOBS_MODE'] = 'thraed'
+        try:
+            self.assertRaises(ValueError, run_in_background, purge_user, 1)
+        finally:
+            self.app.config['BACKGROUND_JOBS_MODE'] = 'sync'
+
+    def test_failed_purge_left_to_resume(self):
+        self.create_user("user1")
+        self.insert_runs("user1", 3)
+        admin_token = self.get_login_token("admin")
+
+        def fail_purge(connection, cursor, statement, parameters, context, executemany):
+            if statement.startswith("DELETE FROM run_records"):
+                raise RuntimeError("connection lost")
+
+        event.listen(db.engine, 'before_cursor_execute', fail_purge)
+        try:
+            response = self.make_delete_request("/users/user1", admin_token)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', fail_purge)
+        self.assert_content_type_and_status(response, 200)
+        self.assertEqual('failed', UserDeletion.query.filter_by(user_id="user1").one().status)
+        self.assertEqual(1, resume_user_deletions())
+        self.assertIsNone(User.query.filter_by(id="user1").first())
@@ -0,0 +1,117 @@
+import time
+from datetime import datetime, timedelta
+
+from server import weather_backfill
+from server.models import db, Checkpoint, Run, RunChange
+from server.utils.rate_limit import RedisBucketStore
+from server.weather_backfill import backfill
+from tests.base import BaseTestCase
+
+
+class RecordingRedisStore(RedisBucketStore):
+    """
+    RedisBucketStore without a server, its buckets never empty.
+    """
+
+    def __init__(self, prefix='login_rate_limit:'):
+        self.prefix = prefix
+
+    def consume(self, key, capacity, refill_rate):
+        return 0
+
+
+class TestWeatherBackfill(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        weather_backfill.store = None
+        self.create_user("user1")
+        self.calls = []
+        start = datetime(2020, 1, 20, 7)
+        # Two runs per place and hour, one other place, one other hour, and one without coordinates.
+        self.insert_runs([(start, '12.8986343', '77.656089'), (start + timedelta(minutes=20), '12.8987', '77.6561'),
+                          (start, '48.8566', '2.3522'), (start + timedelta(minutes=10), '48.8567', '2.3523'),
+                          (start + timedelta(hours=3), '12.8986343', '77.656089'), (start, None, None)])
+
+    def insert_runs(self, runs, **values):
+        db.session.execute(Run.__table__.insert(), [
+            dict(values, user_id="user1", start_time=start, end_time=start + timedelta(minutes=30), end_lat=lat,
+                 end_lng=lng, distance=5000, duration=1800, created_at=start + timedelta(minutes=30))
+            for start, lat, lng in runs])
+        db.session.commit()
+
+    def fetch(self, lat, lng, when):
+        self.calls.append((lat, lng, when))
+        return '{{"reference_time": "{}"}}'.format(when.isoformat())
+
+    def weathers(self):
+        return [weather for weather, in db.session.query(Run.weather_info).order_by(Run.id)]
+
+    def test_runs_grouped_by_place_and_hour(self):
+        progress = []
+        stats = backfill(batch_size=4, progress=progress.append, fetch=self.fetch)
+        self.assertEqual((6, 5, 3), (stats['processed'], stats['updated'], stats['calls']))
+        self.assertEqual([(12.8986343, 77.656089, datetime(2020, 1, 20, 7, 30)),
+                          (48.8566, 2.3522, datetime(2020, 1, 20, 7, 30)),
+                          (12.8986343, 77.656089, datetime(2020, 1, 20, 10, 30))], self.calls)
+        weathers = self.weathers()
+        self.assertEqual(weathers[0], weathers[1])
+        self.assertEqual(weathers[0], weathers[2])
+        self.assertIn("10:30", weathers[4])
+        self.assertIsNone(weathers[5])
+        self.assertEqual([4, 6], [entry['processed'] for entry in progress])
+        self.assertEqual(0, progress[-1]['remaining'])
+        self.assertEqual(5, RunChange.query.count())
+
+    def test_resumes_from_checkpoint(self):
+        def failing_fetch(lat, lng, when):
+            if len(self.calls) == 2:
+                raise RuntimeError('provider unavailable')
+            return self.fetch(lat, lng, when)
+
+        self.assertRaises(RuntimeError, backfill, batch_size=4, fetch=failing_fetch)
+        checkpoint = Checkpoint.query.filter_by(name='weather_backfill').one()
+        self.assertEqual((4, 4), (checkpoint.processed, checkpoint.updated))
+        stats = backfill(batch_size=4, fetch=self.fetch)
+        self.assertEqual((2, 1, 1), (stats['processed'], stats['updated'], stats['calls']))
+        self.assertEqual(5, len([weather for weather in self.weathers() if weather]))
+        self.assertEqual(0, backfill(fetch=self.fetch)['processed'])
+        # The run without coordinates is the only one left without weather.
+        self.assertEqual(1, backfill(restart=True, fetch=self.fetch)['processed'])
+
+    def test_unavailable_weather_retried(self):
+        def fetch(lat, lng, when):
+            return None if lat > 40 else self.fetch(lat, lng, when)
+
+        stats = backfill(batch_size=2, fetch=fetch)
+        self.assertEqual((6, 3, 2), (stats['processed'], stats['updated'], stats['unavailable']))
+        # The checkpoint stays before the runs in Paris, which the next backfill retries.
+        self.assertEqual(2, Checkpoint.query.filter_by(name='weather_backfill').one().last_id)
+        stats = backfill(batch_size=2, fetch=self.fetch)
+        self.assertEqual(2, stats['updated'])
+        self.assertEqual(5, len([weather for weather in self.weathers() if weather]))
+
+    def test_stale_weather_refreshed(self):
+        backfill(fetch=self.fetch)
+        late = datetime(2020, 1, 21, 7)
+        self.insert_runs([(late, '12.8986343', '77.656089')], weather_info='{"late": true}')
+        Run.query.filter(Run.start_time == late).update({'created_at': late + timedelta(days=2)})
+        db.session.commit()
+        self.assertEqual(0, backfill(fetch=self.fetch)['updated'])
+        stats = backfill(stale=True, restart=True, fetch=self.fetch)
+        self.assertEqual(1, stats['updated'])
+        self.assertIn("2020-01-21T07:30", self.weathers()[-1])
+        # The stale scan has a checkpoint of its own.
+        self.assertEqual(6, Checkpoint.query.filter_by(name='weather_backfill').one().last_id)
+        self.assertEqual(7, Checkpoint.query.filter_by(name='weather_backfill_stale').one().last_id)
+
+    def test_redis_bucket_prefix(self):
+        self.app.config.update(WEATHER_RATE_LIMIT_STORE='tests.test_weather_backfill.RecordingRedisStore',
+                               WEATHER_RATE_LIMIT_STORE_OPTIONS={})
+        weather_backfill.rate_limit()
+        self.assertEqual('weather_rate_limit:', weather_backfill.store.prefix)
+
+    def test_provider_calls_rate_limited(self):
+        self.app.config['WEATHER_RATE_LIMIT'] = (1, 0.1)
+        started = time.monotonic()
+        self.assertEqual(3, backfill(fetch=self.fetch)['calls'])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)